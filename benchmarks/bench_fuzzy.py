@@ -0,0 +1,71 @@
+"""Бенчмарк нечеткого поиска: стоимость сообщения (мкс) для точных слов, SymSpell-индекса и перебора.
+
+Запуск: python benchmarks/bench_fuzzy.py [число_слов ...]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+# main.py проверяет токен при импорте; бот здесь не запускается
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import RuleSet, bounded_edit_distance  # noqa: E402
+
+
+def benchmark_fuzzy_matching(keyword_count: int, message_count: int = 200, tokens_per_message: int = 40):
+    """Замер стоимости сообщения (мкс): точные слова, нечеткие через индекс и наивный перебор токены × слова"""
+    rng = random.Random(42)
+    alphabet = 'абвгдеиклмнопрстуя'
+
+    def make_word():
+        return ''.join(rng.choice(alphabet) for _ in range(rng.randint(5, 9)))
+
+    def make_typo(word):
+        i = rng.randrange(len(word))
+        return word[:i] + rng.choice(alphabet) + word[i + 1:]
+
+    keywords = [make_word() for _ in range(keyword_count)]
+    messages = [
+        ' '.join(make_typo(rng.choice(keywords)) if rng.random() < 0.05 else make_word()
+                 for _ in range(tokens_per_message))
+        for _ in range(message_count)
+    ]
+
+    def measure(rule_set, sample):
+        started = time.perf_counter()
+        for text in sample:
+            rule_set.match(text)
+        return (time.perf_counter() - started) / len(sample) * 1_000_000
+
+    naive_sample = messages[:20]
+    started = time.perf_counter()
+    for text in naive_sample:
+        for token in set(text.split()):
+            for keyword in keywords:
+                bounded_edit_distance(token, keyword, 1)
+    naive = (time.perf_counter() - started) / len(naive_sample) * 1_000_000
+
+    return {
+        'exact': measure(RuleSet(keywords, []), messages),
+        'fuzzy': measure(RuleSet([f"{keyword}~1" for keyword in keywords], []), messages),
+        'naive': naive,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('counts', nargs='*', type=int, default=[200, 1000], help='число ключевых слов')
+    args = parser.parse_args()
+
+    print("⏱️ Стоимость сообщения из 40 слов, мкс:")
+    for count in args.counts:
+        result = benchmark_fuzzy_matching(count)
+        print(f"🔍 {count} слов: точно {result['exact']:.0f} • "
+              f"с опечатками (индекс) {result['fuzzy']:.0f} • перебор {result['naive']:.0f}")
+
+
+if __name__ == '__main__':
+    main()
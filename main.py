@@ -1,50 +1,336 @@
 import os
 import asyncio
 import logging
+import logging.handlers
+import queue
+import atexit
+import threading
 import sqlite3
 import re
-from datetime import datetime
+import io
+import random
+import zlib
+import math
+import socket
+import mmap
+import struct
+import bisect
+import heapq
+import fcntl
+import unicodedata
+import hashlib
+import hmac
+import secrets
+import contextlib
+import tempfile
+import sys
+import resource
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import count, islice
+from functools import lru_cache
+import csv
+import json
+from collections import deque, namedtuple, OrderedDict
+from datetime import datetime, timezone
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
-from aiogram.types import Message
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, utils
 from telethon.sessions import StringSession
 from telethon.errors import SessionPasswordNeededError, PhoneNumberInvalidError
 import aiohttp
 from aiohttp import web
 import time
 
+# Морфологический анализатор необязателен: без него слова приводятся к основе встроенным стеммером
+try:
+    import pymorphy3 as pymorphy
+except ImportError:
+    try:
+        import pymorphy2 as pymorphy
+    except ImportError:
+        pymorphy = None
+
 # Конфигурация для Railway
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = [int(x.strip()) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip()]
 PORT = int(os.getenv('PORT', 8080))
+API_TOKEN = os.getenv('API_TOKEN')
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 500))
+RECENT_ALERTS_SIZE = int(os.getenv('RECENT_ALERTS_SIZE', 50))
+ALERTS_PAGE_SIZE = 10
+STORAGE_SAMPLE_RATE = float(os.getenv('STORAGE_SAMPLE_RATE', 0.01))
+COUNTERS_FLUSH_INTERVAL = int(os.getenv('COUNTERS_FLUSH_INTERVAL', 10))
+MESSAGE_COMPRESSION = os.getenv('MESSAGE_COMPRESSION', '1') == '1'
+COMPRESS_MIN_LENGTH = int(os.getenv('COMPRESS_MIN_LENGTH', 200))
+INTERN_CACHE_SIZE = int(os.getenv('INTERN_CACHE_SIZE', 20000))
+MATCH_CACHE_SIZE = int(os.getenv('MATCH_CACHE_SIZE', 50000))
+LEMMA_CACHE_SIZE = int(os.getenv('LEMMA_CACHE_SIZE', 100000))
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', 20 * 1024 * 1024))
+# Файлы импорта больше этого размера скачиваются на диск, а не в память
+IMPORT_SPOOL_BYTES = int(os.getenv('IMPORT_SPOOL_BYTES', 1024 * 1024))
+MEMORY_BUDGET_MB = int(os.getenv('MEMORY_BUDGET_MB', 0))
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', 4))
+API_CACHE_TTL = float(os.getenv('API_CACHE_TTL', 5))
+API_ALERTS_LIMIT = 100
+MEMORY_CHECK_INTERVAL = int(os.getenv('MEMORY_CHECK_INTERVAL', 60))
+# Глубина стека tracemalloc; 0 - трассировка включается только по запросу /admin/memory?trace=1
+MEMORY_TRACE_FRAMES = int(os.getenv('MEMORY_TRACE_FRAMES', 0))
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', 8))
+MATCHER_MODE = os.getenv('MATCHER_MODE', 'inline')
+MATCHER_PROCESSES = int(os.getenv('MATCHER_PROCESSES', os.cpu_count() or 2))
+MATCHER_BATCH_SIZE = int(os.getenv('MATCHER_BATCH_SIZE', 64))
+MATCHER_BATCH_DELAY = float(os.getenv('MATCHER_BATCH_DELAY', 0.005))
+GOVERNOR_INTERVAL = float(os.getenv('GOVERNOR_INTERVAL', 1))
+GOVERNOR_MAX_DEPTH = int(os.getenv('GOVERNOR_MAX_DEPTH', 2000))
+GOVERNOR_MAX_LAG = float(os.getenv('GOVERNOR_MAX_LAG', 0.5))
+GOVERNOR_RECOVERY_TICKS = int(os.getenv('GOVERNOR_RECOVERY_TICKS', 10))
+ALERT_COALESCE_INTERVAL = int(os.getenv('ALERT_COALESCE_INTERVAL', 10))
+# Веса пользователей в планировщике: "user_id:вес,user_id:вес", по умолчанию 1 (разбираются после настройки логов)
+TENANT_WEIGHTS_SPEC = os.getenv('TENANT_WEIGHTS', '')
+# Предел очереди одного пользователя в планировщике; лишние сообщения отбрасываются
+SCHEDULER_QUEUE_LIMIT = int(os.getenv('SCHEDULER_QUEUE_LIMIT', 5000))
+REPLICA_ID = os.getenv('REPLICA_ID') or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TTL = int(os.getenv('LEASE_TTL', 60))
+LEASE_HEARTBEAT_INTERVAL = int(os.getenv('LEASE_HEARTBEAT_INTERVAL', 20))
+SESSION_RETRY_INTERVAL = int(os.getenv('SESSION_RETRY_INTERVAL', 600))
+ARCHIVE_BACKEND = os.getenv('ARCHIVE_BACKEND', 'sqlite')
+# Каждая реплика пишет в свой подкаталог ARCHIVE_DIR/<REPLICA_ID>, выгрузка читает все
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR') or ('/data/archive' if os.path.exists('/data') else 'archive')
+ARCHIVE_SEGMENT_SIZE = int(os.getenv('ARCHIVE_SEGMENT_SIZE', 64 * 1024 * 1024))
+ARCHIVE_INDEX_INTERVAL = int(os.getenv('ARCHIVE_INDEX_INTERVAL', 64 * 1024))
+# Шарды сообщений: '' - все в основной БД, 'user' - файл на пользователя, N - N файлов по user_id % N
+STORAGE_SHARDS = os.getenv('STORAGE_SHARDS', '')
+SHARD_DIR = os.getenv('SHARD_DIR') or ('/data/shards' if os.path.exists('/data') else 'shards')
+SHARD_HANDLE_CACHE = int(os.getenv('SHARD_HANDLE_CACHE', 32))
+
+# Типы чатов для фильтра сессии
+CHAT_TYPES = {
+    'channel': 'каналы',
+    'group': 'группы',
+    'private': 'личные чаты',
+}
+
+# Уровни деградации при перегрузке (включаются по порядку)
+OVERLOAD_LEVELS = {
+    0: 'норма',
+    1: 'не сохраняются сообщения без совпадений',
+    2: 'без запроса отправителя',
+    3: 'уведомления объединяются',
+    4: 'отбрасываются сессии с низким приоритетом',
+}
+
+# Кодеки текста сообщений в user_messages.text_codec
+TEXT_CODEC_PLAIN = 0
+TEXT_CODEC_ZLIB = 1
+
+# Политики хранения сообщений
+STORAGE_POLICIES = {
+    'all': 'все сообщения',
+    'matches': 'только совпадения',
+    'sample': f'совпадения + {STORAGE_SAMPLE_RATE:.0%} остальных',
+    'none': 'ничего не сохранять',
+}
+
+# Процесс пула поиска (MATCHER_MODE=process): spawn заново импортирует модуль, но воркеру нужен
+# только код поиска - без бота, потока логирования и проверки токена
+IS_MATCHER_WORKER = multiprocessing.parent_process() is not None
 
 # Проверка обязательных переменных
-if not BOT_TOKEN:
+if not BOT_TOKEN and not IS_MATCHER_WORKER:
     raise ValueError("BOT_TOKEN не установлен")
+if STORAGE_SHARDS not in ('', 'user') and not (STORAGE_SHARDS.isdigit() and int(STORAGE_SHARDS) > 0):
+    raise ValueError(f"STORAGE_SHARDS должен быть пустым, 'user' или числом больше 0, получено '{STORAGE_SHARDS}'")
 
 # Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_HOT_RATE = float(os.getenv('LOG_HOT_RATE', 20))
+
+# Стандартные атрибуты LogRecord; всё остальное - поля из extra=
+LOG_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonLogFormatter(logging.Formatter):
+    """Структурированный вывод: одна JSON-строка на запись, поля из extra= попадают в неё как есть"""
+    
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# Аргументы, которые не изменятся до форматирования в потоке слушателя
+IMMUTABLE_LOG_ARGS = (str, int, float, bytes, type(None))
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке: сообщение собирается в потоке слушателя.
+
+    Записи с изменяемыми аргументами (списки, словари, объекты) форматируются сразу, иначе в лог
+    попадет состояние аргумента на момент записи, а не на момент вызова.
+    """
+    
+    def prepare(self, record):
+        args = record.args if isinstance(record.args, tuple) else (record.args,)
+        if record.args and not all(isinstance(arg, IMMUTABLE_LOG_ARGS) for arg in args):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+class RateLimitFilter(logging.Filter):
+    """Ограничение частоты записей ниже ERROR (token bucket); число пропущенных дописывается к следующей записи"""
+    
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.suppressed = 0
+    
+    def filter(self, record):
+        # Ошибки не ограничиваются: при всплеске именно они нужны для разбора
+        if record.levelno >= logging.ERROR:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return False
+        self.tokens -= 1
+        if self.suppressed:
+            record.suppressed = self.suppressed
+            record.msg = f"{record.msg} (пропущено записей: {self.suppressed})"
+            self.suppressed = 0
+        return True
+
+def setup_logging():
+    """Логи идут через очередь в фоновый поток, чтобы запись в stdout не блокировала event loop"""
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonLogFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    root_logger = logging.getLogger()
+    root_logger.handlers.clear()
+    root_logger.addHandler(LazyQueueHandler(log_queue))
+    root_logger.setLevel(LOG_LEVEL)
+
+if IS_MATCHER_WORKER:
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+else:
+    setup_logging()
 logger = logging.getLogger(__name__)
+# Логгер для записей на каждое сообщение: ограничен по частоте
+hot_logger = logging.getLogger(f"{__name__}.hot")
+hot_logger.addFilter(RateLimitFilter(LOG_HOT_RATE))
+
+def parse_tenant_weights(spec: str):
+    """Разбор TENANT_WEIGHTS: некорректные записи и веса <= 0 пропускаются с ошибкой в логе"""
+    weights = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        try:
+            user_id, weight = item.split(':')
+            user_id, weight = int(user_id), float(weight)
+        except ValueError:
+            logger.error(f"❌ TENANT_WEIGHTS: запись '{item.strip()}' пропущена, нужен формат user_id:вес")
+            continue
+        if not weight > 0 or math.isinf(weight):
+            logger.error(f"❌ TENANT_WEIGHTS: вес пользователя {user_id} должен быть больше 0, получено {weight}")
+            continue
+        weights[user_id] = weight
+    return weights
 
-# Инициализация бота
-bot = Bot(
+TENANT_WEIGHTS = parse_tenant_weights(TENANT_WEIGHTS_SPEC)
+
+# Инициализация бота (в воркерах пула поиска бот не создается)
+bot = None if IS_MATCHER_WORKER else Bot(
     token=BOT_TOKEN,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 dp = Dispatcher()
 
-# Словарь для хранения активных клиентов Telethon
+# Клиенты Telethon по id аккаунта Telegram: одно соединение на аккаунт
 active_clients = {}
+# Подписчики аккаунта: account_id -> {(user_id, session_id): session_name}
+account_subscribers = {}
+# Запущенные сессии: (user_id, session_id) -> account_id
+session_accounts = {}
+# Username подключенных аккаунтов для сообщений о запуске
+account_usernames = {}
+# Сессии, запуск которых идет прямо сейчас (между проверками и подключением есть await)
+starting_sessions = set()
+# Аккаунты, которые сейчас подключаются: account_id -> событие окончания подключения
+starting_accounts = {}
 
-# Простой флуд-контроль
+# Простой флуд-контроль (старые записи чистит memory_watch_loop)
 user_last_message = {}
 
+# Предыдущий снимок tracemalloc для сравнения в /admin/memory
+memory_snapshot = None
+
+# Задача поллинга бота (работает только на реплике-лидере)
+polling_task = None
+# Неудачные запуски сессий по аренде: session_id -> время попытки
+session_start_failures = {}
+
+# Кольцевой буфер последних уведомлений: user_id -> deque[(timestamp, id, chat_name, username, keywords, text, seq)]
+recent_alerts = {}
+# Порядковые номера записей буфера - курсор страниц /my_alerts
+alert_sequence = count(1)
+# Пользователи, для которых буфер уже дополнен историей из БД
+recent_alerts_seeded = set()
+
+# Кэш политик хранения: (user_id, session_id) -> policy
+storage_policies = {}
+# Несохраненные сообщения до сброса в БД: (user_id, session_id) -> [сообщений, из них с ключами]
+pending_message_counters = {}
+# Почасовые агрегаты до сброса в БД: (user_id, час, chat_id) -> [сообщений, с ключами, название чата]
+pending_chat_rollups = {}
+# (user_id, час, ключевое слово) -> число уведомлений
+pending_keyword_rollups = {}
+
+# Фильтры чатов запущенных сессий: (user_id, session_id) -> {'include', 'exclude', 'types'}
+session_chat_filters = {}
+# Версии настроек пользователей (users.cache_version), известные этой реплике
+user_cache_versions = {}
+# Версии уведомлений пользователей (users.alerts_version), известные этой реплике
+user_alert_versions = {}
+# Пользователи, чей буфер уведомлений нужно дополнить из БД (уведомления пришли на других репликах)
+recent_alerts_stale = set()
+
+# Архив сообщений в сегментных файлах (ARCHIVE_BACKEND=segments)
+message_archive = None
+
+# Скомпилированные правила: user_id -> RuleSet
+user_rule_sets = {}
+# Версии правил без компиляции: в режиме пула процессов правила компилируются только в воркерах
+user_rule_versions = {}
+
+# Кэши интернирования измерений: chat_id -> (chat_ref, chat_name, message_type), username -> sender_ref
+chat_refs = {}
+sender_refs = {}
+
 async def safe_send_message(user_id: int, text: str, reply_markup=None):
     """Безопасная отправка сообщения с базовым флуд-контролем"""
     try:
@@ -58,10 +344,10 @@ async def safe_send_message(user_id: int, text: str, reply_markup=None):
         
         await bot.send_message(user_id, text, reply_markup=reply_markup, parse_mode=None)
         user_last_message[user_id] = time.time()
-        logger.debug(f"📤 Сообщение отправлено пользователю {user_id}")
+        hot_logger.debug("📤 Сообщение отправлено пользователю %s", user_id)
         
     except Exception as e:
-        logger.error(f"❌ Ошибка отправки сообщения {user_id}: {e}")
+        hot_logger.error("❌ Ошибка отправки сообщения %s: %s", user_id, e)
 
 def init_db():
     """Инициализация базы данных"""
@@ -133,24 +419,101 @@ def init_db():
             )
         ''')
         
-        # Сообщения пользователей
+        # Ключевые слова и исключения, действующие только в указанных чатах
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_messages (
+            CREATE TABLE IF NOT EXISTS user_chat_keywords (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                chat_id INTEGER,
+                keyword TEXT,
+                is_exception BOOLEAN DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(user_id, chat_id, keyword, is_exception),
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_chat_keywords_user ON user_chat_keywords(user_id)')
+        
+        # Сообщения пользователей и измерения чатов и отправителей
+        init_message_tables(cursor)
+        
+        # Аренды сессий и лидерства между репликами
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT,
+                expires_at REAL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS replica_heartbeats (
+                replica_id TEXT PRIMARY KEY,
+                last_seen REAL
+            )
+        ''')
+        
+        # Личные токены HTTP API (хранится только хэш)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS api_tokens (
+                user_id INTEGER PRIMARY KEY,
+                token_hash TEXT UNIQUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Счетчики сообщений, не записанных в user_messages по политике хранения
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_message_counters (
                 user_id INTEGER,
                 session_id INTEGER,
+                skipped_messages INTEGER DEFAULT 0,
+                skipped_alerts INTEGER DEFAULT 0,
+                PRIMARY KEY (user_id, session_id)
+            )
+        ''')
+        
+        # Почасовые агрегаты по чатам и ключевым словам (час - unix-время // 3600)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_hourly_stats (
+                user_id INTEGER,
+                hour INTEGER,
                 chat_id TEXT,
                 chat_name TEXT,
-                username TEXT,
-                message_text TEXT,
-                has_keywords BOOLEAN DEFAULT 0,
-                keywords_found TEXT,
-                message_type TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
+                messages INTEGER DEFAULT 0,
+                alerts INTEGER DEFAULT 0,
+                PRIMARY KEY (user_id, hour, chat_id)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS keyword_hourly_stats (
+                user_id INTEGER,
+                hour INTEGER,
+                keyword TEXT,
+                alerts INTEGER DEFAULT 0,
+                PRIMARY KEY (user_id, hour, keyword)
             )
         ''')
         
+        # Миграции существующих таблиц
+        add_column_if_missing(cursor, 'users', 'storage_policy', "TEXT DEFAULT 'all'")
+        add_column_if_missing(cursor, 'users', 'rules_version', "INTEGER DEFAULT 0")
+        add_column_if_missing(cursor, 'users', 'morphology', "INTEGER DEFAULT 0")
+        add_column_if_missing(cursor, 'user_keywords', 'lemmas', "TEXT")
+        add_column_if_missing(cursor, 'user_exceptions', 'lemmas', "TEXT")
+        add_column_if_missing(cursor, 'user_chat_keywords', 'lemmas', "TEXT")
+        add_column_if_missing(cursor, 'user_sessions', 'storage_policy', "TEXT")
+        add_column_if_missing(cursor, 'user_sessions', 'chat_include', "TEXT")
+        add_column_if_missing(cursor, 'user_sessions', 'chat_exclude', "TEXT")
+        add_column_if_missing(cursor, 'user_sessions', 'chat_types', "TEXT")
+        add_column_if_missing(cursor, 'user_sessions', 'start_failed', "INTEGER DEFAULT 0")
+        add_column_if_missing(cursor, 'user_sessions', 'account_id', "INTEGER")
+        add_column_if_missing(cursor, 'users', 'cache_version', "INTEGER DEFAULT 0")
+        add_column_if_missing(cursor, 'users', 'alerts_version', "INTEGER DEFAULT 0")
+        cursor.execute("PRAGMA user_version")
+        if cursor.fetchone()[0] < 1:
+            migrate_literal_keywords(cursor)
+            cursor.execute("PRAGMA user_version = 1")
+        
         # Добавляем админов в белый список
         for admin_id in ADMIN_IDS:
             cursor.execute("INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)", 
@@ -165,11 +528,157 @@ def init_db():
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации БД: {e}")
 
+def init_message_tables(cursor):
+    """Таблицы сообщений: в основной БД или в файле шарда"""
+    # Сообщения пользователей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            session_id INTEGER,
+            chat_id TEXT,
+            chat_name TEXT,
+            username TEXT,
+            message_text TEXT,
+            has_keywords BOOLEAN DEFAULT 0,
+            keywords_found TEXT,
+            message_type TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_messages_user_id ON user_messages (user_id)")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_messages_alerts ON user_messages (user_id, has_keywords, timestamp)"
+    )
+    
+    # Измерения: чаты и отправители хранятся один раз, сообщения ссылаются на них по id
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT UNIQUE,
+            chat_name TEXT,
+            message_type TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS senders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE
+        )
+    ''')
+    
+    # Миграции существующих таблиц
+    add_column_if_missing(cursor, 'user_messages', 'chat_ref', "INTEGER")
+    add_column_if_missing(cursor, 'user_messages', 'sender_ref', "INTEGER")
+    add_column_if_missing(cursor, 'user_messages', 'text_codec', "INTEGER DEFAULT 0")
+    
+    # Представление для чтения: новые строки берут чат и отправителя из измерений, старые - из своих колонок
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS user_messages_view AS
+        SELECT
+            m.id, m.user_id, m.session_id,
+            COALESCE(c.chat_id, m.chat_id) AS chat_id,
+            COALESCE(c.chat_name, m.chat_name) AS chat_name,
+            COALESCE(s.username, m.username) AS username,
+            COALESCE(c.message_type, m.message_type) AS message_type,
+            m.has_keywords, m.keywords_found, m.message_text, m.text_codec, m.timestamp
+        FROM user_messages m
+        LEFT JOIN chats c ON c.id = m.chat_ref
+        LEFT JOIN senders s ON s.id = m.sender_ref
+    ''')
+
+def migrate_literal_keywords(cursor):
+    """Слова, сохраненные до появления правил, остаются простыми: если текст читается как правило
+    (заглавные И/ИЛИ/НЕ, скобки, кавычки, * или ~), к нему добавляется префикс LITERAL_PREFIX"""
+    migrated = 0
+    for table, column in (('user_keywords', 'keyword'), ('user_exceptions', 'exception_word'),
+                          ('user_chat_keywords', 'keyword')):
+        cursor.execute(f"SELECT id, user_id, {column} FROM {table}")
+        rows = [(row_id, user_id, text) for row_id, user_id, text in cursor.fetchall() if is_rule(text)]
+        cursor.executemany(f"UPDATE OR IGNORE {table} SET {column} = ? WHERE id = ?",
+                           [(LITERAL_PREFIX + text, row_id) for row_id, _, text in rows])
+        cursor.executemany("UPDATE users SET rules_version = rules_version + 1 WHERE user_id = ?",
+                           [(user_id,) for user_id in {user_id for _, user_id, _ in rows}])
+        migrated += len(rows)
+    if migrated:
+        logger.warning(f"⚠️ {migrated} старых ключевых слов похожи на правила и помечены как простые ({LITERAL_PREFIX})")
+
+def add_column_if_missing(cursor, table: str, column: str, definition: str):
+    """Добавление колонки в существующую таблицу, если её ещё нет"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
 def get_db_connection():
     """Получение соединения с БД"""
     db_path = '/data/monitoring.db' if os.path.exists('/data') else 'monitoring.db'
     return sqlite3.connect(db_path, check_same_thread=False)
 
+def message_shard_key(user_id: int):
+    """Шард сообщений пользователя ('' - основная БД)"""
+    if not STORAGE_SHARDS:
+        return ''
+    if STORAGE_SHARDS == 'user':
+        return f"user_{user_id}"
+    return f"bucket_{user_id % int(STORAGE_SHARDS):04d}"
+
+def message_shard_path(shard_key: str):
+    """Файл БД шарда"""
+    if not shard_key:
+        return '/data/monitoring.db' if os.path.exists('/data') else 'monitoring.db'
+    return os.path.join(SHARD_DIR, f"{shard_key}.db")
+
+class ShardHandles:
+    """Открытые соединения записи по шардам: открываются лениво, лишние закрываются по LRU"""
+    
+    def __init__(self, max_open: int):
+        self.max_open = max_open
+        self.handles = OrderedDict()
+        self.initialized = set()
+        self.opened = 0
+    
+    def get(self, shard_key: str):
+        conn = self.handles.get(shard_key)
+        if conn is not None:
+            self.handles.move_to_end(shard_key)
+            return conn
+        if shard_key:
+            os.makedirs(SHARD_DIR, exist_ok=True)
+        conn = sqlite3.connect(message_shard_path(shard_key), check_same_thread=False)
+        self.opened += 1
+        if shard_key and shard_key not in self.initialized:
+            # WAL: чтения выгрузки не блокируют запись в шард
+            conn.execute("PRAGMA journal_mode=WAL")
+            init_message_tables(conn.cursor())
+            conn.commit()
+            self.initialized.add(shard_key)
+        self.handles[shard_key] = conn
+        if len(self.handles) > self.max_open:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+        return conn
+    
+    def stats(self):
+        return {'mode': STORAGE_SHARDS or 'single', 'open': len(self.handles), 'max_open': self.max_open, 'opened': self.opened}
+
+shard_handles = ShardHandles(SHARD_HANDLE_CACHE)
+
+def connect_message_db(user_id: int):
+    """Отдельное соединение для чтения сообщений пользователя (закрывает вызывающий)"""
+    shard_key = message_shard_key(user_id)
+    # Шард создается при первом обращении, чтобы чтение пустого шарда не падало на отсутствии таблиц
+    shard_handles.get(shard_key)
+    return sqlite3.connect(message_shard_path(shard_key), check_same_thread=False)
+
+def list_message_shards():
+    """Все существующие шарды сообщений (для выгрузок без фильтра по пользователю)"""
+    if not STORAGE_SHARDS:
+        return ['']
+    if not os.path.isdir(SHARD_DIR):
+        return []
+    return sorted(name[:-3] for name in os.listdir(SHARD_DIR) if name.endswith('.db'))
+
 def is_user_allowed(user_id: int):
     """Проверка доступа пользователя"""
     try:
@@ -274,26 +783,37 @@ def add_user_keywords(user_id: int, keywords_text: str):
         conn = get_db_connection()
         cursor = conn.cursor()
         
+        # Правила проверяем сразу, чтобы не сохранять то, что не скомпилируется
+        invalid = []
+        for keyword in list(keywords):
+            if is_rule(keyword):
+                try:
+                    parse_rule(keyword)
+                except RuleSyntaxError as e:
+                    invalid.append(f"{keyword} ({e})")
+                    keywords.remove(keyword)
+        
         added_count = 0
         for keyword in keywords:
             try:
                 cursor.execute(
-                    "INSERT OR IGNORE INTO user_keywords (user_id, keyword) VALUES (?, ?)",
-                    (user_id, keyword)
+                    "INSERT OR IGNORE INTO user_keywords (user_id, keyword, lemmas) VALUES (?, ?, ?)",
+                    (user_id, keyword, keyword_lemmas(keyword))
                 )
                 added_count += 1
             except:
                 continue
         
+        bump_rules_version(cursor, user_id)
         conn.commit()
         conn.close()
         
         logger.info(f"🔍 Пользователь {user_id} добавил {added_count} ключевых слов")
-        return added_count, keywords
+        return added_count, keywords, invalid
         
     except Exception as e:
         logger.error(f"❌ Ошибка добавления ключевых слов для {user_id}: {e}")
-        return 0, []
+        return 0, [], []
 
 def add_user_exceptions(user_id: int, exceptions_text: str):
     """Добавление исключений через запятую"""
@@ -304,26 +824,97 @@ def add_user_exceptions(user_id: int, exceptions_text: str):
         conn = get_db_connection()
         cursor = conn.cursor()
         
+        # Правила проверяем сразу, чтобы не сохранять то, что не скомпилируется
+        invalid = []
+        for exception in list(exceptions):
+            if is_rule(exception):
+                try:
+                    parse_rule(exception)
+                except RuleSyntaxError as e:
+                    invalid.append(f"{exception} ({e})")
+                    exceptions.remove(exception)
+        
         added_count = 0
         for exception in exceptions:
             try:
                 cursor.execute(
-                    "INSERT OR IGNORE INTO user_exceptions (user_id, exception_word) VALUES (?, ?)",
-                    (user_id, exception)
+                    "INSERT OR IGNORE INTO user_exceptions (user_id, exception_word, lemmas) VALUES (?, ?, ?)",
+                    (user_id, exception, keyword_lemmas(exception))
                 )
                 added_count += 1
             except:
                 continue
         
+        bump_rules_version(cursor, user_id)
         conn.commit()
         conn.close()
         
         logger.info(f"🚫 Пользователь {user_id} добавил {added_count} исключений")
-        return added_count, exceptions
+        return added_count, exceptions, invalid
         
     except Exception as e:
         logger.error(f"❌ Ошибка добавления исключений для {user_id}: {e}")
-        return 0, []
+        return 0, [], []
+
+# Таблицы для массового импорта: (таблица, колонка слова)
+IMPORT_TARGETS = {
+    False: ('user_keywords', 'keyword'),
+    True: ('user_exceptions', 'exception_word'),
+}
+
+def iter_import_terms(stream, filename: str):
+    """Потоковый разбор файла импорта: одно слово или правило в строке, для CSV - первая колонка"""
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace')
+    if filename.lower().endswith('.csv'):
+        lines = (row[0] if row else '' for row in csv.reader(text_stream))
+    else:
+        lines = text_stream
+    for line in lines:
+        term = line.strip()
+        if term and not term.startswith('#'):
+            yield term
+
+def import_user_terms(user_id: int, terms, is_exception: bool = False, chat_id: int = None):
+    """Массовый импорт ключевых слов или исключений одной транзакцией; версия правил меняется один раз.
+    Выполняется в потоке, поэтому кэш скомпилированных правил не трогает - после импорта
+    event loop вызывает reload_rule_set. Возвращает (добавлено, дубликаты, некорректные правила)."""
+    valid = {}
+    invalid = []
+    for term in terms:
+        if is_rule(term):
+            try:
+                parse_rule(term)
+            except RuleSyntaxError as e:
+                invalid.append(f"{term} ({e})")
+                continue
+        valid[term] = valid.get(term, 0) + 1
+    
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if chat_id is not None:
+            cursor.executemany(
+                "INSERT OR IGNORE INTO user_chat_keywords (user_id, chat_id, keyword, is_exception, lemmas) VALUES (?, ?, ?, ?, ?)",
+                ((user_id, chat_id, term, int(is_exception), keyword_lemmas(term)) for term in valid)
+            )
+        else:
+            table, column = IMPORT_TARGETS[is_exception]
+            cursor.executemany(
+                f"INSERT OR IGNORE INTO {table} (user_id, {column}, lemmas) VALUES (?, ?, ?)",
+                ((user_id, term, keyword_lemmas(term)) for term in valid)
+            )
+        added_count = max(cursor.rowcount, 0)
+        increment_rules_version(cursor, user_id)
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка импорта для {user_id}: {e}")
+        return 0, 0, invalid
+    
+    duplicates = sum(valid.values()) - added_count
+    logger.info(f"📥 Пользователь {user_id} импортировал {added_count} записей "
+                f"(дубликатов {duplicates}, некорректных {len(invalid)})")
+    return added_count, duplicates, invalid
 
 def get_user_keywords(user_id: int):
     """Получение ключевых слов пользователя с ID"""
@@ -351,12 +942,200 @@ def get_user_exceptions(user_id: int):
         logger.error(f"❌ Ошибка получения исключений для {user_id}: {e}")
         return []
 
+def normalize_chat_id(value):
+    """id чата без префикса -100, как в chat.id у Telethon"""
+    return utils.resolve_id(int(value))[0]
+
+def add_chat_keywords(user_id: int, chat_id: int, words_text: str, is_exception: bool = False):
+    """Добавление ключевых слов или исключений для одного чата через запятую"""
+    try:
+        words = [word.strip() for word in words_text.split(',') if word.strip()]
+        
+        # Правила проверяем сразу, чтобы не сохранять то, что не скомпилируется
+        invalid = []
+        for word in list(words):
+            if is_rule(word):
+                try:
+                    parse_rule(word)
+                except RuleSyntaxError as e:
+                    invalid.append(f"{word} ({e})")
+                    words.remove(word)
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT OR IGNORE INTO user_chat_keywords (user_id, chat_id, keyword, is_exception, lemmas) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, chat_id, word, int(is_exception), keyword_lemmas(word)) for word in words]
+        )
+        added_count = cursor.rowcount
+        bump_rules_version(cursor, user_id)
+        conn.commit()
+        conn.close()
+        
+        logger.info(f"💬 Пользователь {user_id} добавил {added_count} записей для чата {chat_id}")
+        return added_count, words, invalid
+    except Exception as e:
+        logger.error(f"❌ Ошибка добавления ключевых слов чата для {user_id}: {e}")
+        return 0, [], []
+
+def get_chat_keywords(user_id: int):
+    """Ключевые слова и исключения пользователя, привязанные к чатам"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, chat_id, keyword, is_exception FROM user_chat_keywords WHERE user_id = ? ORDER BY chat_id, id",
+            (user_id,)
+        )
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения ключевых слов чатов для {user_id}: {e}")
+        return []
+
+def delete_chat_keyword(user_id: int, entry_id: int):
+    """Удаление ключевого слова или исключения чата"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM user_chat_keywords WHERE id = ? AND user_id = ?", (entry_id, user_id))
+        deleted = cursor.rowcount > 0
+        bump_rules_version(cursor, user_id)
+        conn.commit()
+        conn.close()
+        logger.info(f"🗑️ Пользователь {user_id} удалил запись чата ID: {entry_id}")
+        return deleted
+    except Exception as e:
+        logger.error(f"❌ Ошибка удаления ключевого слова чата: {e}")
+        return False
+
+def parse_chat_ids(value: str):
+    """Разбор списка id чатов, разделенных запятыми или пробелами"""
+    return {int(item) for item in re.split(r'[\s,]+', value or '') if item}
+
+def record_own_version(known_versions: dict, user_id: int, version: int):
+    """Версия, записанная самой репликой: если до нее реплика видела все изменения, ее кэши актуальны"""
+    if known_versions.get(user_id) == version - 1:
+        known_versions[user_id] = version
+
+def bump_cache_version(cursor, user_id: int):
+    """Новая версия настроек пользователя: другие реплики сбросят свои кэши при синхронизации"""
+    cursor.execute("UPDATE users SET cache_version = cache_version + 1 WHERE user_id = ? RETURNING cache_version",
+                   (user_id,))
+    row = cursor.fetchone()
+    if row:
+        record_own_version(user_cache_versions, user_id, row[0])
+
+def changed_versions(known_versions: dict, versions: dict):
+    """Пользователи, чья версия изменилась с прошлой синхронизации; известные версии обновляются"""
+    changed = {user_id for user_id, version in versions.items()
+               if user_id in known_versions and known_versions[user_id] != version}
+    known_versions.clear()
+    known_versions.update(versions)
+    return changed
+
+def sync_user_caches():
+    """Сброс кэшей пользователей, чьи настройки или уведомления изменились на других репликах:
+    политики хранения перечитываются, фильтры запущенных сессий обновляются на месте,
+    буфер /my_alerts дополняется из БД при следующем запросе"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, cache_version, alerts_version FROM users")
+    rows = cursor.fetchall()
+    conn.close()
+    changed = changed_versions(user_cache_versions, {user_id: version for user_id, version, _ in rows})
+    alerts_changed = changed_versions(user_alert_versions, {user_id: version for user_id, _, version in rows})
+    recent_alerts_stale.update(user_id for user_id in alerts_changed if user_id in recent_alerts)
+    if not changed:
+        return
+    for key in [key for key in storage_policies if key[0] in changed]:
+        del storage_policies[key]
+    for user_id, session_id in [key for key in session_chat_filters if key[0] in changed]:
+        load_chat_filter(user_id, session_id)
+
+def load_chat_filter(user_id: int, session_id: int):
+    """Загрузка фильтра чатов сессии из БД в реестр запущенных сессий"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT chat_include, chat_exclude, chat_types FROM user_sessions WHERE id = ? AND user_id = ?",
+            (session_id, user_id)
+        )
+        row = cursor.fetchone()
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки фильтра чатов для {user_id}: {e}")
+        row = None
+    
+    include, exclude, chat_types = row or (None, None, None)
+    chat_filter = session_chat_filters.setdefault((user_id, session_id), {})
+    # Обновляем словарь на месте: обработчик запущенного клиента читает его при каждом событии
+    chat_filter['include'] = parse_chat_ids(include)
+    chat_filter['exclude'] = parse_chat_ids(exclude)
+    chat_filter['types'] = set(chat_types.split(',')) if chat_types else None
+    return chat_filter
+
+def set_chat_filter(user_id: int, session_id: int, field: str, value):
+    """Изменение фильтра чатов сессии; запущенный клиент подхватывает его без перезапуска"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(f"UPDATE user_sessions SET {field} = ? WHERE id = ? AND user_id = ?",
+                       (value, session_id, user_id))
+        updated = cursor.rowcount > 0
+        bump_cache_version(cursor, user_id)
+        conn.commit()
+        conn.close()
+        if updated and (user_id, session_id) in session_chat_filters:
+            # Реестр хранит только запущенные сессии; остальные прочитают фильтр из БД при запуске
+            load_chat_filter(user_id, session_id)
+        if updated:
+            logger.info(f"🧭 Пользователь {user_id} изменил фильтр чатов сессии {session_id}: {field}")
+        return updated
+    except Exception as e:
+        logger.error(f"❌ Ошибка изменения фильтра чатов для {user_id}: {e}")
+        return False
+
+def is_session_running(user_id: int, session_id: int):
+    """Запущена ли сессия на этой реплике"""
+    return (user_id, session_id) in session_accounts
+
+def count_user_sessions(user_id: int):
+    """Число запущенных на этой реплике сессий пользователя"""
+    return sum(1 for uid, _ in session_accounts if uid == user_id)
+
+def chat_filter_accepts(chat_filter: dict, event):
+    """Проверка события по фильтру чатов без сетевых запросов (только peer и кэш сущностей)"""
+    if not event.raw_text:
+        return False
+    
+    chat_id = event.chat_id
+    # Пользователи видят в выгрузках id без префикса -100, поэтому сравниваем обе формы
+    chat_ids = {chat_id, utils.resolve_id(chat_id)[0]}
+    if chat_filter['include'] and not chat_ids & chat_filter['include']:
+        return False
+    if chat_ids & chat_filter['exclude']:
+        return False
+    
+    chat_types = chat_filter['types']
+    if chat_types is None:
+        return True
+    if event.is_private:
+        return 'private' in chat_types
+    if event.is_group is None:
+        # Тип канала неизвестен без запроса сущности - пропускаем, если разрешен хотя бы один из вариантов
+        return 'channel' in chat_types or 'group' in chat_types
+    return ('group' if event.is_group else 'channel') in chat_types
+
 def delete_user_keyword(user_id: int, keyword_id: int):
     """Удаление ключевого слова"""
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("DELETE FROM user_keywords WHERE id = ? AND user_id = ?", (keyword_id, user_id))
+        bump_rules_version(cursor, user_id)
         conn.commit()
         conn.close()
         logger.info(f"🗑️ Пользователь {user_id} удалил ключевое слово ID: {keyword_id}")
@@ -371,6 +1150,7 @@ def delete_user_exception(user_id: int, exception_id: int):
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("DELETE FROM user_exceptions WHERE id = ? AND user_id = ?", (exception_id, user_id))
+        bump_rules_version(cursor, user_id)
         conn.commit()
         conn.close()
         logger.info(f"🗑️ Пользователь {user_id} удалил исключение ID: {exception_id}")
@@ -385,6 +1165,7 @@ def clear_all_keywords(user_id: int):
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("DELETE FROM user_keywords WHERE user_id = ?", (user_id,))
+        bump_rules_version(cursor, user_id)
         conn.commit()
         conn.close()
         logger.info(f"🧹 Пользователь {user_id} очистил все ключевые слова")
@@ -399,6 +1180,7 @@ def clear_all_exceptions(user_id: int):
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("DELETE FROM user_exceptions WHERE user_id = ?", (user_id,))
+        bump_rules_version(cursor, user_id)
         conn.commit()
         conn.close()
         logger.info(f"🧹 Пользователь {user_id} очистил все исключения")
@@ -407,97 +1189,1504 @@ def clear_all_exceptions(user_id: int):
         logger.error(f"❌ Ошибка очистки исключений: {e}")
         return False
 
+def encode_message_text(text: str):
+    """Сжатие длинного текста сообщения: (значение для БД, кодек)"""
+    if MESSAGE_COMPRESSION and len(text) >= COMPRESS_MIN_LENGTH:
+        compressed = zlib.compress(text.encode('utf-8'), 6)
+        if len(compressed) < len(text.encode('utf-8')):
+            return compressed, TEXT_CODEC_ZLIB
+    return text, TEXT_CODEC_PLAIN
+
+def decode_message_text(value, codec):
+    """Распаковка текста сообщения, прочитанного из БД"""
+    if codec == TEXT_CODEC_ZLIB:
+        return zlib.decompress(value).decode('utf-8')
+    return value
+
+def intern_chat(cursor, chat_id: str, chat_name: str, message_type: str, shard_key: str = ''):
+    """id чата в таблице-измерении chats шарда (с кэшем на пути записи)"""
+    cached = chat_refs.get((shard_key, chat_id))
+    if cached is not None:
+        chat_ref, cached_name, cached_type = cached
+        if cached_name == chat_name and cached_type == message_type:
+            return chat_ref
+        cursor.execute("UPDATE chats SET chat_name = ?, message_type = ? WHERE id = ?",
+                       (chat_name, message_type, chat_ref))
+    else:
+        cursor.execute("INSERT OR IGNORE INTO chats (chat_id, chat_name, message_type) VALUES (?, ?, ?)",
+                       (chat_id, chat_name, message_type))
+        cursor.execute("SELECT id, chat_name, message_type FROM chats WHERE chat_id = ?", (chat_id,))
+        chat_ref, stored_name, stored_type = cursor.fetchone()
+        if stored_name != chat_name or stored_type != message_type:
+            cursor.execute("UPDATE chats SET chat_name = ?, message_type = ? WHERE id = ?",
+                           (chat_name, message_type, chat_ref))
+        if len(chat_refs) >= INTERN_CACHE_SIZE:
+            chat_refs.clear()
+    chat_refs[(shard_key, chat_id)] = (chat_ref, chat_name, message_type)
+    return chat_ref
+
+def intern_sender(cursor, username: str, shard_key: str = ''):
+    """id отправителя в таблице-измерении senders шарда (с кэшем на пути записи)"""
+    if not username:
+        return None
+    sender_ref = sender_refs.get((shard_key, username))
+    if sender_ref is None:
+        cursor.execute("INSERT OR IGNORE INTO senders (username) VALUES (?)", (username,))
+        cursor.execute("SELECT id FROM senders WHERE username = ?", (username,))
+        sender_ref = cursor.fetchone()[0]
+        if len(sender_refs) >= INTERN_CACHE_SIZE:
+            sender_refs.clear()
+        sender_refs[(shard_key, username)] = sender_ref
+    return sender_ref
+
+# Архив сообщений: append-only сегменты
+ARCHIVE_RECORD_HEADER = struct.Struct('<I')
+ARCHIVE_INDEX_ENTRY = struct.Struct('<dQ')
+
+class ArchiveReader:
+    """Чтение сегментного архива: сегменты с записями [длина][JSON] и разреженный индекс время -> смещение"""
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+    
+    def segment_path(self, number: int, extension: str = 'seg'):
+        return os.path.join(self.directory, f"{number:08d}.{extension}")
+    
+    def list_segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.seg'))
+    
+    def read_index(self, number: int):
+        """Разреженный индекс сегмента: [(timestamp, offset)]"""
+        try:
+            with open(self.segment_path(number, 'idx'), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        usable = len(data) - len(data) % ARCHIVE_INDEX_ENTRY.size
+        return list(ARCHIVE_INDEX_ENTRY.iter_unpack(data[:usable]))
+    
+    def iter_records(self, since: float = None, until: float = None, segments=None, limits=None):
+        """Чтение записей за период через mmap; начало ищется по разреженному индексу.
+        limits: {сегмент: размер} - читать не дальше снимка размера (хвост дописывается параллельно)"""
+        segments = self.list_segments() if segments is None else segments
+        limits = limits or {}
+        first_timestamps = {}
+        for number in segments:
+            index = self.read_index(number)
+            first_timestamps[number] = index[0][0] if index else None
+        
+        for position, number in enumerate(segments):
+            next_first = first_timestamps.get(segments[position + 1]) if position + 1 < len(segments) else None
+            if since is not None and next_first is not None and next_first <= since:
+                continue
+            if until is not None and first_timestamps[number] is not None and first_timestamps[number] >= until:
+                return
+            
+            index = self.read_index(number)
+            start = 0
+            if since is not None and index:
+                position_in_index = bisect.bisect_left([entry[0] for entry in index], since)
+                start = index[max(position_in_index - 1, 0)][1]
+            
+            with open(self.segment_path(number), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    size = min(len(mapped), limits.get(number, len(mapped)))
+                    offset = start
+                    while offset + ARCHIVE_RECORD_HEADER.size <= size:
+                        (length,) = ARCHIVE_RECORD_HEADER.unpack_from(mapped, offset)
+                        end = offset + ARCHIVE_RECORD_HEADER.size + length
+                        if end > size:
+                            break
+                        record = json.loads(mapped[offset + ARCHIVE_RECORD_HEADER.size:end])
+                        offset = end
+                        if since is not None and record['ts'] < since:
+                            continue
+                        if until is not None and record['ts'] >= until:
+                            return
+                        yield record
+
+class MessageArchive(ArchiveReader):
+    """Append-only архив одной реплики: пишет только владелец каталога (эксклюзивная блокировка файла)"""
+    
+    def __init__(self, directory: str, segment_size: int, index_interval: int):
+        super().__init__(directory)
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        os.makedirs(directory, exist_ok=True)
+        # Два процесса с одним REPLICA_ID не должны дописывать одни и те же сегменты
+        self.lock_file = open(os.path.join(directory, 'LOCK'), 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            raise RuntimeError(f"архив {directory} уже открыт другим процессом")
+        # Дозапись и ротация идут в event loop, чтение выгрузки - в потоке
+        self.lock = threading.Lock()
+        segments = self.list_segments()
+        self.segment_number = segments[-1] if segments else 1
+        self.open_segment(recover=bool(segments))
+    
+    def open_segment(self, recover: bool = False):
+        """Открытие текущего сегмента на дозапись"""
+        self.size = self.recover_segment() if recover else 0
+        index = [entry for entry in self.read_index(self.segment_number) if entry[1] < max(self.size, 1)]
+        if recover:
+            # Переписываем индекс без записей, указывающих за обрезанный хвост
+            with open(self.segment_path(self.segment_number, 'idx'), 'wb') as f:
+                f.write(b''.join(ARCHIVE_INDEX_ENTRY.pack(*entry) for entry in index))
+        self.last_indexed_offset = index[-1][1] if index else None
+        self.data_file = open(self.segment_path(self.segment_number), 'ab')
+        self.index_file = open(self.segment_path(self.segment_number, 'idx'), 'ab')
+    
+    def recover_segment(self):
+        """Проверка хвоста последнего сегмента после рестарта: недописанная запись отрезается"""
+        path = self.segment_path(self.segment_number)
+        index = self.read_index(self.segment_number)
+        with open(path, 'r+b') as f:
+            file_size = f.seek(0, os.SEEK_END)
+            offset = index[-1][1] if index and index[-1][1] <= file_size else 0
+            f.seek(offset)
+            while offset + ARCHIVE_RECORD_HEADER.size <= file_size:
+                (length,) = ARCHIVE_RECORD_HEADER.unpack(f.read(ARCHIVE_RECORD_HEADER.size))
+                if offset + ARCHIVE_RECORD_HEADER.size + length > file_size:
+                    break
+                f.seek(length, os.SEEK_CUR)
+                offset += ARCHIVE_RECORD_HEADER.size + length
+            if offset < file_size:
+                f.truncate(offset)
+                logger.warning(f"⚠️ Архив: обрезан недописанный хвост сегмента {path} ({file_size - offset} байт)")
+        return offset
+    
+    def rotate(self):
+        """Переход на новый сегмент (вызывается под self.lock)"""
+        self.data_file.close()
+        self.index_file.close()
+        self.segment_number += 1
+        self.open_segment()
+        logger.info(f"🗃️ Архив: новый сегмент {self.segment_number:08d}")
+    
+    def append(self, record: dict):
+        """Последовательная дозапись одной записи"""
+        payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        record_size = ARCHIVE_RECORD_HEADER.size + len(payload)
+        with self.lock:
+            if self.size and self.size + record_size > self.segment_size:
+                self.rotate()
+            if self.last_indexed_offset is None or self.size - self.last_indexed_offset >= self.index_interval:
+                self.index_file.write(ARCHIVE_INDEX_ENTRY.pack(record['ts'], self.size))
+                self.last_indexed_offset = self.size
+            self.data_file.write(ARCHIVE_RECORD_HEADER.pack(len(payload)))
+            self.data_file.write(payload)
+            self.size += record_size
+    
+    def flush(self):
+        with self.lock:
+            self.data_file.flush()
+            self.index_file.flush()
+    
+    def iter_records(self, since: float = None, until: float = None, segments=None, limits=None):
+        """Чтение по снимку: список сегментов и размер текущего фиксируются под блокировкой,
+        после этого ротация в event loop не мешает чтению"""
+        with self.lock:
+            self.data_file.flush()
+            self.index_file.flush()
+            segments = self.list_segments()
+            limits = {self.segment_number: self.size}
+        return super().iter_records(since, until, segments, limits)
+
+def archive_directory(replica_id: str):
+    """Каталог архива реплики: у каждой реплики свои сегменты и индекс"""
+    return os.path.join(ARCHIVE_DIR, re.sub(r'[^\w.-]', '_', replica_id))
+
+def iter_archive_records(since: float = None, until: float = None):
+    """Записи архивов всех реплик за период, слитые по времени"""
+    own_directory = os.path.abspath(message_archive.directory)
+    sources = [message_archive.iter_records(since, until)]
+    # Сегменты прямо в ARCHIVE_DIR - архив, записанный до разделения по репликам
+    sources.append(ArchiveReader(ARCHIVE_DIR).iter_records(since, until))
+    for name in sorted(os.listdir(ARCHIVE_DIR)):
+        directory = os.path.join(ARCHIVE_DIR, name)
+        if os.path.isdir(directory) and os.path.abspath(directory) != own_directory:
+            sources.append(ArchiveReader(directory).iter_records(since, until))
+    return heapq.merge(*sources, key=lambda record: record['ts'])
+
+def init_message_archive():
+    """Открытие архива сообщений, если включен бэкенд segments"""
+    global message_archive
+    if ARCHIVE_BACKEND != 'segments':
+        return
+    try:
+        directory = archive_directory(REPLICA_ID)
+        message_archive = MessageArchive(directory, ARCHIVE_SEGMENT_SIZE, ARCHIVE_INDEX_INTERVAL)
+        logger.info(f"🗃️ Архив сообщений: {directory} (сегмент {message_archive.segment_number:08d})")
+    except Exception as e:
+        logger.error(f"❌ Ошибка открытия архива сообщений: {e}")
+
+def archive_user_message(user_id: int, message_data: dict, clean_text: str):
+    """Дозапись сообщения в сегментный архив"""
+    message_archive.append({
+        'ts': time.time(),
+        'user_id': user_id,
+        'session_id': message_data.get('session_id', 0),
+        'chat_id': message_data['chat_id'],
+        'chat_name': message_data['chat_name'],
+        'username': message_data['username'],
+        'message_type': message_data['message_type'],
+        'has_keywords': bool(message_data['has_keywords']),
+        'keywords_found': message_data['keywords_found'],
+        'message_text': clean_text,
+    })
+
 def save_user_message(user_id: int, message_data: dict):
-    """Сохранение сообщения пользователя"""
+    """Сохранение сообщения пользователя (текст уже нормализован в process_message_for_user)"""
+    conn = None
     try:
-        clean_text = re.sub(r'\*{2,}', '', message_data['message_text'])
+        clean_text = message_data['message_text']
         
-        conn = get_db_connection()
+        if message_archive is not None:
+            archive_user_message(user_id, message_data, clean_text)
+            if not message_data['has_keywords']:
+                # В SQLite при архиве остаются только уведомления, остальное учитываем в счетчиках
+                count_skipped_message(user_id, message_data.get('session_id', 0), False)
+                return None
+        
+        stored_text, text_codec = encode_message_text(clean_text)
+        
+        # Соединение шарда пользователя из кэша: запись одного пользователя не ждет блокировку чужого файла
+        shard_key = message_shard_key(user_id)
+        conn = shard_handles.get(shard_key)
         cursor = conn.cursor()
+        chat_ref = intern_chat(cursor, message_data['chat_id'], message_data['chat_name'],
+                               message_data['message_type'], shard_key)
+        sender_ref = intern_sender(cursor, message_data['username'], shard_key)
         cursor.execute('''
             INSERT INTO user_messages 
-            (user_id, session_id, chat_id, chat_name, username, message_text, has_keywords, keywords_found, message_type)
+            (user_id, session_id, chat_ref, sender_ref, message_text, text_codec, has_keywords, keywords_found, timestamp)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             user_id,
             message_data.get('session_id', 0),
-            message_data['chat_id'],
-            message_data['chat_name'],
-            message_data['username'],
-            clean_text,
+            chat_ref,
+            sender_ref,
+            stored_text,
+            text_codec,
             message_data['has_keywords'],
             message_data['keywords_found'],
-            message_data['message_type']
+            message_data.get('timestamp') or datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
         ))
+        message_id = cursor.lastrowid
         conn.commit()
-        conn.close()
-        logger.info(f"💬 Сообщение сохранено для {user_id}")
+        hot_logger.debug("💬 Сообщение сохранено для %s", user_id, extra={'user_id': user_id, 'message_id': message_id})
+        return message_id
     except Exception as e:
-        logger.error(f"❌ Ошибка сохранения сообщения для {user_id}: {e}")
+        # Транзакция не зафиксирована - вставленные в ней измерения могли не сохраниться
+        if conn is not None:
+            conn.rollback()
+        chat_refs.clear()
+        sender_refs.clear()
+        hot_logger.error("❌ Ошибка сохранения сообщения для %s: %s", user_id, e)
+        return None
 
-async def check_keywords_for_user(user_id: int, text: str):
-    """Проверка ключевых слов и исключений"""
-    if not text:
-        return False, []
-    
-    clean_text = re.sub(r'\*{2,}', '', text)
-    keywords_data = get_user_keywords(user_id)
-    exceptions_data = get_user_exceptions(user_id)
-    
-    keywords = {row[1].lower() for row in keywords_data}
-    exceptions = {row[1].lower() for row in exceptions_data}
-    
-    text_lower = clean_text.lower()
-    
-    # Проверяем исключения
-    has_exceptions = any(exc in text_lower for exc in exceptions)
-    if has_exceptions:
-        return False, []
-    
-    # Проверяем ключевые слова
-    found_keywords = [kw for kw in keywords if kw in text_lower]
-    return len(found_keywords) > 0, found_keywords
+def get_storage_policy(user_id: int, session_id: int):
+    """Политика хранения для сессии: своя политика сессии или политика пользователя"""
+    key = (user_id, session_id)
+    policy = storage_policies.get(key)
+    if policy is not None:
+        return policy
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COALESCE(
+                (SELECT storage_policy FROM user_sessions WHERE id = ? AND user_id = ?),
+                (SELECT storage_policy FROM users WHERE user_id = ?),
+                'all'
+            )
+        ''', (session_id, user_id, user_id))
+        policy = cursor.fetchone()[0]
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения политики хранения для {user_id}: {e}")
+        policy = 'all'
+    storage_policies[key] = policy
+    return policy
 
-async def test_session(session_string: str):
-    """Тестирование сессии перед запуском"""
+def set_storage_policy(user_id: int, policy: str, session_id: int = None):
+    """Установка политики хранения для пользователя или отдельной сессии"""
     try:
-        client = TelegramClient(
-            StringSession(session_string),
-            api_id=2040,
-            api_hash='b18441a1ff607e10a989891a5462e627'
-        )
-        
-        await client.start()
-        me = await client.get_me()
-        await client.disconnect()
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if session_id is None:
+            cursor.execute("UPDATE users SET storage_policy = ? WHERE user_id = ?", (policy, user_id))
+        else:
+            cursor.execute("UPDATE user_sessions SET storage_policy = ? WHERE id = ? AND user_id = ?",
+                           (policy, session_id, user_id))
+        updated = cursor.rowcount > 0
+        bump_cache_version(cursor, user_id)
+        conn.commit()
+        conn.close()
         
-        return True, f"✅ Сессия валидна: @{me.username}"
+        # Сбрасываем кэш всех сессий пользователя: политика сессии может наследоваться
+        for key in [key for key in storage_policies if key[0] == user_id]:
+            del storage_policies[key]
+        logger.info(f"🗄️ Пользователь {user_id} установил политику хранения {policy} (сессия: {session_id})")
+        return updated
     except Exception as e:
-        error_msg = str(e)
-        if "EOF when reading a line" in error_msg:
-            return False, "❌ Сессия невалидна или устарела. Получите новую сессию"
-        else:
-            return False, f"❌ Ошибка сессии: {error_msg}"
+        logger.error(f"❌ Ошибка установки политики хранения для {user_id}: {e}")
+        return False
 
-async def process_message_for_user(user_id: int, session_id: int, session_name: str, event):
-    """Обработка сообщения для пользователя (вынесено в отдельную функцию)"""
+def should_store_message(policy: str, has_keywords: bool):
+    """Нужно ли записывать сообщение в user_messages при данной политике"""
+    if policy == 'all':
+        return True
+    if policy == 'matches':
+        return has_keywords
+    if policy == 'sample':
+        return has_keywords or random.random() < STORAGE_SAMPLE_RATE
+    return False
+
+def count_skipped_message(user_id: int, session_id: int, has_keywords: bool):
+    """Учет несохраненного сообщения в агрегированных счетчиках (без обращения к БД)"""
+    counters = pending_message_counters.get((user_id, session_id))
+    if counters is None:
+        counters = pending_message_counters[(user_id, session_id)] = [0, 0]
+    counters[0] += 1
+    if has_keywords:
+        counters[1] += 1
+
+def flush_message_counters():
+    """Сброс накопленных счетчиков в БД одной транзакцией"""
+    if not pending_message_counters:
+        return
+    rows = [(user_id, session_id, messages, alerts)
+            for (user_id, session_id), (messages, alerts) in pending_message_counters.items()]
+    pending_message_counters.clear()
     try:
-        if not event.message.text:
-            return
-        
-        # Получаем информацию о чате
-        chat = await event.get_chat()
-        chat_id = str(chat.id)
+        conn = get_db_connection()
+        conn.executemany('''
+            INSERT INTO user_message_counters (user_id, session_id, skipped_messages, skipped_alerts)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, session_id) DO UPDATE SET
+                skipped_messages = skipped_messages + excluded.skipped_messages,
+                skipped_alerts = skipped_alerts + excluded.skipped_alerts
+        ''', rows)
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения счетчиков сообщений: {e}")
+        # Несохраненные счетчики возвращаются в буфер и уйдут в БД следующим сбросом
+        for user_id, session_id, messages, alerts in rows:
+            counters = pending_message_counters.setdefault((user_id, session_id), [0, 0])
+            counters[0] += messages
+            counters[1] += alerts
+
+def count_message_rollup(user_id: int, chat_id: str, chat_name: str, found_keywords):
+    """Учет сообщения в почасовых агрегатах по чату и ключевым словам (без обращения к БД)"""
+    hour = int(time.time() // 3600)
+    counters = pending_chat_rollups.get((user_id, hour, chat_id))
+    if counters is None:
+        counters = pending_chat_rollups[(user_id, hour, chat_id)] = [0, 0, chat_name]
+    counters[0] += 1
+    counters[2] = chat_name
+    if found_keywords:
+        counters[1] += 1
+        for keyword in found_keywords:
+            key = (user_id, hour, keyword)
+            pending_keyword_rollups[key] = pending_keyword_rollups.get(key, 0) + 1
+
+def flush_rollups():
+    """Сброс почасовых агрегатов в БД одной транзакцией"""
+    if not pending_chat_rollups and not pending_keyword_rollups:
+        return
+    chat_rows = [(user_id, hour, chat_id, chat_name, messages, alerts)
+                 for (user_id, hour, chat_id), (messages, alerts, chat_name) in pending_chat_rollups.items()]
+    keyword_rows = [(user_id, hour, keyword, alerts)
+                    for (user_id, hour, keyword), alerts in pending_keyword_rollups.items()]
+    pending_chat_rollups.clear()
+    pending_keyword_rollups.clear()
+    try:
+        conn = get_db_connection()
+        conn.executemany('''
+            INSERT INTO chat_hourly_stats (user_id, hour, chat_id, chat_name, messages, alerts)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, hour, chat_id) DO UPDATE SET
+                chat_name = excluded.chat_name,
+                messages = messages + excluded.messages,
+                alerts = alerts + excluded.alerts
+        ''', chat_rows)
+        conn.executemany('''
+            INSERT INTO keyword_hourly_stats (user_id, hour, keyword, alerts)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, hour, keyword) DO UPDATE SET alerts = alerts + excluded.alerts
+        ''', keyword_rows)
+        # Новые уведомления: другие реплики дополнят свои буферы /my_alerts из БД
+        alert_versions = []
+        for user_id in {row[0] for row in chat_rows if row[5]}:
+            alert_versions += conn.execute(
+                "UPDATE users SET alerts_version = alerts_version + 1 WHERE user_id = ? RETURNING user_id, alerts_version",
+                (user_id,)
+            ).fetchall()
+        conn.commit()
+        conn.close()
+        # Свой буфер уже содержит эти уведомления
+        for user_id, version in alert_versions:
+            record_own_version(user_alert_versions, user_id, version)
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения почасовых агрегатов: {e}")
+        # Несохраненные агрегаты возвращаются в буфер и уйдут в БД следующим сбросом
+        for user_id, hour, chat_id, chat_name, messages, alerts in chat_rows:
+            counters = pending_chat_rollups.setdefault((user_id, hour, chat_id), [0, 0, chat_name])
+            counters[0] += messages
+            counters[1] += alerts
+        for user_id, hour, keyword, alerts in keyword_rows:
+            key = (user_id, hour, keyword)
+            pending_keyword_rollups[key] = pending_keyword_rollups.get(key, 0) + alerts
+
+def parse_stats_period(args):
+    """Период для /top_chats и /top_keywords: 24h, 7d, all или две даты YYYY-MM-DD -> (с часа, до часа)"""
+    now_hour = int(time.time() // 3600) + 1
+    if not args:
+        return now_hour - 7 * 24, now_hour
+    if len(args) == 2:
+        start, end = (parse_export_datetime(value) for value in args)
+        return int(start.timestamp() // 3600), int(end.timestamp() // 3600) + 24
+    value = args[0].lower()
+    if value == 'all':
+        return 0, now_hour
+    match = re.fullmatch(r'(\d+)([hd])', value)
+    if not match:
+        raise ValueError(value)
+    hours = int(match.group(1)) * (24 if match.group(2) == 'd' else 1)
+    return now_hour - hours, now_hour
+
+def get_top_chats(user_id: int, start_hour: int, end_hour: int, limit: int = 10):
+    """Чаты с наибольшим числом уведомлений за период из почасовых агрегатов"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # Название чата - любое из встречавшихся за период (переименования редки)
+    cursor.execute('''
+        SELECT chat_id, MAX(chat_name), SUM(messages), SUM(alerts)
+        FROM chat_hourly_stats
+        WHERE user_id = ? AND hour >= ? AND hour < ?
+        GROUP BY chat_id
+        ORDER BY SUM(alerts) DESC, SUM(messages) DESC
+        LIMIT ?
+    ''', (user_id, start_hour, end_hour, limit))
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+def get_top_keywords(user_id: int, start_hour: int, end_hour: int, limit: int = 10):
+    """Ключевые слова с наибольшим числом уведомлений за период из почасовых агрегатов"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT keyword, SUM(alerts)
+        FROM keyword_hourly_stats
+        WHERE user_id = ? AND hour >= ? AND hour < ?
+        GROUP BY keyword
+        ORDER BY SUM(alerts) DESC
+        LIMIT ?
+    ''', (user_id, start_hour, end_hour, limit))
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+async def flush_message_counters_loop():
+    """Периодический сброс счетчиков несохраненных сообщений, почасовых агрегатов и буферов архива"""
+    while True:
+        await asyncio.sleep(COUNTERS_FLUSH_INTERVAL)
+        flush_message_counters()
+        flush_rollups()
+        if message_archive is not None:
+            message_archive.flush()
+
+def get_skipped_counts(user_id: int, cursor):
+    """Число несохраненных сообщений пользователя (БД + еще не сброшенные)"""
+    cursor.execute(
+        "SELECT COALESCE(SUM(skipped_messages), 0), COALESCE(SUM(skipped_alerts), 0) FROM user_message_counters WHERE user_id = ?",
+        (user_id,)
+    )
+    skipped_messages, skipped_alerts = cursor.fetchone()
+    # Копия: функцию вызывает и поток HTTP API, пока цикл событий пополняет счетчики
+    for (counter_user_id, _), (messages, alerts) in list(pending_message_counters.items()):
+        if counter_user_id == user_id:
+            skipped_messages += messages
+            skipped_alerts += alerts
+    return skipped_messages, skipped_alerts
+
+def remember_alert(user_id: int, alert: tuple):
+    """Добавление уведомления в кольцевой буфер пользователя (с порядковым номером записи)"""
+    buffer = recent_alerts.get(user_id)
+    if buffer is None:
+        buffer = recent_alerts[user_id] = deque(maxlen=RECENT_ALERTS_SIZE)
+    buffer.append(alert + (next(alert_sequence),))
+
+def query_alerts(user_id: int, condition: str, order: str, params: tuple, limit: int):
+    """Уведомления из БД keyset-запросом по (timestamp, id); у строк БД нет номера в буфере (seq = 0)"""
+    conn = connect_message_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT timestamp, id, chat_name, username, keywords_found, message_text, text_codec
+        FROM user_messages_view
+        WHERE user_id = ? AND has_keywords = 1 {condition}
+        ORDER BY timestamp {order}, id {order}
+        LIMIT ?
+    ''', (user_id, *params, limit))
+    rows = [(ts, row_id, chat_name, username, keywords, (decode_message_text(text, codec) or '')[:200], 0)
+            for ts, row_id, chat_name, username, keywords, text, codec in cursor.fetchall()]
+    conn.close()
+    return rows
+
+def seed_recent_alerts(user_id: int):
+    """Прогрев буфера историей из БД с сохранением уведомлений, пришедших после запуска"""
+    rows = query_alerts(user_id, "", "DESC", (), RECENT_ALERTS_SIZE)
+    known_ids = {row[1] for row in rows}
+    pending = [alert for alert in recent_alerts.get(user_id, ()) if alert[1] is None or alert[1] not in known_ids]
+    # Несохраненное уведомление пришло позже сохраненных в ту же секунду
+    merged = sorted(rows + pending, key=lambda alert: (alert[0], alert[1] is None, alert[1] or 0))
+    # Номера выдаются заново по порядку буфера: курсоры старых страниц уйдут в keyset-запрос к БД
+    buffer = recent_alerts[user_id] = deque(
+        (alert[:6] + (next(alert_sequence),) for alert in merged), maxlen=RECENT_ALERTS_SIZE
+    )
+    recent_alerts_seeded.add(user_id)
+    recent_alerts_stale.discard(user_id)
+    return buffer
+
+def get_alerts_page(user_id: int, direction: str = 'older', cursor_key: tuple = None):
+    """Страница уведомлений (новые сверху) и признак наличия следующей страницы.
+
+    cursor_key - (timestamp, id, seq) крайнего уведомления текущей страницы. Внутри кольцевого буфера
+    страницы листаются по seq: у уведомлений, не сохраненных в БД, нет id. За буфером - keyset-запрос
+    по (timestamp, id) с LIMIT, так что стоимость страницы не зависит от её номера.
+    """
+    buffer = recent_alerts.get(user_id)
+    if cursor_key is None:
+        if buffer is None or user_id in recent_alerts_stale or (
+            len(buffer) < ALERTS_PAGE_SIZE and user_id not in recent_alerts_seeded
+        ):
+            buffer = seed_recent_alerts(user_id)
+        entries = list(buffer)
+        position = len(entries)
+    else:
+        entries = list(buffer or ())
+        timestamp, alert_id, seq = cursor_key
+        position = next((i for i, alert in enumerate(entries) if seq and alert[6] == seq), None)
+        if position is None:
+            # Страница ушла из буфера - дальше только сохраненные в БД уведомления
+            if direction == 'older':
+                rows = query_alerts(user_id, "AND (timestamp, id) < (?, ?)", "DESC", (timestamp, alert_id),
+                                    ALERTS_PAGE_SIZE + 1)
+            else:
+                rows = query_alerts(user_id, "AND (timestamp, id) > (?, ?)", "ASC", (timestamp, alert_id),
+                                    ALERTS_PAGE_SIZE + 1)
+            has_more = len(rows) > ALERTS_PAGE_SIZE
+            rows = rows[:ALERTS_PAGE_SIZE]
+            if direction != 'older':
+                rows.reverse()
+            return rows, has_more
+
+    if direction != 'older':
+        page = entries[position + 1:position + 1 + ALERTS_PAGE_SIZE]
+        page.reverse()
+        return page, position + 1 + ALERTS_PAGE_SIZE < len(entries)
+
+    page = entries[max(position - ALERTS_PAGE_SIZE, 0):position]
+    page.reverse()
+    if position > ALERTS_PAGE_SIZE or not entries:
+        return page, position > ALERTS_PAGE_SIZE
+    # Начало буфера: страницу дополняют и наличие следующей проверяют уведомления из БД старше буфера
+    anchor = next((alert for alert in entries if alert[1] is not None), None)
+    if anchor is not None:
+        condition, params = "AND (timestamp, id) < (?, ?)", anchor[:2]
+    else:
+        condition, params = "AND timestamp < ?", entries[0][:1]
+    needed = ALERTS_PAGE_SIZE - len(page)
+    rows = query_alerts(user_id, condition, "DESC", params, needed + 1)
+    return page + rows[:needed], len(rows) > needed
+
+# Нормализация текста: выполняется один раз на сообщение
+MARKUP_RE = re.compile(r'\*{2,}|_{2,}|~{2,}|`{1,3}')
+INLINE_SPACE_RE = re.compile(r'[^\S\n]+')
+BLANK_LINES_RE = re.compile(r'\n\s*\n+')
+SPACE_RE = re.compile(r'\s+')
+MIXED_SCRIPT_RE = re.compile(r'\b(?=\w*[a-z])(?=\w*[а-яё])\w+')
+CYRILLIC_RE = re.compile(r'[а-яё]')
+LATIN_RE = re.compile(r'[a-z]')
+# Похожие по начертанию буквы (после casefold; b, h, m, t похожи в заглавном написании)
+HOMOGLYPHS_LATIN = 'aceopxykbhmt'
+HOMOGLYPHS_CYRILLIC = 'асеорхуквнмт'
+TO_CYRILLIC = str.maketrans(HOMOGLYPHS_LATIN, HOMOGLYPHS_CYRILLIC)
+TO_LATIN = str.maketrans(HOMOGLYPHS_CYRILLIC, HOMOGLYPHS_LATIN)
+
+NormalizedText = namedtuple('NormalizedText', ['display', 'match', 'digest'])
+
+def unify_script(match):
+    """Слово из смеси кириллицы и латиницы приводится к преобладающему алфавиту"""
+    word = match.group(0)
+    if len(CYRILLIC_RE.findall(word)) >= len(LATIN_RE.findall(word)):
+        return word.translate(TO_CYRILLIC)
+    return word.translate(TO_LATIN)
+
+def normalize_match_text(text: str):
+    """Текст для сопоставления: NFKC и casefold, единый алфавит в словах, один пробел между словами.
+
+    Через эту функцию проходят и сообщения, и ключевые слова: «ＵＳＤＴ» в слове совпадет с «usdt» в тексте.
+    """
+    text = unicodedata.normalize('NFKC', text).casefold()
+    if LATIN_RE.search(text) and CYRILLIC_RE.search(text):
+        text = MIXED_SCRIPT_RE.sub(unify_script, text)
+    return SPACE_RE.sub(' ', text).strip()
+
+def normalize_text(text: str):
+    """NFKC и удаление разметки для хранения и уведомлений, плюс текст для сопоставления"""
+    display = MARKUP_RE.sub('', unicodedata.normalize('NFKC', text))
+    display = BLANK_LINES_RE.sub('\n\n', INLINE_SPACE_RE.sub(' ', display)).strip()
+    match_text = normalize_match_text(display)
+    # Хэш текста для сопоставления - ключ кэша результатов поиска
+    digest = hashlib.blake2b(match_text.encode(), digest_size=16).digest()
+    return NormalizedText(display, match_text, digest)
+
+def get_normalized_text(message):
+    """Нормализованный текст сообщения Telethon, кэшируется на самом объекте сообщения"""
+    normalized = getattr(message, '_normalized_text', None)
+    if normalized is None:
+        normalized = normalize_text(message.text)
+        message._normalized_text = normalized
+    return normalized
+
+# Правила ключевых слов: булевы выражения и близость слов
+RULE_OPERATORS = {'AND': 'AND', 'И': 'AND', 'OR': 'OR', 'ИЛИ': 'OR', 'NOT': 'NOT', 'НЕ': 'NOT'}
+RULE_TOKEN_RE = re.compile(r'\(|\)|"[^"]*"|[^\s()"]+')
+RULE_NEAR_RE = re.compile(r'(?:NEAR|РЯДОМ)/(\d+)$')
+RULE_FUZZY_RE = re.compile(r'([^~]+)~(\d*)$')
+# Префикс простого слова: "=Ремонт И отделка" ищется как подстрока, а не как правило
+LITERAL_PREFIX = '='
+WORD_RE = re.compile(r'\w+')
+FUZZY_MAX_DISTANCE = 2
+FUZZY_MIN_WORD_LENGTH = 4
+FUZZY_MAX_TOKEN_LENGTH = 32
+
+class RuleSyntaxError(ValueError):
+    """Ошибка разбора правила"""
+
+def plain_text(text: str):
+    """Текст простого слова без префикса LITERAL_PREFIX"""
+    return text[len(LITERAL_PREFIX):] if text.startswith(LITERAL_PREFIX) else text
+
+def is_rule(text: str):
+    """Правило - это выражение с операторами (в верхнем регистре), скобками или фразами в кавычках"""
+    if text.startswith(LITERAL_PREFIX):
+        return False
+    for token in RULE_TOKEN_RE.findall(text):
+        if token in ('(', ')') or token.startswith('"') or token.endswith('*') or RULE_FUZZY_RE.match(token):
+            return True
+        if token in RULE_OPERATORS or RULE_NEAR_RE.match(token):
+            return True
+    return False
+
+def parse_rule(text: str):
+    """Разбор правила в дерево: ('term', слова, префикс, опечатки) / ('and'|'or', a, b) / ('not', a) / ('near', n, a, b)"""
+    tokens = RULE_TOKEN_RE.findall(text)
+    position = 0
+    
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+    
+    def advance():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+    
+    def parse_or():
+        node = parse_and()
+        while RULE_OPERATORS.get(peek()) == 'OR':
+            advance()
+            node = ('or', node, parse_and())
+        return node
+    
+    def parse_and():
+        node = parse_not()
+        while peek() is not None and peek() != ')' and RULE_OPERATORS.get(peek()) != 'OR':
+            # "usdt NOT scam" и "usdt scam" читаются как AND
+            if RULE_OPERATORS.get(peek()) == 'AND':
+                advance()
+            node = ('and', node, parse_not())
+        return node
+    
+    def parse_not():
+        if RULE_OPERATORS.get(peek()) == 'NOT':
+            advance()
+            return ('not', parse_not())
+        return parse_near()
+    
+    def parse_near():
+        node = parse_atom()
+        while peek() is not None and RULE_NEAR_RE.match(peek()):
+            distance = int(RULE_NEAR_RE.match(advance()).group(1))
+            right = parse_atom()
+            if node[0] != 'term' or right[0] != 'term':
+                raise RuleSyntaxError("NEAR применяется только к словам и фразам")
+            node = ('near', distance, node, right)
+        return node
+    
+    def parse_atom():
+        token = peek()
+        if token is None:
+            raise RuleSyntaxError("неожиданный конец правила")
+        if token == '(':
+            advance()
+            node = parse_or()
+            if peek() != ')':
+                raise RuleSyntaxError("не закрыта скобка")
+            advance()
+            return node
+        if token == ')' or token in RULE_OPERATORS or RULE_NEAR_RE.match(token):
+            raise RuleSyntaxError(f"неожиданный оператор {token}")
+        advance()
+        fuzzy = 0
+        if token.startswith('"'):
+            words, prefix = tuple(WORD_RE.findall(normalize_match_text(token[1:-1]))), False
+        elif RULE_FUZZY_RE.match(token):
+            # слово~N: совпадение с точностью до N опечаток
+            word, distance = RULE_FUZZY_RE.match(token).groups()
+            words, prefix, fuzzy = tuple(WORD_RE.findall(normalize_match_text(word))), False, int(distance or 1)
+            if len(words) != 1:
+                raise RuleSyntaxError(f"нечеткий поиск только для одного слова: {token}")
+            if not 1 <= fuzzy <= FUZZY_MAX_DISTANCE:
+                raise RuleSyntaxError(f"допустимо от 1 до {FUZZY_MAX_DISTANCE} опечаток: {token}")
+            if len(words[0]) < FUZZY_MIN_WORD_LENGTH:
+                raise RuleSyntaxError(f"слово слишком короткое для нечеткого поиска: {token}")
+        else:
+            prefix = token.endswith('*')
+            words = tuple(WORD_RE.findall(normalize_match_text(token.rstrip('*'))))
+            prefix = prefix and len(words) == 1
+        if not words:
+            raise RuleSyntaxError(f"пустой термин {token}")
+        return ('term', words, prefix, fuzzy)
+    
+    node = parse_or()
+    if peek() is not None:
+        raise RuleSyntaxError(f"лишний токен {peek()}")
+    if not requires_term(node):
+        # Иначе правило срабатывает почти на любом сообщении
+        raise RuleSyntaxError("нужно хотя бы одно обязательное слово: НЕ/NOT только исключает")
+    return node
+
+def requires_term(node):
+    """Может ли правило сработать только при наличии хотя бы одного своего слова"""
+    kind = node[0]
+    if kind in ('term', 'near'):
+        return True
+    if kind == 'not':
+        return False
+    if kind == 'and':
+        return requires_term(node[1]) or requires_term(node[2])
+    return requires_term(node[1]) and requires_term(node[2])
+
+def within_distance(left, right, distance: int):
+    """Есть ли пара позиций из двух отсортированных списков на расстоянии не больше distance"""
+    i = j = 0
+    while i < len(left) and j < len(right):
+        if abs(left[i] - right[j]) <= distance:
+            return True
+        if left[i] < right[j]:
+            i += 1
+        else:
+            j += 1
+    return False
+
+def compile_rule_node(node):
+    """Дерево правила -> функция от MessageTokens"""
+    kind = node[0]
+    if kind == 'term':
+        key = node[1:]
+        return lambda tokens: bool(tokens.positions(key))
+    if kind == 'and':
+        left, right = compile_rule_node(node[1]), compile_rule_node(node[2])
+        return lambda tokens: left(tokens) and right(tokens)
+    if kind == 'or':
+        left, right = compile_rule_node(node[1]), compile_rule_node(node[2])
+        return lambda tokens: left(tokens) or right(tokens)
+    if kind == 'not':
+        operand = compile_rule_node(node[1])
+        return lambda tokens: not operand(tokens)
+    distance, left_key, right_key = node[1], node[2][1:], node[3][1:]
+    return lambda tokens: within_distance(tokens.positions(left_key), tokens.positions(right_key), distance)
+
+def rule_triggers(node):
+    """Слова, без одного из которых правило не может сработать (None - правило проверяется всегда)"""
+    kind = node[0]
+    if kind == 'term':
+        return None if node[2] else {node[1][0]}
+    if kind == 'near':
+        return rule_triggers(node[2])
+    if kind == 'not':
+        return None
+    left, right = rule_triggers(node[1]), rule_triggers(node[2])
+    if kind == 'and':
+        candidates = [triggers for triggers in (left, right) if triggers is not None]
+        return min(candidates, key=len) if candidates else None
+    return left | right if left is not None and right is not None else None
+
+def rule_fuzzy_terms(node):
+    """Нечеткие термины правила: [(слово, число опечаток)]"""
+    kind = node[0]
+    if kind == 'term':
+        return [(node[1][0], node[3])] if node[3] else []
+    if kind == 'near':
+        return rule_fuzzy_terms(node[2]) + rule_fuzzy_terms(node[3])
+    return [term for child in node[1:] if isinstance(child, tuple) for term in rule_fuzzy_terms(child)]
+
+def compile_rule(text: str):
+    """Компиляция текста правила: (функция проверки, слова-триггеры, нечеткие термины)"""
+    node = parse_rule(text)
+    return compile_rule_node(node), rule_triggers(node), rule_fuzzy_terms(node)
+
+def deletion_variants(word: str, distance: int):
+    """Все варианты слова с удалением до distance символов (SymSpell)"""
+    variants = {word}
+    frontier = {word}
+    for _ in range(distance):
+        frontier = {item[:i] + item[i + 1:] for item in frontier if len(item) > 1 for i in range(len(item))}
+        variants |= frontier
+    return variants
+
+def bounded_edit_distance(source: str, target: str, limit: int):
+    """Расстояние Дамерау-Левенштейна (OSA) с ранним выходом; limit + 1, если больше limit"""
+    if abs(len(source) - len(target)) > limit:
+        return limit + 1
+    previous_previous = None
+    previous = list(range(len(target) + 1))
+    for i in range(1, len(source) + 1):
+        current = [i] + [0] * len(target)
+        for j in range(1, len(target) + 1):
+            cost = 0 if source[i - 1] == target[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (i > 1 and j > 1 and source[i - 1] == target[j - 2]
+                    and source[i - 2] == target[j - 1]):
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+class FuzzyIndex:
+    """Словарь удалений SymSpell по нечетким ключевым словам.
+
+    Для каждого токена сообщения перебираются его варианты удалений и ищутся в словаре,
+    поэтому стоимость зависит от числа токенов, а не от произведения токенов на ключевые слова.
+    """
+    
+    def __init__(self):
+        self.words = {}
+        self.deletes = {}
+        self.max_distance = 0
+    
+    def add(self, word: str, distance: int):
+        if self.words.get(word, 0) >= distance:
+            return
+        self.words[word] = distance
+        self.max_distance = max(self.max_distance, distance)
+        for variant in deletion_variants(word, distance):
+            self.deletes.setdefault(variant, set()).add(word)
+    
+    def lookup(self, token_index: dict):
+        """Найденные с опечатками слова индекса: слово -> позиции в сообщении"""
+        hits = {}
+        for token, positions in token_index.items():
+            if len(token) > FUZZY_MAX_TOKEN_LENGTH or len(token) < FUZZY_MIN_WORD_LENGTH - self.max_distance:
+                continue
+            checked = set()
+            for variant in deletion_variants(token, self.max_distance):
+                for word in self.deletes.get(variant, ()):
+                    if word in checked:
+                        continue
+                    checked.add(word)
+                    if bounded_edit_distance(token, word, self.words[word]) <= self.words[word]:
+                        hits.setdefault(word, []).extend(positions)
+        for positions in hits.values():
+            positions.sort()
+        return hits
+
+# Морфология: слова ключей и сообщений приводятся к лемме (или основе), сравнение идет по леммам
+MORPH_BACKEND = pymorphy.__name__ if pymorphy is not None else 'stemmer'
+morph_analyzer = None
+
+# Упрощенный стеммер Портера для русского языка (Snowball), используется без pymorphy
+STEM_RV_RE = re.compile(r'^(.*?[аеиоуыэюя])(.*)$')
+STEM_PERFECTIVE_GERUND_RE = re.compile(r'((ив|ивши|ившись|ыв|ывши|ывшись)|((?<=[ая])(в|вши|вшись)))$')
+STEM_REFLEXIVE_RE = re.compile(r'(с[яь])$')
+STEM_ADJECTIVE_RE = re.compile(r'(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$')
+STEM_PARTICIPLE_RE = re.compile(r'((ивш|ывш|ующ)|((?<=[ая])(ем|нн|вш|ющ|щ)))$')
+STEM_VERB_RE = re.compile(r'((ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|ыть|ишь|ую|ю)'
+                          r'|((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)))$')
+STEM_NOUN_RE = re.compile(r'(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|ью|ю|ия|ья|я)$')
+STEM_DERIVATIONAL_RE = re.compile(r'.*[^аеиоуыэюя]+[аеиоуыэюя].*ость?$')
+STEM_SUPERLATIVE_RE = re.compile(r'(ейше|ейш)$')
+
+def stem_russian(word: str):
+    """Основа русского слова; слова без кириллических гласных возвращаются как есть"""
+    word = word.replace('ё', 'е')
+    match = STEM_RV_RE.match(word)
+    if match is None:
+        return word
+    prefix, rv = match.groups()
+    stripped = STEM_PERFECTIVE_GERUND_RE.sub('', rv, 1)
+    if stripped == rv:
+        rv = STEM_REFLEXIVE_RE.sub('', rv, 1)
+        stripped = STEM_ADJECTIVE_RE.sub('', rv, 1)
+        if stripped != rv:
+            rv = STEM_PARTICIPLE_RE.sub('', stripped, 1)
+        else:
+            stripped = STEM_VERB_RE.sub('', rv, 1)
+            rv = STEM_NOUN_RE.sub('', rv, 1) if stripped == rv else stripped
+    else:
+        rv = stripped
+    if rv.endswith('и'):
+        rv = rv[:-1]
+    if STEM_DERIVATIONAL_RE.match(rv):
+        rv = re.sub(r'ость?$', '', rv)
+    if rv.endswith('ь'):
+        rv = rv[:-1]
+    else:
+        rv = STEM_SUPERLATIVE_RE.sub('', rv, 1)
+        if rv.endswith('нн'):
+            rv = rv[:-1]
+    return prefix + rv
+
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatize_token(token: str):
+    """Лемма токена; словарь слов в сообщениях невелик, поэтому анализ каждого слова кэшируется"""
+    global morph_analyzer
+    if pymorphy is None:
+        return stem_russian(token)
+    if morph_analyzer is None:
+        # Словари pymorphy загружаются при первом обращении (в том числе в каждом процессе пула)
+        morph_analyzer = pymorphy.MorphAnalyzer()
+    return morph_analyzer.parse(token)[0].normal_form.replace('ё', 'е')
+
+def keyword_lemmas(text: str):
+    """Леммы простого ключевого слова для хранения в БД (с именем анализатора).
+
+    Для правил леммы не нужны, но сохраняется пустая отметка анализатора: иначе refresh_user_lemmas
+    выбирал бы строки правил (lemmas IS NULL) при каждом включении морфологии.
+    """
+    if is_rule(text):
+        return f"{MORPH_BACKEND}:"
+    return f"{MORPH_BACKEND}:{' '.join(lemmatize_token(word) for word in WORD_RE.findall(normalize_match_text(text)))}"
+
+def parse_stored_lemmas(stored, text: str):
+    """Кортеж лемм из БД; если леммы не сохранены или посчитаны другим анализатором - считаются заново"""
+    if stored:
+        backend, _, lemmas = stored.partition(':')
+        if backend == MORPH_BACKEND:
+            return tuple(lemmas.split())
+    return tuple(lemmatize_token(word) for word in WORD_RE.findall(normalize_match_text(text)))
+
+class MessageTokens:
+    """Однократная токенизация сообщения: позиции слов и кэш найденных терминов.
+    При morphology=True токены один раз приводятся к леммам, и слова сравниваются по леммам."""
+    
+    __slots__ = ('tokens', 'index', 'cache', 'fuzzy', 'lemmas', 'lemma_index')
+    
+    def __init__(self, text_lower: str, morphology: bool = False):
+        self.tokens = WORD_RE.findall(text_lower)
+        self.index = {}
+        for position, token in enumerate(self.tokens):
+            self.index.setdefault(token, []).append(position)
+        self.cache = {}
+        # Совпадения с опечатками: заполняется RuleSet одним проходом по FuzzyIndex
+        self.fuzzy = {}
+        self.lemmas = None
+        self.lemma_index = None
+        if morphology:
+            self.lemmas = [lemmatize_token(token) for token in self.tokens]
+            self.lemma_index = {}
+            for position, lemma in enumerate(self.lemmas):
+                self.lemma_index.setdefault(lemma, []).append(position)
+    
+    def positions(self, key):
+        """Позиции термина (слова, префикса или начала фразы); каждый термин ищется один раз на сообщение"""
+        result = self.cache.get(key)
+        if result is None:
+            result = self.cache[key] = self.find(*key)
+        return result
+    
+    def find(self, words, prefix, fuzzy):
+        if fuzzy:
+            return self.fuzzy.get(words[0], [])
+        if prefix:
+            return sorted(p for token, positions in self.index.items() if token.startswith(words[0]) for p in positions)
+        if self.lemmas is not None:
+            return self.lemma_positions(tuple(lemmatize_token(word) for word in words))
+        starts = self.index.get(words[0], [])
+        if len(words) == 1:
+            return starts
+        return [p for p in starts
+                if tuple(self.tokens[p:p + len(words)]) == words]
+    
+    def lemma_positions(self, lemmas):
+        """Позиции начала последовательности лемм"""
+        starts = self.lemma_index.get(lemmas[0], [])
+        if len(lemmas) == 1:
+            return starts
+        return [p for p in starts
+                if tuple(self.lemmas[p:p + len(lemmas)]) == lemmas]
+
+class RuleSet:
+    """Скомпилированные ключевые слова и исключения пользователя.
+
+    chat_rules: {chat_id: (ключевые слова, исключения)} - записи, действующие только в своем чате;
+    они компилируются в отдельные наборы и проверяются только для сообщений из этого чата.
+    morphology: простые слова сравниваются по леммам, а не подстрокой; lemmas - {текст: леммы из БД}.
+    """
+    
+    def __init__(self, keywords, exceptions, version: int = 0, chat_rules: dict = None,
+                 morphology: bool = False, lemmas: dict = None):
+        self.version = version
+        self.morphology = morphology
+        self.stored_lemmas = lemmas or {}
+        self.chat_sets = {
+            chat_id: RuleSet(chat_keywords, chat_exceptions, version, morphology=morphology, lemmas=lemmas)
+            for chat_id, (chat_keywords, chat_exceptions) in (chat_rules or {}).items()
+        }
+        # Простые слова собираются в dict (без повторов после нормализации), затем превращаются в списки
+        self.plain_keywords = {}
+        self.rules = []
+        self.plain_exceptions = {}
+        self.rule_exceptions = []
+        # Индекс лемм простых слов: первая лемма -> [(леммы, слово)], ищется по леммам сообщения
+        self.lemma_keywords = {}
+        self.lemma_exceptions = {}
+        # Индекс правил по словам-триггерам: проверяются только правила, чьи слова есть в сообщении
+        self.rule_index = {}
+        self.untriggered_rules = []
+        self.fuzzy_index = FuzzyIndex()
+        for text in dict.fromkeys(keywords):
+            self.add(text, self.plain_keywords, self.rules, self.lemma_keywords)
+        for text in dict.fromkeys(exceptions):
+            self.add(text, self.plain_exceptions, self.rule_exceptions, self.lemma_exceptions)
+        self.plain_keywords = list(self.plain_keywords)
+        self.plain_exceptions = list(self.plain_exceptions)
+        for position, (_, _, triggers) in enumerate(self.rules):
+            if triggers is None:
+                self.untriggered_rules.append(position)
+            else:
+                for word in triggers:
+                    self.rule_index.setdefault(self.trigger_key(word), []).append(position)
+        # Токенизация нужна только если есть правила или слова сравниваются по леммам
+        self.needs_tokens = bool(self.rules or self.rule_exceptions or self.lemma_keywords or self.lemma_exceptions)
+    
+    def add(self, text, plain, rules, lemma_index):
+        if not is_rule(text):
+            normalized = normalize_match_text(plain_text(text))
+            if not normalized:
+                return
+            lemmas = parse_stored_lemmas(self.stored_lemmas.get(text), text) if self.morphology else ()
+            if lemmas:
+                entries = lemma_index.setdefault(lemmas[0], [])
+                if all(entry[1] != normalized for entry in entries):
+                    entries.append((lemmas, normalized))
+            else:
+                # Без морфологии и для слов без букв (например, "$$$") - поиск подстроки
+                plain[normalized] = None
+            return
+        try:
+            rule, triggers, fuzzy_terms = compile_rule(text)
+            rules.append((text, rule, triggers))
+            for word, distance in fuzzy_terms:
+                self.fuzzy_index.add(word, distance)
+        except RuleSyntaxError as e:
+            logger.warning(f"⚠️ Пропущено некорректное правило '{text}': {e}")
+    
+    def trigger_key(self, word):
+        return lemmatize_token(word) if self.morphology else word
+    
+    def candidate_rules(self, tokens):
+        """Номера правил, которые могут сработать на этом сообщении"""
+        candidates = set(self.untriggered_rules)
+        for token in (tokens.lemma_index if self.morphology else tokens.index):
+            candidates.update(self.rule_index.get(token, ()))
+        for word in tokens.fuzzy:
+            candidates.update(self.rule_index.get(self.trigger_key(word), ()))
+        return sorted(candidates)
+    
+    @staticmethod
+    def lemma_matches(lemma_index, tokens):
+        """Простые слова, найденные по леммам сообщения: поиск в индексе, а не перебор всех слов"""
+        found = []
+        for lemma in tokens.lemma_index:
+            for lemmas, text in lemma_index.get(lemma, ()):
+                if len(lemmas) == 1 or tokens.lemma_positions(lemmas):
+                    found.append(text)
+        return found
+    
+    def match(self, text_lower: str, chat_id: int = None):
+        """(есть совпадения, найденные ключевые слова и правила) для текста из normalize_match_text.
+        Исключения чата подавляют и общие ключевые слова, общие исключения - ключевые слова чата."""
+        chat_set = self.chat_sets.get(chat_id)
+        rule_sets = (self,) if chat_set is None else (self, chat_set)
+        if any(exc in text_lower for rule_set in rule_sets for exc in rule_set.plain_exceptions):
+            return False, []
+        tokens = (MessageTokens(text_lower, self.morphology)
+                  if any(rule_set.needs_tokens for rule_set in rule_sets) else None)
+        if any(rule_set.lemma_exceptions and rule_set.lemma_matches(rule_set.lemma_exceptions, tokens)
+               for rule_set in rule_sets):
+            return False, []
+        for rule_set in rule_sets:
+            if rule_set.fuzzy_index.words:
+                tokens.fuzzy.update(rule_set.fuzzy_index.lookup(tokens.index))
+        if any(rule(tokens) for rule_set in rule_sets for _, rule, _ in rule_set.rule_exceptions):
+            return False, []
+        found = []
+        for rule_set in rule_sets:
+            found.extend(kw for kw in rule_set.plain_keywords if kw in text_lower and kw not in found)
+            if rule_set.lemma_keywords:
+                found.extend(kw for kw in rule_set.lemma_matches(rule_set.lemma_keywords, tokens) if kw not in found)
+            if rule_set.rules:
+                for position in rule_set.candidate_rules(tokens):
+                    text, rule, _ = rule_set.rules[position]
+                    if rule(tokens) and text not in found:
+                        found.append(text)
+        return bool(found), found
+
+class MatchCache:
+    """LRU-кэш результатов поиска по ключу (user_id, версия правил, хэш текста)"""
+    
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+    
+    def put(self, key, result):
+        self.entries[key] = result
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+match_cache = MatchCache(MATCH_CACHE_SIZE)
+
+def load_rule_set(user_id: int):
+    """Скомпилированный набор правил пользователя (компилируется один раз до изменения правил)"""
+    rule_set = user_rule_sets.get(user_id)
+    if rule_set is None:
+        try:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT rules_version, morphology FROM users WHERE user_id = ?", (user_id,))
+            row = cursor.fetchone()
+            morphology = bool(row and row[1])
+            cursor.execute("SELECT keyword FROM user_keywords WHERE user_id = ? AND is_active = 1 ORDER BY id",
+                           (user_id,))
+            keywords = [keyword for keyword, in cursor.fetchall()]
+            cursor.execute("SELECT exception_word FROM user_exceptions WHERE user_id = ? AND is_active = 1 ORDER BY id",
+                           (user_id,))
+            exceptions = [exception for exception, in cursor.fetchall()]
+            cursor.execute("SELECT chat_id, keyword, is_exception FROM user_chat_keywords WHERE user_id = ? "
+                           "ORDER BY chat_id, id", (user_id,))
+            chat_rules = {}
+            for chat_id, keyword, is_exception in cursor.fetchall():
+                chat_rules.setdefault(chat_id, ([], []))[1 if is_exception else 0].append(keyword)
+            lemmas = get_stored_lemmas(cursor, user_id) if morphology else None
+            conn.close()
+        except Exception as e:
+            # Пустой набор не кэшируется: иначе пользователь остался бы без уведомлений до правки правил
+            logger.error(f"❌ Ошибка загрузки правил для {user_id}: {e}")
+            return RuleSet([], [], version=-1)
+        rule_set = user_rule_sets[user_id] = RuleSet(keywords, exceptions, row[0] if row else 0, chat_rules,
+                                                     morphology, lemmas)
+    return rule_set
+
+def get_stored_lemmas(cursor, user_id: int):
+    """Сохраненные при добавлении леммы простых слов пользователя: {текст: леммы}"""
+    cursor.execute('''
+        SELECT keyword, lemmas FROM user_keywords WHERE user_id = ? AND lemmas IS NOT NULL
+        UNION ALL
+        SELECT exception_word, lemmas FROM user_exceptions WHERE user_id = ? AND lemmas IS NOT NULL
+        UNION ALL
+        SELECT keyword, lemmas FROM user_chat_keywords WHERE user_id = ? AND lemmas IS NOT NULL
+    ''', (user_id, user_id, user_id))
+    return dict(cursor.fetchall())
+
+def refresh_user_lemmas(cursor, user_id: int):
+    """Леммы для записей, добавленных до появления индекса или посчитанных другим анализатором"""
+    updated = 0
+    for table, column in (('user_keywords', 'keyword'), ('user_exceptions', 'exception_word'),
+                          ('user_chat_keywords', 'keyword')):
+        cursor.execute(
+            f"SELECT id, {column} FROM {table} WHERE user_id = ? AND (lemmas IS NULL OR lemmas NOT LIKE ?)",
+            (user_id, f"{MORPH_BACKEND}:%")
+        )
+        rows = [(keyword_lemmas(text), row_id) for row_id, text in cursor.fetchall()]
+        cursor.executemany(f"UPDATE {table} SET lemmas = ? WHERE id = ?", rows)
+        updated += len(rows)
+    return updated
+
+def get_user_morphology(user_id: int):
+    """Включено ли у пользователя сравнение слов по леммам"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT morphology FROM users WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return bool(row and row[0])
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения режима морфологии для {user_id}: {e}")
+        return False
+
+def set_user_morphology(user_id: int, enabled: bool):
+    """Включение/выключение морфологии; при включении леммы недостающих записей считаются один раз"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("UPDATE users SET morphology = ? WHERE user_id = ?", (int(enabled), user_id))
+        updated = cursor.rowcount > 0
+        refreshed = refresh_user_lemmas(cursor, user_id) if enabled else 0
+        bump_rules_version(cursor, user_id)
+        conn.commit()
+        conn.close()
+        logger.info(f"🔤 Пользователь {user_id} {'включил' if enabled else 'выключил'} морфологию "
+                    f"(пересчитано лемм: {refreshed})")
+        return updated
+    except Exception as e:
+        logger.error(f"❌ Ошибка установки режима морфологии для {user_id}: {e}")
+        return False
+
+def increment_rules_version(cursor, user_id: int):
+    """Новая версия правил в БД без изменения локального кэша (безопасно вызывать из потоков)"""
+    cursor.execute("UPDATE users SET rules_version = rules_version + 1 WHERE user_id = ?", (user_id,))
+
+def bump_rules_version(cursor, user_id: int):
+    """Новая версия правил пользователя: локальный кэш сбрасывается сразу, на других репликах - при синхронизации"""
+    increment_rules_version(cursor, user_id)
+    user_rule_sets.pop(user_id, None)
+    user_rule_versions.pop(user_id, None)
+
+def reload_rule_set(user_id: int):
+    """Сброс и перекомпиляция правил в event loop после изменения их в потоке"""
+    user_rule_sets.pop(user_id, None)
+    user_rule_versions.pop(user_id, None)
+    if process_matcher is None:
+        load_rule_set(user_id)
+
+def load_rule_version(user_id: int):
+    """(версия правил, чаты со своими правилами) без компиляции правил - для режима пула процессов"""
+    cached = user_rule_versions.get(user_id)
+    if cached is None:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT rules_version FROM users WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        cursor.execute("SELECT DISTINCT chat_id FROM user_chat_keywords WHERE user_id = ?", (user_id,))
+        chat_ids = frozenset(chat_id for chat_id, in cursor.fetchall())
+        conn.close()
+        cached = user_rule_versions[user_id] = (row[0] if row else 0, chat_ids)
+    return cached
+
+def sync_rule_versions():
+    """Сброс скомпилированных правил, измененных на других репликах"""
+    if not user_rule_sets and not user_rule_versions:
+        return
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, rules_version FROM users")
+    versions = dict(cursor.fetchall())
+    conn.close()
+    for user_id in [uid for uid, rule_set in user_rule_sets.items() if versions.get(uid, 0) != rule_set.version]:
+        del user_rule_sets[user_id]
+    for user_id in [uid for uid, (version, _) in user_rule_versions.items() if versions.get(uid, 0) != version]:
+        del user_rule_versions[user_id]
+
+def match_batch(batch):
+    """Поиск в процессе-воркере: правила компилируются в воркере и перечитываются, только если
+    запрошена более новая версия (из БД могла прочитаться версия новее запрошенной - она подходит)"""
+    results = []
+    for user_id, version, match_text, chat_id in batch:
+        rule_set = user_rule_sets.get(user_id)
+        if rule_set is not None and rule_set.version < version:
+            del user_rule_sets[user_id]
+        results.append(load_rule_set(user_id).match(match_text, chat_id))
+    return results
+
+class ProcessMatcher:
+    """Поиск ключевых слов в пуле процессов: сообщения копятся в пакеты, event loop не занят CPU"""
+    
+    def __init__(self, processes: int, batch_size: int, batch_delay: float):
+        self.processes = processes
+        self.pool = self.create_pool()
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.pending = []
+        self.flush_handle = None
+        self.batches = 0
+        self.fallbacks = 0
+        self.restarts = 0
+    
+    def create_pool(self):
+        # spawn: fork процесса с работающим event loop и потоком логирования небезопасен
+        pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+        # Процессы запускаются заранее: импорт модуля в воркере занимает секунды
+        for _ in range(self.processes):
+            pool.submit(int)
+        return pool
+    
+    def restart_pool(self, broken_pool):
+        """Новый пул вместо сломанного; пакеты, упавшие одновременно, пересоздают его один раз"""
+        if self.pool is not broken_pool:
+            return
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+        self.pool = self.create_pool()
+        self.restarts += 1
+        logger.warning(f"⚠️ Пул поиска пересоздан (перезапусков: {self.restarts})")
+    
+    def match(self, user_id: int, version: int, match_text: str, chat_id: int = None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append(((user_id, version, match_text, chat_id), future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_delay, self.flush)
+        return future
+    
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        pending, self.pending = self.pending, []
+        if pending:
+            asyncio.create_task(self.run_batch(pending))
+    
+    async def run_batch(self, pending):
+        batch = [item for item, _ in pending]
+        pool = self.pool
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(pool, match_batch, batch)
+            self.batches += 1
+        except Exception as e:
+            # Пакет считается в основном процессе; сломанный пул (например, воркер убит) пересоздается
+            hot_logger.error("❌ Ошибка пула поиска, пакет обработан в основном процессе: %s", e)
+            self.fallbacks += 1
+            if isinstance(e, BrokenProcessPool):
+                self.restart_pool(pool)
+            results = [load_rule_set(user_id).match(match_text, chat_id) for user_id, _, match_text, chat_id in batch]
+        for (_, future), result in zip(pending, results):
+            if not future.done():
+                future.set_result(result)
+    
+    def stats(self):
+        return {
+            'processes': self.processes,
+            'pending': len(self.pending),
+            'batches': self.batches,
+            'fallbacks': self.fallbacks,
+            'restarts': self.restarts,
+        }
+
+process_matcher = None
+
+def init_process_matcher():
+    """Включение пула процессов для поиска (MATCHER_MODE=process)"""
+    global process_matcher
+    if MATCHER_MODE != 'process':
+        return
+    process_matcher = ProcessMatcher(MATCHER_PROCESSES, MATCHER_BATCH_SIZE, MATCHER_BATCH_DELAY)
+    logger.info(f"🧮 Поиск ключевых слов в пуле из {MATCHER_PROCESSES} процессов")
+
+async def check_keywords_for_user(user_id: int, normalized: NormalizedText, chat_id: int = None):
+    """Проверка ключевых слов и исключений по нормализованному тексту.
+
+    Пересланные посты и волны спама приходят одним текстом во многие чаты: результат
+    запоминается по версии правил, поэтому после изменения правил старые записи не используются.
+    """
+    if not normalized.match:
+        return False, []
+    
+    if process_matcher is not None:
+        # Правила компилируются только в воркерах, здесь нужны лишь версия и чаты со своими правилами
+        rule_set = None
+        version, rule_chats = load_rule_version(user_id)
+    else:
+        rule_set = load_rule_set(user_id)
+        version, rule_chats = rule_set.version, rule_set.chat_sets
+    # Чат входит в ключ, только если для него есть свои правила: иначе результат общий для всех чатов
+    chat_key = chat_id if chat_id in rule_chats else None
+    key = (user_id, version, normalized.digest, chat_key)
+    result = match_cache.get(key)
+    if result is None:
+        if rule_set is None:
+            result = await process_matcher.match(user_id, version, normalized.match, chat_key)
+        else:
+            result = rule_set.match(normalized.match, chat_key)
+        match_cache.put(key, result)
+    return result
+
+async def test_session(session_string: str):
+    """Тестирование сессии перед запуском"""
+    try:
+        client = TelegramClient(
+            StringSession(session_string),
+            api_id=2040,
+            api_hash='b18441a1ff607e10a989891a5462e627'
+        )
+        
+        await client.start()
+        me = await client.get_me()
+        await client.disconnect()
+        
+        return True, f"✅ Сессия валидна: @{me.username}"
+    except Exception as e:
+        error_msg = str(e)
+        if "EOF when reading a line" in error_msg:
+            return False, "❌ Сессия невалидна или устарела. Получите новую сессию"
+        else:
+            return False, f"❌ Ошибка сессии: {error_msg}"
+
+async def process_message_for_user(user_id: int, session_id: int, session_name: str, event):
+    """Обработка сообщения для пользователя (вынесено в отдельную функцию)"""
+    try:
+        if not event.message.text:
+            return
+        
+        # Получаем информацию о чате
+        chat = await event.get_chat()
+        chat_id = str(chat.id)
         chat_name = getattr(chat, 'title', 'Unknown Chat')
         
-        # Получаем информацию об отправителе
-        sender = await event.get_sender()
+        # Получаем информацию об отправителе; при перегрузке - только из кэша Telethon
+        sender = event.sender if overload_governor.level >= 2 else await event.get_sender()
         username = getattr(sender, 'username', 'Unknown')
         
-        message_text = event.message.text
+        # Нормализация один раз: результат общий для поиска, хранения и уведомлений
+        normalized = get_normalized_text(event.message)
+        message_text = normalized.display
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
         
         # Проверяем ключевые слова
-        has_keywords, found_keywords = await check_keywords_for_user(user_id, message_text)
+        has_keywords, found_keywords = await check_keywords_for_user(user_id, normalized, chat.id)
         
         # Сохраняем сообщение
         message_data = {
@@ -508,43 +2697,317 @@ async def process_message_for_user(user_id: int, session_id: int, session_name:
             'message_text': message_text,
             'has_keywords': has_keywords,
             'keywords_found': ', '.join(found_keywords) if found_keywords else '',
-            'message_type': 'channel' if hasattr(chat, 'broadcast') else 'group'
+            'message_type': 'channel' if hasattr(chat, 'broadcast') else 'group',
+            'timestamp': timestamp
         }
         
-        save_user_message(user_id, message_data)
+        if overload_governor.level >= 1 and not has_keywords:
+            message_id = None
+            count_skipped_message(user_id, session_id, has_keywords)
+        elif should_store_message(get_storage_policy(user_id, session_id), has_keywords):
+            message_id = save_user_message(user_id, message_data)
+        else:
+            message_id = None
+            count_skipped_message(user_id, session_id, has_keywords)
+        count_message_rollup(user_id, chat_id, chat_name, found_keywords)
         
         # Отправляем уведомление если есть ключевые слова
         if has_keywords and found_keywords:
-            clean_message = re.sub(r'\*{2,}', '', message_text)
+            remember_alert(user_id, (
+                timestamp, message_id, chat_name, username,
+                message_data['keywords_found'], message_text[:200]
+            ))
             
             # Форматируем username с @ для удобного перехода
             username_display = f"@{username}" if username and username != "Unknown" else "Неизвестный"
             
+            if overload_governor.level >= 3:
+                overload_governor.queue_alert(user_id, f"📱 {chat_name} • 🔍 {', '.join(found_keywords)} • 💬 {message_text[:80]}")
+                return
+            
             alert_text = (
                 f"🚨 Найдено ключевое слово!\n\n"
                 f"📱 Чат: {chat_name}\n"
                 f"👤 Отправитель: {username_display}\n"
                 f"🔍 Ключи: {', '.join(found_keywords)}\n"
-                f"💬 Сообщение: {clean_message[:150]}...\n"
+                f"💬 Сообщение: {message_text[:150]}...\n"
                 f"🔐 Сессия: {session_name}"
             )
             
             try:
                 await safe_send_message(user_id, alert_text)
-                logger.info(f"🔔 Уведомление отправлено {user_id}: {found_keywords}")
+                hot_logger.info("🔔 Уведомление отправлено %s: %s", user_id, ', '.join(found_keywords),
+                                extra={'user_id': user_id, 'session_id': session_id, 'chat_id': chat_id})
             except Exception as e:
-                logger.error(f"❌ Ошибка отправки: {e}")
+                hot_logger.error("❌ Ошибка отправки: %s", e)
                     
     except Exception as e:
-        logger.error(f"❌ Ошибка обработки сообщения: {e}")
+        hot_logger.error("❌ Ошибка обработки сообщения: %s", e, extra={'user_id': user_id, 'session_id': session_id})
+
+class FairScheduler:
+    """Очереди сообщений по пользователям, разбираемые воркерами по deficit round robin.
+
+    За один обход пользователь получает число слотов, равное своему весу, поэтому сессия
+    в огромных чатах не задерживает уведомления остальных пользователей.
+    """
+    
+    def __init__(self, handler, workers: int, weights: dict, queue_limit: int = SCHEDULER_QUEUE_LIMIT):
+        self.handler = handler
+        self.workers = workers
+        self.weights = weights
+        self.queue_limit = queue_limit
+        self.queues = {}
+        self.deficits = {}
+        self.active = deque()
+        self.ready = None
+        self.waits = {}
+        self.processed = {}
+        # Пользователи, чьи сообщения отбрасываются при перегрузке
+        self.shed_users = set()
+        self.dropped = {}
+    
+    def start(self):
+        self.ready = asyncio.Semaphore(0)
+        for _ in range(self.workers):
+            asyncio.create_task(self.worker())
+    
+    def submit(self, user_id: int, *args):
+        if user_id in self.shed_users:
+            self.dropped[user_id] = self.dropped.get(user_id, 0) + 1
+            return
+        queue = self.queues.get(user_id)
+        if queue is None:
+            queue = self.queues[user_id] = deque()
+        elif len(queue) >= self.queue_limit:
+            # Очередь одного пользователя не растет без предела, даже если регулятор еще не вмешался
+            self.dropped[user_id] = self.dropped.get(user_id, 0) + 1
+            hot_logger.warning("⚠️ Очередь пользователя переполнена, сообщение отброшено", extra={'user_id': user_id})
+            return
+        if not queue:
+            self.active.append(user_id)
+            self.deficits[user_id] = 0.0
+        queue.append((time.monotonic(), args))
+        self.ready.release()
+    
+    def pop(self):
+        """Следующее сообщение по DRR: пользователь обслуживается, пока у него есть дефицит"""
+        # Очереди могли быть отброшены регулятором нагрузки после release семафора
+        while self.active:
+            user_id = self.active[0]
+            if self.deficits[user_id] < 1:
+                self.deficits[user_id] += self.weights.get(user_id, 1.0)
+                if self.deficits[user_id] < 1:
+                    self.active.rotate(-1)
+                    continue
+            queue = self.queues[user_id]
+            enqueued_at, args = queue.popleft()
+            self.deficits[user_id] -= 1
+            if not queue:
+                self.active.popleft()
+                del self.queues[user_id]
+                del self.deficits[user_id]
+            elif self.deficits[user_id] < 1:
+                self.active.rotate(-1)
+            return user_id, enqueued_at, args
+        return None
+    
+    async def worker(self):
+        while True:
+            await self.ready.acquire()
+            item = self.pop()
+            if item is None:
+                continue
+            user_id, enqueued_at, args = item
+            wait = time.monotonic() - enqueued_at
+            waits = self.waits.get(user_id)
+            if waits is None:
+                waits = self.waits[user_id] = deque(maxlen=256)
+            waits.append(wait)
+            self.processed[user_id] = self.processed.get(user_id, 0) + 1
+            try:
+                await self.handler(user_id, *args)
+            except Exception as e:
+                hot_logger.error("❌ Ошибка в воркере планировщика: %s", e, extra={'user_id': user_id})
+    
+    def depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+    
+    def lowest_priority_users(self):
+        """Пользователи с минимальным весом среди ожидающих; при равных весах - с самой длинной очередью.
+        Последний пользователь с очередью не отбрасывается."""
+        if len(self.queues) < 2:
+            return set()
+        min_weight = min(self.weights.get(user_id, 1.0) for user_id in self.queues)
+        lowest = {user_id for user_id in self.queues if self.weights.get(user_id, 1.0) == min_weight}
+        if len(lowest) == len(self.queues):
+            lowest = {max(self.queues, key=lambda user_id: len(self.queues[user_id]))}
+        return lowest
+    
+    def shed(self, user_ids):
+        """Отбрасывание очередей пользователей и их новых сообщений до снятия перегрузки"""
+        self.shed_users = set(user_ids)
+        for user_id in self.shed_users:
+            queue = self.queues.pop(user_id, None)
+            if queue is None:
+                continue
+            self.dropped[user_id] = self.dropped.get(user_id, 0) + len(queue)
+            self.active.remove(user_id)
+            del self.deficits[user_id]
+    
+    def stats(self):
+        """Глубина очередей и задержка до начала обработки (по последним 256 сообщениям) по пользователям"""
+        tenants = {}
+        for user_id in set(self.waits) | set(self.queues) | set(self.dropped):
+            waits = sorted(self.waits.get(user_id, ()))
+            tenants[str(user_id)] = {
+                'weight': self.weights.get(user_id, 1.0),
+                'depth': len(self.queues.get(user_id, ())),
+                'processed': self.processed.get(user_id, 0),
+                'wait_p50_ms': round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+                'wait_p95_ms': round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+                'wait_max_ms': round(waits[-1] * 1000, 1) if waits else 0.0,
+                'dropped': self.dropped.get(user_id, 0),
+            }
+        return {'workers': self.workers, 'depth': self.depth(), 'tenants': tenants}
+
+message_scheduler = FairScheduler(process_message_for_user, SCHEDULER_WORKERS, TENANT_WEIGHTS)
+
+class OverloadGovernor:
+    """Следит за глубиной очередей и задержкой event loop и переключает уровни деградации.
+
+    При перегрузке уровень поднимается на один за тик, восстановление - на один уровень
+    после GOVERNOR_RECOVERY_TICKS спокойных тиков подряд.
+    """
+    
+    def __init__(self, scheduler: FairScheduler):
+        self.scheduler = scheduler
+        self.level = 0
+        self.loop_lag = 0.0
+        self.calm_ticks = 0
+        self.pending_alerts = {}
+        self.last_alert_flush = time.monotonic()
+    
+    def update(self, depth: int, lag: float):
+        """Новый уровень по замерам одного тика"""
+        self.loop_lag = lag
+        previous = self.level
+        overloaded = depth > GOVERNOR_MAX_DEPTH or lag > GOVERNOR_MAX_LAG
+        if overloaded:
+            self.calm_ticks = 0
+            self.level = min(self.level + 1, max(OVERLOAD_LEVELS))
+        elif depth < GOVERNOR_MAX_DEPTH / 4 and lag < GOVERNOR_MAX_LAG / 4:
+            self.calm_ticks += 1
+            if self.level and self.calm_ticks >= GOVERNOR_RECOVERY_TICKS:
+                self.level -= 1
+                self.calm_ticks = 0
+        else:
+            self.calm_ticks = 0
+        
+        if self.level >= 4:
+            # Новые пользователи отбрасываются только пока перегрузка держится; на спокойных тиках
+            # при восстановлении список не растет (отброшенные уже не попадают в lowest_priority_users)
+            if overloaded:
+                self.scheduler.shed(self.scheduler.shed_users | self.scheduler.lowest_priority_users())
+        elif self.scheduler.shed_users:
+            self.scheduler.shed(set())
+        if self.level != previous:
+            logger.warning(f"⚠️ Уровень перегрузки {previous} → {self.level}: {OVERLOAD_LEVELS[self.level]} "
+                           f"(очередь {depth}, задержка loop {lag * 1000:.0f} мс)")
+    
+    def queue_alert(self, user_id: int, line: str):
+        self.pending_alerts.setdefault(user_id, []).append(line)
+    
+    async def flush_alerts(self):
+        """Отправка накопленных уведомлений одним сообщением на пользователя"""
+        pending, self.pending_alerts = self.pending_alerts, {}
+        self.last_alert_flush = time.monotonic()
+        for user_id, lines in pending.items():
+            text = f"🚨 Найдено совпадений: {len(lines)} (высокая нагрузка, уведомления объединены)\n\n"
+            text += "\n".join(lines)
+            await safe_send_message(user_id, text[:4000])
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(GOVERNOR_INTERVAL)
+            try:
+                self.update(self.scheduler.depth(), max(0.0, loop.time() - started - GOVERNOR_INTERVAL))
+                if self.pending_alerts and (
+                    self.level < 3 or time.monotonic() - self.last_alert_flush >= ALERT_COALESCE_INTERVAL
+                ):
+                    await self.flush_alerts()
+            except Exception as e:
+                logger.error(f"❌ Ошибка регулятора нагрузки: {e}")
+    
+    def stats(self):
+        return {
+            'level': self.level,
+            'description': OVERLOAD_LEVELS[self.level],
+            'loop_lag_ms': round(self.loop_lag * 1000, 1),
+            'shed_users': sorted(self.scheduler.shed_users),
+            'pending_alerts': sum(len(lines) for lines in self.pending_alerts.values()),
+        }
+
+overload_governor = OverloadGovernor(message_scheduler)
 
-async def start_user_session(user_id: int, session_id: int, session_name: str, session_string: str):
-    """Запуск мониторинга для сессии пользователя"""
+async def start_user_session(user_id: int, session_id: int, session_name: str, session_string: str,
+                             quiet: bool = False):
+    """Запуск мониторинга для сессии пользователя.
+
+    quiet=True - фоновый запуск (перебалансировка, повтор после ошибки): пользователь получает
+    сообщение только при смене состояния - первая ошибка или восстановление после ошибки.
+    Сессия, которая уже запускается, повторно не запускается (вызывающие проверяют starting_sessions заранее).
+    """
+    if session_id in starting_sessions:
+        logger.warning(f"⚠️ Сессия {session_name} для {user_id} уже запускается")
+        return False
+    
+    async def report(text: str, failed: bool):
+        was_failed = mark_session_start_failed(session_id, failed)
+        if not quiet or failed != was_failed:
+            await safe_send_message(user_id, text)
+    
+    async def fail(text: str):
+        # Аренда аккаунта без подключения не должна закреплять его за этой репликой
+        if account_id is not None and account_id not in active_clients:
+            release_lease(f"account:{account_id}")
+        # Фильтр мог быть загружен до ошибки - в реестре остаются только запущенные сессии
+        if (user_id, session_id) not in session_accounts:
+            session_chat_filters.pop((user_id, session_id), None)
+        await report(text, True)
+    
+    def subscribe(account_id: int, username: str):
+        account_subscribers[account_id][(user_id, session_id)] = session_name
+        session_accounts[(user_id, session_id)] = account_id
+        logger.info(f"✅ Сессия запущена для {user_id}: {session_name} (@{username})")
+    
+    account_id = None
+    connecting = None
+    # До первого await: параллельный запуск той же сессии увидит ее в starting_sessions
+    starting_sessions.add(session_id)
     try:
+        # Аккаунт уже известен по прошлому запуску - проверяем дубликат до нового MTProto-подключения
+        account_id = get_session_account(session_id)
+        while account_id in starting_accounts:
+            # Аккаунт подключает другая сессия - ждем и подписываемся на ее клиента
+            await starting_accounts[account_id].wait()
+        if account_id in active_clients:
+            load_chat_filter(user_id, session_id)
+            logger.info(f"🔗 Сессия {session_name} для {user_id} использует подключение аккаунта {account_id}")
+            subscribe(account_id, account_usernames.get(account_id))
+            await report(f"✅ Мониторинг запущен для сессии '{session_name}' (@{account_usernames.get(account_id)})", False)
+            return True
+        if account_id is not None and not acquire_lease(f"account:{account_id}"):
+            await fail(f"❌ Аккаунт сессии '{session_name}' уже подключен на другой реплике")
+            return False
+        if account_id is not None:
+            connecting = starting_accounts[account_id] = asyncio.Event()
+        
         # Тестируем сессию перед запуском
         is_valid, message = await test_session(session_string)
         if not is_valid:
-            await safe_send_message(user_id, f"❌ Не удалось запустить сессию '{session_name}': {message}")
+            await fail(f"❌ Не удалось запустить сессию '{session_name}': {message}")
             return False
 
         # Создаем клиента Telethon
@@ -554,63 +3017,207 @@ async def start_user_session(user_id: int, session_id: int, session_name: str, s
             api_hash='b18441a1ff607e10a989891a5462e627'
         )
         
-        @client.on(events.NewMessage)
-        async def handle_user_messages(event):
-            """Обработчик сообщений - только добавляет задачу в event loop"""
-            # Создаем задачу для обработки сообщения, не блокируя основной поток
-            asyncio.create_task(
-                process_message_for_user(user_id, session_id, session_name, event)
-            )
-        
         # Запускаем клиента
         await client.start()
         me = await client.get_me()
+        if account_id is None:
+            account_id = me.id
+            save_session_account(session_id, account_id)
+            # Новая сессия: аренда аккаунта не дает держать его на двух репликах одновременно
+            if account_id not in active_clients and not acquire_lease(f"account:{account_id}"):
+                await client.disconnect()
+                await fail(f"❌ Аккаунт сессии '{session_name}' уже подключен на другой реплике")
+                return False
         
-        # Сохраняем клиент
-        client_key = f"{user_id}_{session_id}"
-        active_clients[client_key] = client
-        
-        logger.info(f"✅ Сессия запущена для {user_id}: {session_name} (@{me.username})")
-        
-        # Запускаем прослушивание в фоне
-        asyncio.create_task(client.run_until_disconnected())
+        load_chat_filter(user_id, session_id)
+        if account_id in active_clients:
+            # Аккаунт уже подключен другой сессией - подписываемся на его клиента
+            await client.disconnect()
+            logger.info(f"🔗 Сессия {session_name} для {user_id} использует подключение аккаунта {account_id}")
+        else:
+            subscribers = account_subscribers[account_id] = {}
+            
+            # Фильтр чатов проверяется Telethon до вызова обработчика, отсеянные события не создают задач
+            @client.on(events.NewMessage(func=lambda event: any(
+                chat_filter_accepts(session_chat_filters[key], event) for key in subscribers
+            )))
+            async def handle_user_messages(event):
+                """Обработчик сообщений - раздает событие подписчикам аккаунта, по одному на пользователя"""
+                queued_users = set()
+                for (subscriber_id, subscriber_session_id), subscriber_session_name in list(subscribers.items()):
+                    if subscriber_id in queued_users:
+                        continue
+                    if chat_filter_accepts(session_chat_filters[(subscriber_id, subscriber_session_id)], event):
+                        queued_users.add(subscriber_id)
+                        message_scheduler.submit(subscriber_id, subscriber_session_id, subscriber_session_name, event)
+            
+            active_clients[account_id] = client
+            account_usernames[account_id] = me.username
+            # Запускаем прослушивание в фоне
+            asyncio.create_task(client.run_until_disconnected())
         
-        await safe_send_message(user_id, f"✅ Мониторинг запущен для сессии '{session_name}' (@{me.username})")
+        subscribe(account_id, me.username)
+        await report(f"✅ Мониторинг запущен для сессии '{session_name}' (@{me.username})", False)
         return True
         
     except SessionPasswordNeededError:
         error_msg = "❌ Сессия требует двухфакторную аутентификацию"
-        await safe_send_message(user_id, error_msg)
+        await fail(error_msg)
         logger.error(f"❌ 2FA required for {session_name}")
         return False
     except PhoneNumberInvalidError:
         error_msg = "❌ Неверный номер телефона в сессии"
-        await safe_send_message(user_id, error_msg)
+        await fail(error_msg)
         logger.error(f"❌ Invalid phone for {session_name}")
         return False
     except Exception as e:
         error_msg = f"❌ Ошибка запуска сессии: {str(e)}"
-        await safe_send_message(user_id, error_msg)
+        await fail(error_msg)
         logger.error(f"❌ Ошибка запуска {session_name}: {e}")
         return False
+    finally:
+        starting_sessions.discard(session_id)
+        if connecting is not None:
+            del starting_accounts[account_id]
+            connecting.set()
+
+def get_session_account(session_id: int):
+    """Id аккаунта Telegram сессии, запомненный при прошлом запуске (None - сессия еще не запускалась)"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT account_id FROM user_sessions WHERE id = ?", (session_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return row[0] if row else None
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения аккаунта сессии {session_id}: {e}")
+        return None
+
+def save_session_account(session_id: int, account_id: int):
+    """Запоминает id аккаунта Telegram сессии"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("UPDATE user_sessions SET account_id = ? WHERE id = ?", (account_id, session_id))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения аккаунта сессии {session_id}: {e}")
+
+def mark_session_start_failed(session_id: int, failed: bool):
+    """Запоминает результат запуска сессии в общей БД; возвращает, была ли прошлая попытка неудачной"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT start_failed FROM user_sessions WHERE id = ?", (session_id,))
+        row = cursor.fetchone()
+        cursor.execute("UPDATE user_sessions SET start_failed = ? WHERE id = ?", (int(failed), session_id))
+        conn.commit()
+        conn.close()
+        return bool(row and row[0])
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения состояния сессии {session_id}: {e}")
+        return False
 
 async def stop_user_session(user_id: int, session_id: int):
     """Остановка сессии пользователя"""
     try:
-        client_key = f"{user_id}_{session_id}"
+        account_id = session_accounts.pop((user_id, session_id), None)
+        if account_id is None:
+            return False
         
-        if client_key in active_clients:
-            client = active_clients[client_key]
+        subscribers = account_subscribers[account_id]
+        subscribers.pop((user_id, session_id), None)
+        session_chat_filters.pop((user_id, session_id), None)
+        if not subscribers:
+            # Последний подписчик - закрываем соединение аккаунта
+            del account_subscribers[account_id]
+            account_usernames.pop(account_id, None)
+            client = active_clients.pop(account_id)
             await client.disconnect()
-            del active_clients[client_key]
-            logger.info(f"⏹️ Сессия остановлена: {client_key}")
-            return True
-        
-        return False
+            release_lease(f"account:{account_id}")
+        logger.info(f"⏹️ Сессия остановлена: {user_id}_{session_id}")
+        return True
     except Exception as e:
         logger.error(f"❌ Ошибка остановки сессии: {e}")
         return False
 
+# Аренды сессий между репликами
+def acquire_lease(name: str, now: float = None):
+    """Захват аренды: свободной, просроченной или уже своей"""
+    now = now or time.time()
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+        ''', (name, REPLICA_ID, now + LEASE_TTL, now))
+        acquired = cursor.rowcount > 0
+        conn.commit()
+        conn.close()
+        return acquired
+    except Exception as e:
+        logger.error(f"❌ Ошибка захвата аренды {name}: {e}")
+        return False
+
+def release_lease(name: str):
+    """Освобождение своей аренды"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, REPLICA_ID))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка освобождения аренды {name}: {e}")
+
+def renew_leases(now: float):
+    """Пульс реплики и продление своих аренд; возвращает (свои аренды, число живых реплик)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO replica_heartbeats (replica_id, last_seen) VALUES (?, ?)
+        ON CONFLICT(replica_id) DO UPDATE SET last_seen = excluded.last_seen
+    ''', (REPLICA_ID, now))
+    cursor.execute("DELETE FROM replica_heartbeats WHERE last_seen < ?", (now - LEASE_TTL * 10,))
+    cursor.execute("UPDATE leases SET expires_at = ? WHERE owner = ? AND expires_at >= ?",
+                   (now + LEASE_TTL, REPLICA_ID, now))
+    cursor.execute("SELECT name FROM leases WHERE owner = ? AND expires_at >= ?", (REPLICA_ID, now))
+    owned = {row[0] for row in cursor.fetchall()}
+    cursor.execute("SELECT COUNT(*) FROM replica_heartbeats WHERE last_seen >= ?", (now - LEASE_TTL,))
+    live_replicas = max(cursor.fetchone()[0], 1)
+    conn.commit()
+    conn.close()
+    return owned, live_replicas
+
+def get_session_lease_owners():
+    """Действующие аренды сессий: session_id -> реплика"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT name, owner FROM leases WHERE name LIKE 'session:%' AND expires_at >= ?", (time.time(),))
+        owners = {int(name.split(':')[1]): owner for name, owner in cursor.fetchall()}
+        conn.close()
+        return owners
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения аренд сессий: {e}")
+        return {}
+
+def set_session_active(user_id: int, session_id: int, is_active: bool):
+    """Флаг is_active сессии: по нему реплики решают, какие сессии держать запущенными"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("UPDATE user_sessions SET is_active = ? WHERE id = ? AND user_id = ?",
+                       (int(is_active), session_id, user_id))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка изменения статуса сессии {session_id}: {e}")
+
 # Middleware для проверки доступа
 @dp.message.middleware()
 async def check_access_middleware(handler, event: Message, data):
@@ -648,6 +3255,7 @@ async def cmd_start(message: Message):
         "📁 /my_sessions - мои сессии\n"
         "▶️ /start_session - запустить мониторинг\n"
         "⏹️ /stop_session - остановить мониторинг\n"
+        "🧭 /chat_filter - фильтр чатов сессии\n"
         "🔍 /add_keyword - добавить ключевые слова\n"
         "🚫 /add_exception - добавить исключения\n"
         "📋 /keywords - список ключевых слов\n"
@@ -656,7 +3264,14 @@ async def cmd_start(message: Message):
         "🗑️ /del_exception - удалить исключение\n"
         "🧹 /clear_keywords - очистить все ключевые слова\n"
         "🧹 /clear_exceptions - очистить все исключения\n"
+        "💬 /add_chat_keyword, /add_chat_exception - слова для одного чата\n"
+        "💬 /chat_keywords - слова по чатам\n"
+        "📥 /import_keywords, /import_exceptions - импорт из файла (подпись к документу)\n"
+        "🗄️ /storage_policy - политика хранения сообщений\n"
+        "🔤 /morphology - поиск слов в любой форме\n"
+        "🔑 /api_token - личный токен HTTP API\n"
         "📊 /my_stats - моя статистика\n"
+        "🏆 /top_chats, /top_keywords - чаты и слова с уведомлениями\n"
         "🚨 /my_alerts - мои уведомления\n"
         "👥 /add_user - добавить пользователя (админ)\n"
         "👥 /remove_user - удалить пользователя (админ)\n"
@@ -716,12 +3331,17 @@ async def cmd_my_sessions(message: Message):
         await safe_send_message(user_id, "📭 У вас нет сохраненных сессий\n\nДобавьте сессию: /add_session")
         return
     
+    lease_owners = get_session_lease_owners()
     text = "📁 Ваши сессии:\n\n"
     for session_id, session_name, session_string, is_active in sessions:
         # Проверяем активна ли сессия
-        client_key = f"{user_id}_{session_id}"
-        is_running = client_key in active_clients
-        status = "🟢 Активна" if is_running else "🔴 Неактивна"
+        is_running = is_session_running(user_id, session_id)
+        if is_running:
+            status = "🟢 Активна"
+        elif session_id in lease_owners:
+            status = f"🟢 Активна (реплика {lease_owners[session_id]})"
+        else:
+            status = "🔴 Неактивна"
         text += f"🆔 {session_id} • {session_name} • {status}\n"
     
     text += "\n▶️ Запустить: /start_session <ID>"
@@ -759,14 +3379,28 @@ async def cmd_start_session(message: Message):
         session_id, session_name, session_string, is_active = target_session
         
         # Проверяем не запущена ли уже сессия
-        client_key = f"{user_id}_{session_id}"
-        if client_key in active_clients:
+        if is_session_running(user_id, session_id):
             await safe_send_message(user_id, f"❌ Сессия '{session_name}' уже запущена")
             return
+        if session_id in starting_sessions:
+            await safe_send_message(user_id, f"⏳ Сессия '{session_name}' уже запускается")
+            return
+        
+        set_session_active(user_id, session_id, True)
+        session_start_failures.pop(session_id, None)
+        
+        # Сессию держит та реплика, которая владеет её арендой
+        if not acquire_lease(f"session:{session_id}"):
+            owner = get_session_lease_owners().get(session_id, "другая реплика")
+            await safe_send_message(user_id, f"✅ Сессия '{session_name}' уже обслуживается: {owner}")
+            return
         
         # Запускаем сессию
         success = await start_user_session(user_id, session_id, session_name, session_string)
         
+        if not success:
+            release_lease(f"session:{session_id}")
+        
         if success:
             await safe_send_message(user_id, f"✅ Сессия '{session_name}' запущена!")
         else:
@@ -790,16 +3424,106 @@ async def cmd_stop_session(message: Message):
     
     try:
         session_id = int(args[1])
+        # Снимаем флаг активности, иначе реплики снова захватят сессию по аренде
+        set_session_active(user_id, session_id, False)
         success = await stop_user_session(user_id, session_id)
+        owner = get_session_lease_owners().get(session_id)
         
         if success:
+            release_lease(f"session:{session_id}")
             await safe_send_message(user_id, f"✅ Сессия ID {session_id} остановлена")
+        elif owner and owner != REPLICA_ID:
+            await safe_send_message(
+                user_id,
+                f"✅ Сессия ID {session_id} будет остановлена репликой {owner} в течение {LEASE_HEARTBEAT_INTERVAL} сек."
+            )
         else:
             await safe_send_message(user_id, "❌ Не удалось остановить сессию. Возможно, она не запущена")
             
     except ValueError:
         await safe_send_message(user_id, "❌ Неверный ID. Используйте числовой ID")
 
+@dp.message(Command("chat_filter"))
+async def cmd_chat_filter(message: Message):
+    """Фильтр чатов сессии: белый/черный список и типы чатов"""
+    user_id = message.from_user.id
+    
+    if not is_user_allowed(user_id):
+        return
+    
+    args = message.text.split(maxsplit=3)
+    if len(args) < 2:
+        help_text = (
+            "🧭 Фильтр чатов сессии\n\n"
+            "/chat_filter <ID_сессии> - текущий фильтр\n"
+            "/chat_filter <ID_сессии> include id1,id2 - только эти чаты\n"
+            "/chat_filter <ID_сессии> exclude id1,id2 - игнорировать эти чаты\n"
+            f"/chat_filter <ID_сессии> types {','.join(CHAT_TYPES)} - только эти типы чатов\n"
+            "/chat_filter <ID_сессии> include off - отключить правило\n"
+            "/chat_filter <ID_сессии> clear - сбросить фильтр"
+        )
+        await safe_send_message(user_id, help_text)
+        return
+    
+    try:
+        session_id = int(args[1])
+    except ValueError:
+        await safe_send_message(user_id, "❌ Неверный ID. Используйте числовой ID")
+        return
+    
+    if len(args) == 2:
+        if not any(sess[0] == session_id for sess in get_user_sessions(user_id)):
+            await safe_send_message(user_id, "❌ Сессия с таким ID не найдена")
+            return
+        chat_filter = load_chat_filter(user_id, session_id)
+        types_text = ', '.join(CHAT_TYPES[t] for t in sorted(chat_filter['types'])) if chat_filter['types'] else "все"
+        text = (
+            f"🧭 Фильтр чатов сессии ID {session_id}:\n\n"
+            f"✅ Только чаты: {', '.join(map(str, sorted(chat_filter['include']))) or 'все'}\n"
+            f"🚫 Исключенные чаты: {', '.join(map(str, sorted(chat_filter['exclude']))) or 'нет'}\n"
+            f"📂 Типы чатов: {types_text}"
+        )
+        await safe_send_message(user_id, text)
+        return
+    
+    action = args[2].lower()
+    value = args[3].strip() if len(args) > 3 else ''
+    
+    if action == 'clear':
+        success = all(set_chat_filter(user_id, session_id, field, None)
+                      for field in ('chat_include', 'chat_exclude', 'chat_types'))
+    elif action in ('include', 'exclude'):
+        if not value:
+            await safe_send_message(user_id, f"❌ Используйте: /chat_filter {session_id} {action} id1,id2")
+            return
+        if value.lower() == 'off':
+            stored = None
+        else:
+            try:
+                stored = ','.join(map(str, sorted(parse_chat_ids(value))))
+            except ValueError:
+                await safe_send_message(user_id, "❌ ID чатов должны быть числами")
+                return
+        success = set_chat_filter(user_id, session_id, f"chat_{action}", stored)
+    elif action == 'types':
+        if value.lower() == 'off':
+            stored = None
+        else:
+            chat_types = {t for t in re.split(r'[\s,]+', value.lower()) if t}
+            if not chat_types or not chat_types <= set(CHAT_TYPES):
+                await safe_send_message(user_id, f"❌ Доступные типы: {', '.join(CHAT_TYPES)}")
+                return
+            stored = ','.join(sorted(chat_types))
+        success = set_chat_filter(user_id, session_id, 'chat_types', stored)
+    else:
+        await safe_send_message(user_id, "❌ Неизвестное действие. Используйте include, exclude, types или clear")
+        return
+    
+    if success:
+        await safe_send_message(user_id, f"✅ Фильтр чатов сессии ID {session_id} обновлен")
+    else:
+        await safe_send_message(user_id, "❌ Не удалось изменить фильтр. Проверьте ID сессии")
+
 # Остальные команды (ключевые слова, исключения, пользователи и т.д.)
 @dp.message(Command("add_keyword"))
 async def cmd_add_keyword(message: Message):
@@ -811,16 +3535,27 @@ async def cmd_add_keyword(message: Message):
     
     args = message.text.split(maxsplit=1)
     if len(args) < 2:
-        await safe_send_message(user_id, "❌ Используйте: /add_keyword слово1,слово2,слово3")
+        help_text = (
+            "❌ Используйте: /add_keyword слово1,слово2,слово3\n\n"
+            "Правила (операторы заглавными буквами):\n"
+            "/add_keyword (buy OR sell) AND usdt NOT scam\n"
+            "/add_keyword \"сдам квартиру\" NEAR/5 центр\n"
+            "/add_keyword продаж* И НЕ реклама\n"
+            "/add_keyword продам~ - с одной опечаткой, продам~2 - с двумя\n"
+            "/add_keyword =Ремонт И отделка - простое слово, даже если похоже на правило"
+        )
+        await safe_send_message(user_id, help_text)
         return
     
     keywords_text = args[1]
-    added_count, keywords = add_user_keywords(user_id, keywords_text)
+    added_count, keywords, invalid = add_user_keywords(user_id, keywords_text)
     
     if added_count > 0:
         await safe_send_message(user_id, f"✅ Добавлено {added_count} ключевых слов: {', '.join(keywords)}")
     else:
         await safe_send_message(user_id, "❌ Не удалось добавить ключевые слова")
+    if invalid:
+        await safe_send_message(user_id, "⚠️ Некорректные правила пропущены:\n" + "\n".join(invalid))
 
 @dp.message(Command("add_exception"))
 async def cmd_add_exception(message: Message):
@@ -836,12 +3571,14 @@ async def cmd_add_exception(message: Message):
         return
     
     exceptions_text = args[1]
-    added_count, exceptions = add_user_exceptions(user_id, exceptions_text)
+    added_count, exceptions, invalid = add_user_exceptions(user_id, exceptions_text)
     
     if added_count > 0:
         await safe_send_message(user_id, f"✅ Добавлено {added_count} исключений: {', '.join(exceptions)}")
     else:
         await safe_send_message(user_id, "❌ Не удалось добавить исключения")
+    if invalid:
+        await safe_send_message(user_id, "⚠️ Некорректные правила пропущены:\n" + "\n".join(invalid))
 
 @dp.message(Command("keywords"))
 async def cmd_keywords(message: Message):
@@ -931,6 +3668,159 @@ async def cmd_del_exception(message: Message):
     except ValueError:
         await safe_send_message(user_id, "❌ Неверный ID. Используйте числовой ID")
 
+async def add_chat_words_command(message: Message, is_exception: bool):
+    """Общая часть /add_chat_keyword и /add_chat_exception"""
+    user_id = message.from_user.id
+    
+    if not is_user_allowed(user_id):
+        return
+    
+    command = "/add_chat_exception" if is_exception else "/add_chat_keyword"
+    args = message.text.split(maxsplit=2)
+    try:
+        chat_id = normalize_chat_id(args[1])
+    except (IndexError, ValueError):
+        chat_id = None
+    if chat_id is None or len(args) < 3:
+        await safe_send_message(
+            user_id,
+            f"❌ Используйте: {command} <ID_чата> слово1,слово2\n\n"
+            f"Слова действуют только в этом чате. ID чата есть в выгрузке /export"
+        )
+        return
+    
+    added_count, words, invalid = add_chat_keywords(user_id, chat_id, args[2], is_exception)
+    kind = "исключений" if is_exception else "ключевых слов"
+    if added_count > 0:
+        await safe_send_message(user_id, f"✅ Добавлено {added_count} {kind} для чата {chat_id}: {', '.join(words)}")
+    else:
+        await safe_send_message(user_id, f"❌ Не удалось добавить {kind} (возможно, уже добавлены)")
+    if invalid:
+        await safe_send_message(user_id, "⚠️ Некорректные правила пропущены:\n" + "\n".join(invalid))
+
+@dp.message(Command("add_chat_keyword"))
+async def cmd_add_chat_keyword(message: Message):
+    """Ключевые слова для одного чата"""
+    await add_chat_words_command(message, False)
+
+@dp.message(Command("add_chat_exception"))
+async def cmd_add_chat_exception(message: Message):
+    """Исключения для одного чата"""
+    await add_chat_words_command(message, True)
+
+@dp.message(Command("chat_keywords"))
+async def cmd_chat_keywords(message: Message):
+    """Показать ключевые слова и исключения по чатам"""
+    user_id = message.from_user.id
+    
+    if not is_user_allowed(user_id):
+        return
+    
+    rows = get_chat_keywords(user_id)
+    if not rows:
+        await safe_send_message(user_id, "📝 Нет слов для отдельных чатов\n\nДобавьте: /add_chat_keyword <ID_чата> слово1,слово2")
+        return
+    
+    text = f"💬 Слова по чатам ({len(rows)}):\n"
+    current_chat = None
+    for entry_id, chat_id, keyword, is_exception in rows:
+        if chat_id != current_chat:
+            current_chat = chat_id
+            text += f"\n📱 Чат {chat_id}:\n"
+        text += f"🆔 {entry_id} • {'🚫' if is_exception else '🔍'} {keyword}\n"
+    text += "\n🗑️ Удалить: /del_chat_keyword <ID>"
+    await safe_send_message(user_id, text[:4000])
+
+@dp.message(Command("del_chat_keyword"))
+async def cmd_del_chat_keyword(message: Message):
+    """Удалить слово чата по ID"""
+    user_id = message.from_user.id
+    
+    if not is_user_allowed(user_id):
+        return
+    
+    args = message.text.split()
+    if len(args) < 2:
+        await safe_send_message(user_id, "❌ Используйте: /del_chat_keyword <ID>\n\nПосмотреть ID: /chat_keywords")
+        return
+    
+    try:
+        entry_id = int(args[1])
+        if delete_chat_keyword(user_id, entry_id):
+            await safe_send_message(user_id, f"✅ Запись ID {entry_id} удалена")
+        else:
+            await safe_send_message(user_id, "❌ Не удалось удалить запись. Проверьте ID")
+    except ValueError:
+        await safe_send_message(user_id, "❌ Неверный ID. Используйте числовой ID")
+
+# Документ с подписью-командой регистрируется раньше подсказки: Command проверяет и caption
+@dp.message(F.document, F.caption.regexp(r'^/import_(keywords|exceptions)\b'))
+async def cmd_import_document(message: Message):
+    """Массовый импорт ключевых слов или исключений из документа"""
+    user_id = message.from_user.id
+    
+    if not is_user_allowed(user_id):
+        return
+    
+    args = message.caption.split()
+    is_exception = args[0].startswith('/import_exceptions')
+    chat_id = None
+    if len(args) > 1:
+        try:
+            chat_id = normalize_chat_id(args[1])
+        except ValueError:
+            await safe_send_message(user_id, "❌ Неверный ID чата")
+            return
+    
+    document = message.document
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await safe_send_message(user_id, f"❌ Файл больше {IMPORT_MAX_BYTES // (1024 * 1024)} МБ")
+        return
+    
+    try:
+        # Крупный файл уходит во временный файл на диске, строки читаются из него потоком
+        with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_BYTES) as spool:
+            await bot.download(document, destination=spool)
+            spool.seek(0)
+            added_count, duplicates, invalid = await asyncio.to_thread(
+                import_user_terms, user_id, iter_import_terms(spool, document.file_name or ''), is_exception, chat_id
+            )
+        # Правила перекомпилируются один раз после всей вставки, в event loop
+        reload_rule_set(user_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка импорта файла для {user_id}: {e}")
+        await safe_send_message(user_id, "❌ Не удалось прочитать файл")
+        return
+    
+    kind = "исключений" if is_exception else "ключевых слов"
+    scope = f" для чата {chat_id}" if chat_id is not None else ""
+    text = (
+        f"📥 Импорт {kind}{scope} завершен:\n\n"
+        f"✅ Добавлено: {added_count}\n"
+        f"🔁 Дубликатов: {duplicates}\n"
+        f"⚠️ Некорректных: {len(invalid)}"
+    )
+    if invalid:
+        text += "\n\n" + "\n".join(invalid[:20])
+        if len(invalid) > 20:
+            text += f"\n... и еще {len(invalid) - 20}"
+    await safe_send_message(user_id, text[:4000])
+
+@dp.message(Command("import_keywords", "import_exceptions"), ~F.document)
+async def cmd_import_help(message: Message):
+    """Подсказка по импорту: команда работает как подпись к файлу"""
+    user_id = message.from_user.id
+    
+    if not is_user_allowed(user_id):
+        return
+    
+    await safe_send_message(
+        user_id,
+        "📥 Отправьте файл .txt или .csv с подписью /import_keywords или /import_exceptions\n\n"
+        "В файле одно слово или правило в строке (в CSV - первая колонка), строки с # пропускаются.\n"
+        "Для слов одного чата: /import_keywords <ID_чата>"
+    )
+
 @dp.message(Command("clear_keywords"))
 async def cmd_clear_keywords(message: Message):
     """Очистить все ключевые слова"""
@@ -1034,6 +3924,104 @@ async def cmd_users(message: Message):
     
     await safe_send_message(user_id, text)
 
+@dp.message(Command("morphology"))
+async def cmd_morphology(message: Message):
+    """Сравнение ключевых слов по словоформам"""
+    user_id = message.from_user.id
+    
+    if not is_user_allowed(user_id):
+        return
+    
+    args = message.text.split()
+    if len(args) < 2:
+        state = "включена" if get_user_morphology(user_id) else "выключена"
+        text = f"🔤 Морфология: {state} (анализатор: {MORPH_BACKEND})\n\n"
+        text += "При включенной морфологии простые ключевые слова и исключения находятся в любой форме: "
+        text += "«квартира» найдется в «сдаю квартиру». Правила сравнивают слова так же, кроме слово* и слово~.\n\n"
+        if pymorphy is not None and MATCHER_MODE == 'process':
+            text += (f"💾 Словари {MORPH_BACKEND} (около 20 МБ) загружаются в каждом из {MATCHER_PROCESSES} "
+                     f"процессов пула поиска.\n\n")
+        text += "⚙️ /morphology on - включить\n⚙️ /morphology off - выключить"
+        await safe_send_message(user_id, text)
+        return
+    
+    mode = args[1].lower()
+    if mode not in ('on', 'off'):
+        await safe_send_message(user_id, "❌ Используйте /morphology on или /morphology off")
+        return
+    
+    if set_user_morphology(user_id, mode == 'on'):
+        state = "включена" if mode == 'on' else "выключена"
+        await safe_send_message(user_id, f"✅ Морфология {state}")
+    else:
+        await safe_send_message(user_id, "❌ Не удалось изменить режим морфологии")
+
+@dp.message(Command("api_token"))
+async def cmd_api_token(message: Message):
+    """Личный токен HTTP API: доступ только к своим данным"""
+    user_id = message.from_user.id
+    
+    if not is_user_allowed(user_id):
+        return
+    
+    args = message.text.split()
+    if len(args) > 1 and args[1].lower() == 'off':
+        if revoke_api_token(user_id):
+            await safe_send_message(user_id, "✅ Токен API отозван")
+        else:
+            await safe_send_message(user_id, "❌ Токен API не выдан")
+        return
+    
+    token = issue_api_token(user_id)
+    if token is None:
+        await safe_send_message(user_id, "❌ Не удалось выдать токен API")
+        return
+    await safe_send_message(
+        user_id,
+        f"🔑 Токен API (показывается один раз, прежний больше не действует):\n<code>{token}</code>\n\n"
+        f"Заголовок: Authorization: Bearer &lt;токен&gt;\n"
+        f"Доступно: /api/users/{user_id}/sessions, stats, alerts, keywords\n"
+        f"⚙️ /api_token off - отозвать"
+    )
+
+@dp.message(Command("storage_policy"))
+async def cmd_storage_policy(message: Message):
+    """Политика хранения сообщений"""
+    user_id = message.from_user.id
+    
+    if not is_user_allowed(user_id):
+        return
+    
+    args = message.text.split()
+    if len(args) < 2:
+        text = "🗄️ Политики хранения сообщений:\n\n"
+        for policy, description in STORAGE_POLICIES.items():
+            text += f"• {policy} - {description}\n"
+        text += "\nТекущие политики сессий:\n"
+        for session_id, session_name, _, _ in get_user_sessions(user_id):
+            text += f"🆔 {session_id} • {session_name} • {get_storage_policy(user_id, session_id)}\n"
+        text += "\n⚙️ Для всех сессий: /storage_policy <политика>"
+        text += "\n⚙️ Для одной сессии: /storage_policy <политика> <ID_сессии>"
+        await safe_send_message(user_id, text)
+        return
+    
+    policy = args[1].lower()
+    if policy not in STORAGE_POLICIES:
+        await safe_send_message(user_id, f"❌ Неизвестная политика. Доступны: {', '.join(STORAGE_POLICIES)}")
+        return
+    
+    try:
+        session_id = int(args[2]) if len(args) > 2 else None
+    except ValueError:
+        await safe_send_message(user_id, "❌ Неверный ID. Используйте числовой ID")
+        return
+    
+    if set_storage_policy(user_id, policy, session_id):
+        target = f"сессии ID {session_id}" if session_id is not None else "всех сессий"
+        await safe_send_message(user_id, f"✅ Политика хранения для {target}: {STORAGE_POLICIES[policy]}")
+    else:
+        await safe_send_message(user_id, "❌ Не удалось изменить политику хранения. Проверьте ID")
+
 @dp.message(Command("my_stats"))
 async def cmd_my_stats(message: Message):
     """Статистика пользователя"""
@@ -1043,15 +4031,23 @@ async def cmd_my_stats(message: Message):
         return
     
     try:
+        # Общая статистика (сообщения могут лежать в шарде пользователя)
+        message_conn = connect_message_db(user_id)
+        message_cursor = message_conn.cursor()
+        message_cursor.execute("SELECT COUNT(*) FROM user_messages WHERE user_id = ?", (user_id,))
+        total_messages = message_cursor.fetchone()[0]
+        
+        message_cursor.execute("SELECT COUNT(*) FROM user_messages WHERE user_id = ? AND has_keywords = 1", (user_id,))
+        alert_messages = message_cursor.fetchone()[0]
+        message_conn.close()
+        
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Общая статистика
-        cursor.execute("SELECT COUNT(*) FROM user_messages WHERE user_id = ?", (user_id,))
-        total_messages = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM user_messages WHERE user_id = ? AND has_keywords = 1", (user_id,))
-        alert_messages = cursor.fetchone()[0]
+        # Сообщения, не сохраненные по политике хранения
+        skipped_messages, skipped_alerts = get_skipped_counts(user_id, cursor)
+        total_messages += skipped_messages
+        alert_messages += skipped_alerts
         
         cursor.execute("SELECT COUNT(*) FROM user_keywords WHERE user_id = ?", (user_id,))
         total_keywords = cursor.fetchone()[0]
@@ -1060,7 +4056,7 @@ async def cmd_my_stats(message: Message):
         total_sessions = cursor.fetchone()[0]
         
         # Активные сессии
-        active_sessions = len([key for key in active_clients.keys() if key.startswith(f"{user_id}_")])
+        active_sessions = count_user_sessions(user_id)
         
         conn.close()
         
@@ -1079,6 +4075,81 @@ async def cmd_my_stats(message: Message):
         logger.error(f"❌ Ошибка получения статистики: {e}")
         await safe_send_message(user_id, "❌ Ошибка получения статистики")
 
+def format_alerts_page(alerts):
+    """Текст страницы уведомлений"""
+    text = "🚨 Последние уведомления:\n\n"
+    for i, (timestamp, _, chat_name, username, keywords, message_text, _) in enumerate(alerts, 1):
+        text += f"{i}. 📱 {chat_name}\n"
+        text += f"   👤 {username}\n"
+        text += f"   🔍 {keywords}\n"
+        text += f"   💬 {message_text[:50]}...\n"
+        text += f"   🕒 {timestamp}\n\n"
+    return text[:4000]  # Ограничение длины
+
+def alerts_cursor_data(direction: str, alert: tuple):
+    """callback_data для перехода по страницам: alerts:<направление>:<время>:<id>:<номер в буфере>"""
+    compact_ts = re.sub(r'\D', '', alert[0])
+    return f"alerts:{direction}:{compact_ts}:{alert[1] or 0}:{alert[6]}"
+
+def build_alerts_keyboard(alerts, has_newer: bool, has_older: bool):
+    """Кнопки навигации по истории уведомлений"""
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=alerts_cursor_data('newer', alerts[0])))
+    if has_older:
+        buttons.append(InlineKeyboardButton(text="Старее ➡️", callback_data=alerts_cursor_data('older', alerts[-1])))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+async def top_stats_command(message: Message, kind: str):
+    """Общая часть /top_chats и /top_keywords"""
+    user_id = message.from_user.id
+    
+    if not is_user_allowed(user_id):
+        return
+    
+    args = message.text.split()[1:]
+    try:
+        start_hour, end_hour = parse_stats_period(args)
+    except ValueError:
+        await safe_send_message(
+            user_id,
+            f"❌ Используйте: /{kind} [24h | 7d | 30d | all | YYYY-MM-DD YYYY-MM-DD]\n\nПо умолчанию - 7 дней"
+        )
+        return
+    
+    period = ' - '.join(args) if args else '7d'
+    # Несброшенные агрегаты пишем в БД в потоке event loop, чтобы запрос видел последние сообщения
+    flush_rollups()
+    try:
+        if kind == 'top_chats':
+            rows = await asyncio.to_thread(get_top_chats, user_id, start_hour, end_hour)
+            text = f"🏆 Чаты по уведомлениям ({period}):\n\n"
+            for i, (chat_id, chat_name, messages, alerts) in enumerate(rows, 1):
+                text += f"{i}. 📱 {chat_name} ({chat_id})\n   🚨 {alerts} из 💬 {messages}\n"
+        else:
+            rows = await asyncio.to_thread(get_top_keywords, user_id, start_hour, end_hour)
+            text = f"🏆 Ключевые слова по уведомлениям ({period}):\n\n"
+            for i, (keyword, alerts) in enumerate(rows, 1):
+                text += f"{i}. 🔍 {keyword} - 🚨 {alerts}\n"
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения статистики {kind}: {e}")
+        await safe_send_message(user_id, "❌ Ошибка получения статистики")
+        return
+    
+    if not rows:
+        text += "📭 Нет данных за период"
+    await safe_send_message(user_id, text[:4000])
+
+@dp.message(Command("top_chats"))
+async def cmd_top_chats(message: Message):
+    """Чаты, дающие больше всего уведомлений"""
+    await top_stats_command(message, 'top_chats')
+
+@dp.message(Command("top_keywords"))
+async def cmd_top_keywords(message: Message):
+    """Ключевые слова, дающие больше всего уведомлений"""
+    await top_stats_command(message, 'top_keywords')
+
 @dp.message(Command("my_alerts"))
 async def cmd_my_alerts(message: Message):
     """Последние уведомления пользователя"""
@@ -1088,38 +4159,50 @@ async def cmd_my_alerts(message: Message):
         return
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT chat_name, username, keywords_found, message_text, timestamp 
-            FROM user_messages 
-            WHERE user_id = ? AND has_keywords = 1 
-            ORDER BY timestamp DESC 
-            LIMIT 10
-        ''', (user_id,))
-        
-        alerts = cursor.fetchall()
-        conn.close()
+        alerts, has_older = get_alerts_page(user_id)
         
         if not alerts:
             await safe_send_message(user_id, "📭 У вас пока нет уведомлений")
             return
         
-        text = "🚨 Последние уведомления:\n\n"
-        for i, (chat_name, username, keywords, message_text, timestamp) in enumerate(alerts, 1):
-            clean_message = re.sub(r'\*{2,}', '', message_text)
-            text += f"{i}. 📱 {chat_name}\n"
-            text += f"   👤 {username}\n"
-            text += f"   🔍 {keywords}\n"
-            text += f"   💬 {clean_message[:50]}...\n"
-            text += f"   🕒 {timestamp}\n\n"
-        
-        await safe_send_message(user_id, text[:4000])  # Ограничение длины
+        keyboard = build_alerts_keyboard(alerts, has_newer=False, has_older=has_older)
+        await safe_send_message(user_id, format_alerts_page(alerts), reply_markup=keyboard)
         
     except Exception as e:
         logger.error(f"❌ Ошибка получения уведомлений: {e}")
         await safe_send_message(user_id, "❌ Ошибка получения уведомлений")
 
+@dp.callback_query(F.data.startswith("alerts:"))
+async def cb_alerts_page(callback: CallbackQuery):
+    """Переход по страницам истории уведомлений"""
+    user_id = callback.from_user.id
+    
+    if not is_user_allowed(user_id):
+        await callback.answer("❌ Доступ запрещен")
+        return
+    
+    try:
+        _, direction, compact_ts, alert_id, *seq = callback.data.split(':')
+        timestamp = datetime.strptime(compact_ts, '%Y%m%d%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
+        # Кнопки, отправленные до появления номера в буфере, листают через БД
+        cursor_key = (timestamp, int(alert_id), int(seq[0]) if seq else 0)
+        alerts, has_more = get_alerts_page(user_id, direction, cursor_key)
+        
+        if not alerts:
+            await callback.answer("📭 Больше уведомлений нет")
+            return
+        
+        if direction == 'older':
+            keyboard = build_alerts_keyboard(alerts, has_newer=True, has_older=has_more)
+        else:
+            keyboard = build_alerts_keyboard(alerts, has_newer=has_more, has_older=True)
+        await callback.message.edit_text(format_alerts_page(alerts), reply_markup=keyboard, parse_mode=None)
+        await callback.answer()
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка перехода по уведомлениям: {e}")
+        await callback.answer("❌ Ошибка получения уведомлений")
+
 @dp.message(Command("status"))
 async def cmd_status(message: Message):
     """Статус мониторинга"""
@@ -1128,55 +4211,706 @@ async def cmd_status(message: Message):
     if not is_user_allowed(user_id):
         return
     
-    active_user_sessions = len([key for key in active_clients.keys() if key.startswith(f"{user_id}_")])
-    total_active_sessions = len(active_clients)
+    active_user_sessions = count_user_sessions(user_id)
+    total_active_sessions = len(session_accounts)
+    lease_owners = get_session_lease_owners()
     
     text = (
         f"📡 Статус мониторинга:\n\n"
         f"🟢 Ваших активных сессий: {active_user_sessions}\n"
-        f"🌐 Всего активных сессий: {total_active_sessions}\n"
+        f"🌐 Всего активных сессий: {max(total_active_sessions, len(lease_owners))}\n"
+        f"🖥️ Реплика: {REPLICA_ID} ({total_active_sessions} сессий, {len(active_clients)} подключений), "
+        f"реплик с сессиями: {len(set(lease_owners.values()))}\n"
+        f"⚙️ Уровень нагрузки: {overload_governor.level} ({OVERLOAD_LEVELS[overload_governor.level]})\n"
         f"👤 Ваш ID: {user_id}"
     )
     
     await safe_send_message(user_id, text)
 
-# Запуск всех сессий при старте бота
-async def start_all_sessions():
-    """Запуск всех активных сессий при старте бота"""
+# Распределение сессий между репликами
+async def update_polling_leadership(is_leader: bool):
+    """Поллинг бота ведет только одна реплика - держатель аренды bot_polling"""
+    global polling_task
+    is_polling = polling_task is not None and not polling_task.done()
+    if is_leader and not is_polling:
+        logger.info(f"👑 Реплика {REPLICA_ID} стала лидером и запускает поллинг")
+        await bot.delete_webhook(drop_pending_updates=True)
+        polling_task = asyncio.create_task(
+            dp.start_polling(bot, handle_signals=False, close_bot_session=False)
+        )
+    elif not is_leader and is_polling:
+        logger.warning(f"⚠️ Реплика {REPLICA_ID} потеряла лидерство, поллинг остановлен")
+        await dp.stop_polling()
+        polling_task = None
+
+async def rebalance_sessions():
+    """Один раунд: продление аренд, остановка потерянных сессий, захват своей доли свободных"""
+    now = time.time()
+    owned, live_replicas = renew_leases(now)
+    sync_rule_versions()
+    sync_user_caches()
+    await update_polling_leadership('bot_polling' in owned or acquire_lease('bot_polling', now))
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, user_id, session_name, session_string FROM user_sessions WHERE is_active = 1")
+    active_sessions = {row[0]: row for row in cursor.fetchall()}
+    conn.close()
+    
+    owned_sessions = {int(name.split(':')[1]) for name in owned if name.startswith('session:')}
+    for session_id in owned_sessions - set(active_sessions):
+        release_lease(f"session:{session_id}")
+    owned_sessions &= set(active_sessions)
+    # Аренды аккаунтов без подключения (например, после рестарта с тем же REPLICA_ID) отпускаем
+    for name in owned:
+        if name.startswith('account:') and int(name.split(':')[1]) not in active_clients:
+            release_lease(name)
+    
+    # Останавливаем сессии, аренду которых забрали или которые выключили
+    running_sessions = set()
+    for user_id, session_id in list(session_accounts):
+        if session_id in owned_sessions:
+            running_sessions.add(session_id)
+        else:
+            logger.warning(f"⚠️ Сессия {user_id}_{session_id} больше не закреплена за репликой {REPLICA_ID}, останавливаем")
+            await stop_user_session(user_id, session_id)
+    
+    # Справедливая доля реплики; лишнее отдаем, чтобы новая реплика могла забрать сессии
+    fair_share = math.ceil(len(active_sessions) / live_replicas)
+    for session_id in sorted(owned_sessions, reverse=True)[:max(len(owned_sessions) - fair_share, 0)]:
+        user_id = active_sessions[session_id][1]
+        logger.info(f"🔁 Реплика {REPLICA_ID} отдает сессию {session_id} для балансировки")
+        await stop_user_session(user_id, session_id)
+        release_lease(f"session:{session_id}")
+        owned_sessions.discard(session_id)
+    
+    # Запускаем свои, но не запущенные сессии (например, после рестарта с тем же REPLICA_ID) и добираем долю
+    last_renewal = now
+    for session_id, user_id, session_name, session_string in active_sessions.values():
+        # Сессию, которую сейчас запускает /start_session, не трогаем: ее аренду держит тот запуск
+        if session_id in running_sessions or session_id in starting_sessions:
+            continue
+        # Долгий раунд запусков не должен пережить свои же аренды
+        if time.time() - last_renewal > LEASE_TTL / 3:
+            last_renewal = time.time()
+            renew_leases(last_renewal)
+        if session_id not in owned_sessions:
+            if len(owned_sessions) >= fair_share:
+                continue
+            if now - session_start_failures.get(session_id, 0) < SESSION_RETRY_INTERVAL:
+                continue
+            if not acquire_lease(f"session:{session_id}", now):
+                continue
+        # Миграция сессии и повторы после ошибки проходят без сообщений пользователю
+        if await start_user_session(user_id, session_id, session_name, session_string, quiet=True):
+            owned_sessions.add(session_id)
+            session_start_failures.pop(session_id, None)
+            await asyncio.sleep(2)  # Задержка между запусками сессий
+        else:
+            session_start_failures[session_id] = now
+            owned_sessions.discard(session_id)
+            release_lease(f"session:{session_id}")
+            logger.error(f"❌ Невалидная сессия {session_name} для {user_id}")
+
+async def session_lease_loop():
+    """Пульс реплики: периодическая перебалансировка сессий по арендам в общей БД"""
+    logger.info(f"🖥️ Реплика {REPLICA_ID} запущена (аренда {LEASE_TTL} сек.)")
+    while True:
+        try:
+            await rebalance_sessions()
+        except Exception as e:
+            logger.error(f"❌ Ошибка перебалансировки сессий: {e}")
+        await asyncio.sleep(LEASE_HEARTBEAT_INTERVAL)
+
+# HTTP сервер для проверки здоровья
+async def health_check(request):
+    return web.Response(
+        text=f"Monitoring Bot is running! Active sessions: {len(session_accounts)}, connections: {len(active_clients)}. "
+             f"Overload level: {overload_governor.level} ({OVERLOAD_LEVELS[overload_governor.level]})"
+    )
+
+# Диагностика памяти
+def get_rss_mb():
+    """Текущий RSS процесса в МБ (Linux /proc, иначе пиковый RSS)"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def estimate_container_bytes(container, sample_size: int = 100):
+    """Приблизительный размер контейнера: сам контейнер + средний размер элемента по выборке"""
+    size = sys.getsizeof(container)
+    if not container:
+        return size
+    items = container.items() if isinstance(container, dict) else container
+    sample = list(islice(items, sample_size))
+    item_size = sum(
+        sum(sys.getsizeof(part) for part in item) if isinstance(item, tuple) else sys.getsizeof(item)
+        for item in sample
+    ) / len(sample)
+    return int(size + item_size * len(container))
+
+def get_cache_sizes():
+    """Размеры внутренних кэшей и очередей процесса"""
+    return {
+        'user_last_message': len(user_last_message),
+        'recent_alerts': sum(len(buffer) for buffer in recent_alerts.values()),
+        'storage_policies': len(storage_policies),
+        'pending_message_counters': len(pending_message_counters),
+        'pending_chat_rollups': len(pending_chat_rollups),
+        'pending_keyword_rollups': len(pending_keyword_rollups),
+        'session_chat_filters': len(session_chat_filters),
+        'user_rule_sets': len(user_rule_sets),
+        'fuzzy_index_deletes': sum(len(rule_set.fuzzy_index.deletes) for rule_set in user_rule_sets.values()),
+        'chat_refs': len(chat_refs),
+        'sender_refs': len(sender_refs),
+        'match_cache': len(match_cache.entries),
+        'lemma_cache': lemmatize_token.cache_info().currsize,
+        'scheduler_queue': message_scheduler.depth(),
+        'pending_alerts': sum(len(lines) for lines in overload_governor.pending_alerts.values()),
+        'api_response_cache': len(api_response_cache),
+        'shard_handles': len(shard_handles.handles),
+        'session_start_failures': len(session_start_failures),
+    }
+
+def get_client_memory():
+    """Приблизительная память клиентов Telethon: кэши сущностей и сущности сессии"""
+    clients = {}
+    for account_id, client in active_clients.items():
+        entity_cache = getattr(getattr(client, '_mb_entity_cache', None), 'hash_map', {})
+        session_entities = getattr(client.session, '_entities', ())
+        clients[str(account_id)] = {
+            'sessions': [f"{user_id}_{session_id}" for user_id, session_id in account_subscribers.get(account_id, {})],
+            'entity_cache': len(entity_cache),
+            'session_entities': len(session_entities),
+            'approx_kb': round((estimate_container_bytes(entity_cache) + estimate_container_bytes(session_entities)) / 1024, 1),
+        }
+    return clients
+
+def get_task_counts(top: int = 10):
+    """Число задач asyncio по имени корутины (ищем неотслеживаемые задачи)"""
+    counts = {}
+    for task in asyncio.all_tasks():
+        name = getattr(task.get_coro(), '__qualname__', type(task.get_coro()).__name__)
+        counts[name] = counts.get(name, 0) + 1
+    return dict(sorted(counts.items(), key=lambda item: -item[1])[:top])
+
+def format_memory_stat(stat):
+    frame = stat.traceback[0]
+    return {
+        'site': f"{frame.filename}:{frame.lineno}",
+        'size_kb': round(stat.size / 1024, 1),
+        'count': stat.count,
+        'size_diff_kb': round(getattr(stat, 'size_diff', 0) / 1024, 1),
+        'count_diff': getattr(stat, 'count_diff', 0),
+    }
+
+def take_memory_report(top: int):
+    """Снимок tracemalloc: топ мест выделения и разница с предыдущим снимком"""
+    global memory_snapshot
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    report = {
+        'traced_mb': round(tracemalloc.get_traced_memory()[0] / 1024 / 1024, 1),
+        'top': [format_memory_stat(stat) for stat in snapshot.statistics('lineno')[:top]],
+    }
+    if memory_snapshot is not None:
+        report['diff'] = [format_memory_stat(stat) for stat in snapshot.compare_to(memory_snapshot, 'lineno')[:top]]
+    memory_snapshot = snapshot
+    return report
+
+async def admin_memory_handler(request):
+    """Диагностика памяти: RSS, кэши, клиенты, задачи и снимки tracemalloc (каждый вызов сравнивается с прошлым)"""
+    if not check_api_token(request):
+        return web.Response(status=403, text="Forbidden")
+    
+    try:
+        top = int(request.query.get('top', 20))
+    except ValueError:
+        return web.Response(status=400, text="top must be an integer")
+    
+    result = {
+        'rss_mb': round(get_rss_mb(), 1),
+        'budget_mb': MEMORY_BUDGET_MB or None,
+        'caches': get_cache_sizes(),
+        'clients': get_client_memory(),
+        'tasks': get_task_counts(),
+    }
+    if request.query.get('trace') == '1' and not tracemalloc.is_tracing():
+        tracemalloc.start(MEMORY_TRACE_FRAMES or 1)
+        logger.info("🧠 tracemalloc включен по запросу /admin/memory")
+    if tracemalloc.is_tracing():
+        # Сравнение снимков заметно нагружает CPU - выполняем вне event loop
+        result['tracemalloc'] = await asyncio.to_thread(take_memory_report, top)
+    else:
+        result['tracemalloc'] = 'off (включить: ?trace=1 или MEMORY_TRACE_FRAMES)'
+    return web.json_response(result)
+
+async def memory_watch_loop():
+    """Очистка устаревших записей флуд-контроля и предупреждение о превышении MEMORY_BUDGET_MB"""
+    while True:
+        await asyncio.sleep(MEMORY_CHECK_INTERVAL)
+        try:
+            # Запись нужна только на 0.3 секунды между сообщениями одному пользователю
+            expired = time.time() - 60
+            for user_id in [uid for uid, sent_at in user_last_message.items() if sent_at < expired]:
+                del user_last_message[user_id]
+            
+            rss_mb = get_rss_mb()
+            if MEMORY_BUDGET_MB and rss_mb > MEMORY_BUDGET_MB:
+                largest = sorted(get_cache_sizes().items(), key=lambda item: -item[1])[:5]
+                logger.warning(
+                    f"⚠️ Память {rss_mb:.0f} МБ превышает бюджет {MEMORY_BUDGET_MB} МБ; "
+                    f"крупнейшие кэши: {', '.join(f'{name}={size}' for name, size in largest)}"
+                )
+        except Exception as e:
+            logger.error(f"❌ Ошибка проверки памяти: {e}")
+
+async def metrics_handler(request):
+    """Внутренние метрики процесса в JSON"""
+    return web.json_response({
+        'replica_id': REPLICA_ID,
+        'active_sessions': len(session_accounts),
+        'connections': len(active_clients),
+        'match_cache': match_cache.stats(),
+        'message_shards': shard_handles.stats(),
+        'scheduler': message_scheduler.stats(),
+        'overload': overload_governor.stats(),
+        'matcher': process_matcher.stats() if process_matcher is not None else {'mode': 'inline'},
+        'lemma_cache': {'backend': MORPH_BACKEND, **lemmatize_token.cache_info()._asdict()},
+    })
+
+# Потоковая выгрузка сообщений и уведомлений
+EXPORT_COLUMNS = (
+    'id', 'user_id', 'session_id', 'chat_id', 'chat_name', 'username',
+    'message_type', 'has_keywords', 'keywords_found', 'message_text', 'timestamp'
+)
+
+def get_bearer_token(request):
+    """Токен из заголовка Authorization: параметры URL попадают в логи прокси и историю браузера"""
+    auth_header = request.headers.get('Authorization', '')
+    return auth_header[7:] if auth_header.startswith('Bearer ') else None
+
+def check_api_token(request):
+    """Проверка админского токена HTTP API (выгрузки и данные всех пользователей)"""
+    token = get_bearer_token(request)
+    if not API_TOKEN or token is None:
+        return False
+    return hmac.compare_digest(token.encode('utf-8'), API_TOKEN.encode('utf-8'))
+
+def hash_api_token(token: str):
+    """Хэш личного токена API для хранения в БД"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def issue_api_token(user_id: int):
+    """Новый личный токен API пользователя (прежний перестает действовать)"""
+    try:
+        token = secrets.token_urlsafe(24)
+        conn = get_db_connection()
+        conn.execute("INSERT OR REPLACE INTO api_tokens (user_id, token_hash) VALUES (?, ?)",
+                     (user_id, hash_api_token(token)))
+        conn.commit()
+        conn.close()
+        logger.info(f"🔑 Пользователь {user_id} получил новый токен API")
+        return token
+    except Exception as e:
+        logger.error(f"❌ Ошибка выдачи токена API для {user_id}: {e}")
+        return None
+
+def revoke_api_token(user_id: int):
+    """Отзыв личного токена API"""
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT user_id FROM user_sessions WHERE is_active = 1")
-        users = cursor.fetchall()
-        
-        for (user_id,) in users:
-            cursor.execute("SELECT id, session_name, session_string FROM user_sessions WHERE user_id = ? AND is_active = 1", (user_id,))
-            sessions = cursor.fetchall()
-            
-            for session_id, session_name, session_string in sessions:
-                # Проверяем сессию перед запуском
-                is_valid, _ = await test_session(session_string)
-                if is_valid:
-                    await start_user_session(user_id, session_id, session_name, session_string)
-                    await asyncio.sleep(2)  # Задержка между запусками сессий
-                else:
-                    logger.error(f"❌ Невалидная сессия {session_name} для {user_id}")
-        
+        cursor.execute("DELETE FROM api_tokens WHERE user_id = ?", (user_id,))
+        revoked = cursor.rowcount > 0
+        conn.commit()
         conn.close()
-        logger.info("✅ Все валидные сессии запущены")
-        
+        return revoked
     except Exception as e:
-        logger.error(f"❌ Ошибка запуска сессий при старте: {e}")
+        logger.error(f"❌ Ошибка отзыва токена API для {user_id}: {e}")
+        return False
 
-# HTTP сервер для проверки здоровья
-async def health_check(request):
-    return web.Response(text=f"Monitoring Bot is running! Active sessions: {len(active_clients)}")
+def get_api_token_user(token: str):
+    """Владелец личного токена API (None - токен не выдан или отозван)"""
+    conn = get_db_connection()
+    row = conn.execute("SELECT user_id FROM api_tokens WHERE token_hash = ?", (hash_api_token(token),)).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def parse_export_datetime(value: str):
+    """Разбор границы периода: unix-время или ISO-дата (без часового пояса - UTC)"""
+    if value.isdigit():
+        return datetime.fromtimestamp(int(value), timezone.utc)
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+def parse_export_time(value: str):
+    """Граница периода в формате SQLite"""
+    return parse_export_datetime(value).strftime('%Y-%m-%d %H:%M:%S')
+
+def parse_export_epoch(value: str):
+    """Граница периода в unix-времени (для архива)"""
+    return parse_export_datetime(value).timestamp()
+
+def build_archive_filter(query):
+    """Параметры чтения архива: (since, until, фильтр записи)"""
+    since = parse_export_epoch(query['since']) if query.get('since') else None
+    until = parse_export_epoch(query['until']) if query.get('until') else None
+    user_id = int(query['user_id']) if query.get('user_id') else None
+    chat_id = query.get('chat_id')
+    keyword = query.get('keyword', '').lower() or None
+    
+    def accepts(record):
+        return (
+            (user_id is None or record['user_id'] == user_id)
+            and (chat_id is None or record['chat_id'] == chat_id)
+            and (keyword is None or export_row_contains(record['keywords_found'], record['message_text'],
+                                                        TEXT_CODEC_PLAIN, keyword))
+        )
+    
+    return since, until, accepts
+
+def iter_archive_rows(since, until, accepts):
+    """Записи архива в виде строк выгрузки (id нет, текст не сжат)"""
+    for record in iter_archive_records(since, until):
+        if not accepts(record):
+            continue
+        yield (
+            None, record['user_id'], record['session_id'], record['chat_id'], record['chat_name'],
+            record['username'], record['message_type'], int(record['has_keywords']), record['keywords_found'],
+            record['message_text'], datetime.fromtimestamp(record['ts'], timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+            TEXT_CODEC_PLAIN
+        )
+
+def build_export_query(query, alerts_only: bool):
+    """Построение SQL-запроса выгрузки по параметрам запроса"""
+    conditions = []
+    params = []
+    if alerts_only:
+        conditions.append("has_keywords = 1")
+    if query.get('user_id'):
+        conditions.append("user_id = ?")
+        params.append(int(query['user_id']))
+    if query.get('chat_id'):
+        conditions.append("chat_id = ?")
+        params.append(query['chat_id'])
+    if query.get('since'):
+        conditions.append("timestamp >= ?")
+        params.append(parse_export_time(query['since']))
+    if query.get('until'):
+        conditions.append("timestamp < ?")
+        params.append(parse_export_time(query['until']))
+    if query.get('keyword'):
+        # Текст может быть сжат, поэтому проверка - функция соединения, а не LIKE
+        conditions.append("export_contains(keywords_found, message_text, text_codec, ?)")
+        params.append(query['keyword'].lower())
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    # Сортировка по id идёт по rowid без временного B-дерева, поэтому память не растёт с объёмом выгрузки
+    sql = f"SELECT {', '.join(EXPORT_COLUMNS)}, text_codec FROM user_messages_view {where} ORDER BY id"
+    return sql, params
+
+def export_row_contains(keywords_found, message_text, text_codec, keyword: str):
+    """Фильтр выгрузки по слову: найденные ключевые слова или текст сообщения (SQL-функция export_contains)"""
+    if keyword in (keywords_found or '').lower():
+        return True
+    return keyword in (decode_message_text(message_text, text_codec) or '').lower()
+
+def format_export_rows(rows, export_format: str):
+    """Сериализация пачки строк выгрузки в CSV или JSONL"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if export_format == 'csv' else None
+    for *row, text_codec in rows:
+        row[9] = decode_message_text(row[9], text_codec)
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False))
+            buffer.write('\n')
+    return buffer.getvalue().encode('utf-8')
+
+async def export_handler(request):
+    """Потоковая выгрузка user_messages в CSV/JSONL с постоянным расходом памяти"""
+    if not check_api_token(request):
+        return web.Response(status=403, text="Forbidden")
+
+    kind = request.match_info.get('kind')
+    export_format = request.query.get('format', 'csv')
+    if export_format not in ('csv', 'jsonl'):
+        return web.Response(status=400, text="format must be csv or jsonl")
+    if kind == 'archive' and message_archive is None:
+        return web.Response(status=404, text="Archive backend is disabled")
+
+    try:
+        if kind == 'archive':
+            archive_filter = build_archive_filter(request.query)
+        else:
+            sql, params = build_export_query(request.query, kind == 'alerts')
+    except ValueError as e:
+        return web.Response(status=400, text=f"Bad parameter: {e}")
+
+    filename = f"{kind}.{export_format}"
+    response = web.StreamResponse(headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+    response.content_type = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    response.charset = 'utf-8'
+    response.enable_chunked_encoding()
+    if request.query.get('gzip') in ('1', 'true'):
+        response.enable_compression(web.ContentCoding.gzip)
+    await response.prepare(request)
+
+    if export_format == 'csv':
+        header_buffer = io.StringIO()
+        csv.writer(header_buffer).writerow(EXPORT_COLUMNS)
+        await response.write(header_buffer.getvalue().encode('utf-8'))
+
+    conn = cursor = None
+    try:
+        if kind == 'archive':
+            # Архив читается через mmap генератором, в памяти только одна пачка
+            archive_rows = iter_archive_rows(*archive_filter)
+            fetch_chunk = lambda: list(islice(archive_rows, EXPORT_CHUNK_SIZE))
+        else:
+            # Без фильтра по пользователю шарды выгружаются по очереди
+            user_id = request.query.get('user_id')
+            shard_keys = [message_shard_key(int(user_id))] if user_id else list_message_shards()
+            # Шард появляется при первой записи: у пользователя без сообщений его нет, и создавать его не нужно
+            shard_keys = [key for key in shard_keys if os.path.exists(message_shard_path(key))]
+            
+            def fetch_chunk():
+                nonlocal conn, cursor
+                while True:
+                    if conn is None:
+                        if not shard_keys:
+                            return []
+                        conn = sqlite3.connect(f"file:{message_shard_path(shard_keys.pop(0))}?mode=ro", uri=True,
+                                               check_same_thread=False)
+                        conn.create_function('export_contains', 4, export_row_contains, deterministic=True)
+                        # Курсор SQLite читает строки по мере выборки, в памяти только одна пачка
+                        cursor = conn.execute(sql, params)
+                    rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                    if rows:
+                        return rows
+                    conn.close()
+                    conn = None
+        exported = 0
+        while True:
+            rows = await asyncio.to_thread(fetch_chunk)
+            if not rows:
+                break
+            chunk = format_export_rows(rows, export_format)
+            if chunk:
+                # write() ждёт опустошения буфера сокета - медленный клиент притормаживает чтение из БД
+                await response.write(chunk)
+            exported += len(rows)
+        await response.write_eof()
+        logger.info(f"📤 Выгрузка {filename} завершена: выгружено {exported} строк")
+    except Exception as e:
+        logger.error(f"❌ Ошибка выгрузки {filename}: {e}")
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return response
+
+# Read-only JSON API для дашбордов
+class ReadConnectionPool:
+    """Пул соединений только для чтения по файлам БД (основная БД и шарды)"""
+    
+    def __init__(self, size: int):
+        self.size = size
+        self.idle = {}
+        self.lock = threading.Lock()
+    
+    @contextlib.contextmanager
+    def connection(self, path: str):
+        with self.lock:
+            idle = self.idle.setdefault(path, [])
+            conn = idle.pop() if idle else None
+        if conn is None:
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        try:
+            yield conn
+        finally:
+            with self.lock:
+                idle = self.idle[path]
+                if len(idle) < self.size:
+                    idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+read_pool = ReadConnectionPool(API_POOL_SIZE)
+# Ответы API: (вид, user_id, параметры) -> (истекает, etag, тело)
+api_response_cache = {}
+
+def api_sessions(user_id: int, query):
+    """Сессии пользователя без строк сессий"""
+    with read_pool.connection(message_shard_path('')) as conn:
+        rows = conn.execute('''
+            SELECT s.id, s.session_name, s.is_active, s.storage_policy, s.chat_include, s.chat_exclude, s.chat_types,
+                   l.owner
+            FROM user_sessions s
+            LEFT JOIN leases l ON l.name = 'session:' || s.id AND l.expires_at >= ?
+            WHERE s.user_id = ?
+            ORDER BY s.id
+        ''', (time.time(), user_id)).fetchall()
+    return {'sessions': [
+        {
+            'id': session_id, 'name': name, 'is_active': bool(is_active), 'storage_policy': policy,
+            'chat_include': chat_include, 'chat_exclude': chat_exclude, 'chat_types': chat_types, 'replica': owner,
+        }
+        for session_id, name, is_active, policy, chat_include, chat_exclude, chat_types, owner in rows
+    ]}
+
+def api_stats(user_id: int, query):
+    """Статистика пользователя, как в /my_stats"""
+    total_messages = alert_messages = 0
+    message_path = message_shard_path(message_shard_key(user_id))
+    # Шард создается при первой записи - до нее сообщений у пользователя нет
+    if os.path.exists(message_path):
+        with read_pool.connection(message_path) as conn:
+            total_messages, alert_messages = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(has_keywords = 1), 0) FROM user_messages WHERE user_id = ?", (user_id,)
+            ).fetchone()
+    with read_pool.connection(message_shard_path('')) as conn:
+        # Вместе с еще не сброшенными счетчиками, как в /my_stats
+        skipped_messages, skipped_alerts = get_skipped_counts(user_id, conn.cursor())
+        keywords = conn.execute("SELECT COUNT(*) FROM user_keywords WHERE user_id = ?", (user_id,)).fetchone()[0]
+        exceptions = conn.execute("SELECT COUNT(*) FROM user_exceptions WHERE user_id = ?", (user_id,)).fetchone()[0]
+        sessions, active_sessions = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(is_active = 1), 0) FROM user_sessions WHERE user_id = ?", (user_id,)
+        ).fetchone()
+    return {
+        'stored_messages': total_messages,
+        'stored_alerts': alert_messages,
+        'skipped_messages': skipped_messages,
+        'skipped_alerts': skipped_alerts,
+        'keywords': keywords,
+        'exceptions': exceptions,
+        'sessions': sessions,
+        'active_sessions': active_sessions,
+    }
+
+def api_alerts(user_id: int, query):
+    """Уведомления пользователя, новые сверху; следующая страница - по курсору before_ts/before_id"""
+    limit = min(max(int(query.get('limit', 20)), 1), API_ALERTS_LIMIT)
+    condition, params = "", ()
+    if query.get('before_ts'):
+        condition, params = "AND (timestamp, id) < (?, ?)", (query['before_ts'], int(query.get('before_id', 0)))
+    message_path = message_shard_path(message_shard_key(user_id))
+    if not os.path.exists(message_path):
+        return {'alerts': []}
+    with read_pool.connection(message_path) as conn:
+        rows = conn.execute(f'''
+            SELECT id, timestamp, session_id, chat_id, chat_name, username, keywords_found, message_text, text_codec
+            FROM user_messages_view
+            WHERE user_id = ? AND has_keywords = 1 {condition}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        ''', (user_id, *params, limit)).fetchall()
+    alerts = [
+        {
+            'id': row_id, 'timestamp': timestamp, 'session_id': session_id, 'chat_id': chat_id,
+            'chat_name': chat_name, 'username': username, 'keywords': keywords_found,
+            'text': decode_message_text(text, codec),
+        }
+        for row_id, timestamp, session_id, chat_id, chat_name, username, keywords_found, text, codec in rows
+    ]
+    result = {'alerts': alerts}
+    if len(alerts) == limit:
+        result['next'] = {'before_ts': alerts[-1]['timestamp'], 'before_id': alerts[-1]['id']}
+    return result
+
+def api_keywords(user_id: int, query):
+    """Ключевые слова, исключения и слова по чатам"""
+    with read_pool.connection(message_shard_path('')) as conn:
+        keywords = conn.execute(
+            "SELECT id, keyword FROM user_keywords WHERE user_id = ? AND is_active = 1 ORDER BY id", (user_id,)
+        ).fetchall()
+        exceptions = conn.execute(
+            "SELECT id, exception_word FROM user_exceptions WHERE user_id = ? AND is_active = 1 ORDER BY id", (user_id,)
+        ).fetchall()
+        chat_keywords = conn.execute(
+            "SELECT id, chat_id, keyword, is_exception FROM user_chat_keywords WHERE user_id = ? ORDER BY chat_id, id",
+            (user_id,)
+        ).fetchall()
+    return {
+        'keywords': [{'id': entry_id, 'keyword': keyword} for entry_id, keyword in keywords],
+        'exceptions': [{'id': entry_id, 'exception': word} for entry_id, word in exceptions],
+        'chat_keywords': [
+            {'id': entry_id, 'chat_id': chat_id, 'keyword': keyword, 'is_exception': bool(is_exception)}
+            for entry_id, chat_id, keyword, is_exception in chat_keywords
+        ],
+    }
+
+API_VIEWS = {
+    'sessions': api_sessions,
+    'stats': api_stats,
+    'alerts': api_alerts,
+    'keywords': api_keywords,
+}
+
+async def api_handler(request):
+    """GET /api/users/{id}/{sessions|stats|alerts|keywords}: JSON с ETag и коротким кэшем.
+
+    Админский API_TOKEN открывает данные всех пользователей, личный токен (/api_token) - только свои.
+    """
+    kind = request.match_info['kind']
+    user_id = int(request.match_info['user_id'])
+    if not check_api_token(request):
+        token = get_bearer_token(request)
+        try:
+            token_user = await asyncio.to_thread(get_api_token_user, token) if token else None
+        except Exception as e:
+            logger.error(f"❌ Ошибка проверки токена API: {e}")
+            return web.Response(status=500, text="Internal error")
+        if token_user != user_id:
+            return web.Response(status=403, text="Forbidden")
+    
+    query = dict(request.query)
+    cache_key = (kind, user_id, tuple(sorted(query.items())))
+    
+    now = time.monotonic()
+    cached = api_response_cache.get(cache_key)
+    if cached is None or cached[0] < now:
+        try:
+            data = await asyncio.to_thread(API_VIEWS[kind], user_id, query)
+        except ValueError as e:
+            return web.Response(status=400, text=f"Bad parameter: {e}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка API {kind} для {user_id}: {e}")
+            return web.Response(status=500, text="Internal error")
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        cached = api_response_cache[cache_key] = (now + API_CACHE_TTL, etag, body)
+        # Истекшие ответы удаляем при записи, чтобы кэш не рос с числом опрашиваемых пользователей
+        for key in [key for key, entry in api_response_cache.items() if entry[0] < now]:
+            del api_response_cache[key]
+    
+    _, etag, body = cached
+    headers = {'ETag': etag, 'Cache-Control': f'private, max-age={int(API_CACHE_TTL)}'}
+    if etag in {tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')}:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type='application/json', charset='utf-8', headers=headers)
 
 async def start_http_server():
     """Запуск HTTP сервера для Railway"""
     app = web.Application()
     app.router.add_get('/', health_check)
     app.router.add_get('/health', health_check)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/admin/memory', admin_memory_handler)
+    app.router.add_get(r'/api/users/{user_id:\d+}/{kind:sessions|stats|alerts|keywords}', api_handler)
+    app.router.add_get('/export/{kind:messages|alerts|archive}', export_handler)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', PORT)
@@ -1186,24 +4920,26 @@ async def start_http_server():
 async def main():
     """Основная функция запуска"""
     logger.info("🚀 Запуск системы мониторинга...")
+    if MEMORY_TRACE_FRAMES:
+        tracemalloc.start(MEMORY_TRACE_FRAMES)
     
     # Инициализация БД
     init_db()
+    init_message_archive()
+    init_process_matcher()
     
     # Запуск HTTP сервера
     await start_http_server()
     
-    # Запуск бота
-    await bot.delete_webhook(drop_pending_updates=True)
-    
-    # Запуск всех сессий пользователей с задержкой
-    await asyncio.sleep(3)  # Даем боту время запуститься
-    asyncio.create_task(start_all_sessions())
+    asyncio.create_task(flush_message_counters_loop())
+    message_scheduler.start()
+    asyncio.create_task(overload_governor.run())
+    asyncio.create_task(memory_watch_loop())
     
     logger.info("✅ Бот запущен!")
     
-    # Запускаем поллинг
-    await dp.start_polling(bot)
+    # Запускаем распределение сессий; поллинг запускает реплика-лидер
+    await session_lease_loop()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py читает окружение при импорте и создает файлы БД в текущей папке
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+os.chdir(tempfile.mkdtemp(prefix='monitoring-tests-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Чистая БД в отдельной папке и пустые кэши процесса"""
+    monkeypatch.chdir(tmp_path)
+    main.init_db()
+    main.user_rule_sets.clear()
+    main.storage_policies.clear()
+    main.session_chat_filters.clear()
+    main.user_cache_versions.clear()
+    main.user_alert_versions.clear()
+    main.recent_alerts_stale.clear()
+    main.user_rule_versions.clear()
+    main.recent_alerts.clear()
+    main.recent_alerts_seeded.clear()
+    main.pending_message_counters.clear()
+    main.pending_chat_rollups.clear()
+    main.pending_keyword_rollups.clear()
+    main.chat_refs.clear()
+    main.sender_refs.clear()
+    # Соединения открыты по относительным путям - у каждого теста свои
+    monkeypatch.setattr(main, 'shard_handles', main.ShardHandles(4))
+    monkeypatch.setattr(main, 'read_pool', main.ReadConnectionPool(2))
+    yield tmp_path
+
+
+@pytest.fixture
+def allowed_user(db):
+    """Пользователь из белого списка"""
+    user_id = 1001
+    conn = main.get_db_connection()
+    conn.execute("INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, 'user', 'User')", (user_id,))
+    conn.execute("INSERT OR IGNORE INTO allowed_users (user_id) VALUES (?)", (user_id,))
+    conn.commit()
+    conn.close()
+    return user_id
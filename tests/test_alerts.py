@@ -0,0 +1,60 @@
+import main
+
+TS = '2026-01-01 12:00:00'
+
+
+def alert(n, message_id=None, timestamp=TS):
+    return (timestamp, message_id, 'chat', 'u', 'x', f'alert {n}')
+
+
+def texts(page):
+    return [entry[5] for entry in page]
+
+
+def walk_older(user_id):
+    """Все страницы /my_alerts от новых к старым"""
+    page, has_older = main.get_alerts_page(user_id)
+    seen = texts(page)
+    while has_older:
+        page, has_older = main.get_alerts_page(user_id, 'older', main_cursor(page[-1]))
+        seen += texts(page)
+    return seen
+
+
+def main_cursor(entry):
+    return entry[0], entry[1] or 0, entry[6]
+
+
+def test_exactly_one_page_has_no_older_button(db, monkeypatch):
+    monkeypatch.setattr(main, 'shard_handles', main.ShardHandles(4))
+    for n in range(main.ALERTS_PAGE_SIZE):
+        main.remember_alert(1, alert(n))
+    page, has_older = main.get_alerts_page(1)
+    assert len(page) == main.ALERTS_PAGE_SIZE and not has_older
+
+
+def test_unsaved_alerts_in_same_second_are_not_skipped(db, monkeypatch):
+    monkeypatch.setattr(main, 'shard_handles', main.ShardHandles(4))
+    for n in range(12):
+        main.remember_alert(1, alert(n))
+    assert walk_older(1) == [f'alert {n}' for n in reversed(range(12))]
+
+    page, _ = main.get_alerts_page(1)
+    older, _ = main.get_alerts_page(1, 'older', main_cursor(page[-1]))
+    newer, has_newer = main.get_alerts_page(1, 'newer', main_cursor(older[0]))
+    assert texts(newer) == texts(page) and not has_newer
+
+
+def test_paging_continues_from_buffer_into_database(db, monkeypatch):
+    monkeypatch.setattr(main, 'shard_handles', main.ShardHandles(4))
+    main.chat_refs.clear()
+    main.sender_refs.clear()
+    for n in range(25):
+        main.save_user_message(1, {
+            'chat_id': '10', 'chat_name': 'chat', 'username': 'u', 'message_type': 'group', 'has_keywords': True,
+            'keywords_found': 'x', 'message_text': f'alert {n}', 'timestamp': TS,
+        })
+    monkeypatch.setattr(main, 'RECENT_ALERTS_SIZE', 12)
+    # Уведомление после запуска, не сохраненное по политике хранения
+    main.remember_alert(1, alert(25))
+    assert walk_older(1) == [f'alert {n}' for n in reversed(range(26))]
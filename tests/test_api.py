@@ -0,0 +1,63 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import main
+
+
+def get(path, token):
+    """GET к API на тестовом сервере: (статус, JSON или None)"""
+    async def run():
+        app = web.Application()
+        app.router.add_get(r'/api/users/{user_id:\d+}/{kind:sessions|stats|alerts|keywords}', main.api_handler)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get(path, headers={'Authorization': f'Bearer {token}'})
+            return response.status, await response.json() if response.status == 200 else None
+
+    return asyncio.run(run())
+
+
+def setup_api(monkeypatch):
+    monkeypatch.setattr(main, 'API_TOKEN', 'admin')
+    monkeypatch.setattr(main, 'read_pool', main.ReadConnectionPool(2))
+    monkeypatch.setattr(main, 'api_response_cache', {})
+
+
+def test_personal_token_reads_only_own_data(allowed_user, monkeypatch):
+    setup_api(monkeypatch)
+    token = main.issue_api_token(allowed_user)
+
+    assert get(f'/api/users/{allowed_user}/keywords', token)[0] == 200
+    assert get('/api/users/2002/keywords', token)[0] == 403
+    assert get('/api/users/2002/keywords', 'admin')[0] == 200
+
+    # Новый токен заменяет прежний, отозванный перестает действовать
+    new_token = main.issue_api_token(allowed_user)
+    assert get(f'/api/users/{allowed_user}/stats', token)[0] == 403
+    assert main.revoke_api_token(allowed_user)
+    assert get(f'/api/users/{allowed_user}/stats', new_token)[0] == 403
+
+
+def test_alerts_limit_is_clamped(allowed_user, monkeypatch):
+    setup_api(monkeypatch)
+    monkeypatch.setattr(main, 'shard_handles', main.ShardHandles(4))
+    main.chat_refs.clear()
+    main.sender_refs.clear()
+    for text in ('первое', 'второе'):
+        main.save_user_message(allowed_user, {
+            'chat_id': '10', 'chat_name': 'chat', 'username': 'u', 'message_type': 'group',
+            'has_keywords': True, 'keywords_found': 'x', 'message_text': text,
+        })
+
+    for limit in (0, -1):
+        status, data = get(f'/api/users/{allowed_user}/alerts?limit={limit}', 'admin')
+        assert status == 200
+        assert len(data['alerts']) == 1 and 'next' in data
+
+
+def test_stats_include_unflushed_counters(allowed_user, monkeypatch):
+    setup_api(monkeypatch)
+    main.count_skipped_message(allowed_user, 1, True)
+    status, data = get(f'/api/users/{allowed_user}/stats', 'admin')
+    assert (data['skipped_messages'], data['skipped_alerts']) == (1, 1)
@@ -0,0 +1,68 @@
+import pytest
+
+import main
+
+
+def record(ts, text='x'):
+    return {'ts': ts, 'user_id': 1, 'chat_id': '10', 'message_text': text}
+
+
+def open_archive(directory, segment_size=200, index_interval=64):
+    return main.MessageArchive(str(directory), segment_size, index_interval)
+
+
+def test_iter_records_uses_index_and_spans_rotated_segments(tmp_path):
+    archive = open_archive(tmp_path / 'a')
+    for ts in range(20):
+        archive.append(record(float(ts)))
+    assert len(archive.list_segments()) > 1
+    assert [r['ts'] for r in archive.iter_records(5, 9)] == [5.0, 6.0, 7.0, 8.0]
+    assert len(list(archive.iter_records())) == 20
+
+
+def test_reopen_truncates_partial_tail(tmp_path):
+    archive = open_archive(tmp_path / 'a', segment_size=10 ** 6)
+    for ts in range(3):
+        archive.append(record(float(ts)))
+    archive.flush()
+    with open(archive.segment_path(archive.segment_number), 'ab') as f:
+        f.write(main.ARCHIVE_RECORD_HEADER.pack(1000) + b'{"ts"')
+    archive.lock_file.close()
+
+    reopened = open_archive(tmp_path / 'a', segment_size=10 ** 6)
+    reopened.append(record(3.0))
+    assert [r['ts'] for r in reopened.iter_records()] == [0.0, 1.0, 2.0, 3.0]
+
+
+def test_second_writer_for_same_directory_is_rejected(tmp_path):
+    first = open_archive(tmp_path / 'a')
+    with pytest.raises(RuntimeError):
+        open_archive(tmp_path / 'a')
+    first.append(record(1.0))
+
+
+def test_snapshot_read_survives_rotation(tmp_path):
+    archive = open_archive(tmp_path / 'a')
+    for ts in range(5):
+        archive.append(record(float(ts)))
+    reader = archive.iter_records()
+    first = next(reader)
+    for ts in range(5, 30):
+        archive.append(record(float(ts)))
+    assert [first['ts']] + [r['ts'] for r in reader] == [float(ts) for ts in range(5)]
+
+
+def test_export_merges_archives_of_all_replicas(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'ARCHIVE_DIR', str(tmp_path))
+    own = open_archive(main.archive_directory('replica-a'))
+    other = open_archive(main.archive_directory('replica/b'))
+    for ts in (1.0, 3.0, 5.0):
+        own.append(record(ts, 'a'))
+    for ts in (2.0, 4.0):
+        other.append(record(ts, 'b'))
+    other.flush()
+    monkeypatch.setattr(main, 'message_archive', own)
+
+    merged = list(main.iter_archive_records())
+    assert [r['ts'] for r in merged] == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert [r['message_text'] for r in main.iter_archive_records(since=2.0, until=4.0)] == ['b', 'a']
@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+def event(chat_id, kind='group', text='hello'):
+    return SimpleNamespace(raw_text=text, chat_id=chat_id, is_private=kind == 'private',
+                           is_group={'group': True, 'channel': False}.get(kind))
+
+
+def make_filter(include=(), exclude=(), types=None):
+    return {'include': set(include), 'exclude': set(exclude), 'types': set(types) if types else None}
+
+
+def test_include_list_accepts_only_listed_chats():
+    chat_filter = make_filter(include={1234567890})
+    # id из выгрузки без префикса -100 совпадает с id канала Telethon
+    assert main.chat_filter_accepts(chat_filter, event(-1001234567890))
+    assert not main.chat_filter_accepts(chat_filter, event(-1005678901234))
+
+
+def test_exclude_list_rejects_listed_chats():
+    chat_filter = make_filter(exclude={-1001234567890})
+    assert not main.chat_filter_accepts(chat_filter, event(-1001234567890))
+    assert main.chat_filter_accepts(chat_filter, event(-1005678901234))
+
+
+@pytest.mark.parametrize('types, kind, accepted', [
+    ({'private'}, 'private', True),
+    ({'private'}, 'group', False),
+    ({'group'}, 'group', True),
+    ({'group'}, 'channel', False),
+    ({'channel'}, 'channel', True),
+    ({'channel'}, 'unknown', True),
+    ({'private'}, 'unknown', False),
+])
+def test_chat_type_filter(types, kind, accepted):
+    assert main.chat_filter_accepts(make_filter(types=types), event(-1001234567890, kind)) is accepted
+
+
+def test_empty_text_is_rejected():
+    assert not main.chat_filter_accepts(make_filter(), event(-1001234567890, text=''))
+
+
+def test_running_filter_is_updated_in_place(allowed_user):
+    conn = main.get_db_connection()
+    session_id = conn.execute("INSERT INTO user_sessions (user_id, session_name, session_string) VALUES (?, 'w', 'x')",
+                              (allowed_user,)).lastrowid
+    conn.commit()
+    conn.close()
+    chat_filter = main.load_chat_filter(allowed_user, session_id)
+    assert main.chat_filter_accepts(chat_filter, event(-1001234567890))
+
+    assert main.set_chat_filter(allowed_user, session_id, 'chat_exclude', '1234567890')
+    assert main.set_chat_filter(allowed_user, session_id, 'chat_types', 'group,private')
+    assert not main.chat_filter_accepts(chat_filter, event(-1001234567890))
+    assert main.chat_filter_accepts(chat_filter, event(-1005678901234))
+    assert not main.chat_filter_accepts(chat_filter, event(-1005678901234, 'channel'))
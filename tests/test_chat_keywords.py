@@ -0,0 +1,50 @@
+import main
+
+
+def match(rule_set, text, chat_id=None):
+    return rule_set.match(main.normalize_match_text(text), chat_id)
+
+
+def test_add_list_and_delete_chat_keywords(allowed_user):
+    added, words, invalid = main.add_chat_keywords(allowed_user, 42, 'дом, (аренда AND, usdt AND NOT scam')
+    assert added == 2 and words == ['дом', 'usdt AND NOT scam'] and len(invalid) == 1
+    main.add_chat_keywords(allowed_user, 42, 'реклама', is_exception=True)
+    main.add_chat_keywords(allowed_user, 7, 'дом')
+
+    rows = main.get_chat_keywords(allowed_user)
+    assert [(chat_id, keyword, is_exception) for _, chat_id, keyword, is_exception in rows] == [
+        (7, 'дом', 0), (42, 'дом', 0), (42, 'usdt AND NOT scam', 0), (42, 'реклама', 1)]
+
+    assert main.delete_chat_keyword(allowed_user, rows[0][0])
+    assert not main.delete_chat_keyword(allowed_user + 1, rows[1][0])
+    assert [row[1] for row in main.get_chat_keywords(allowed_user)] == [42, 42, 42]
+
+
+def test_chat_keyword_matches_only_in_its_chat():
+    rule_set = main.RuleSet(['квартира'], [], chat_rules={42: (['дом'], [])})
+    assert match(rule_set, 'продаю дом', 42) == (True, ['дом'])
+    assert match(rule_set, 'продаю дом', 7) == (False, [])
+    assert match(rule_set, 'продаю дом') == (False, [])
+    # Общие слова действуют и в чате со своими правилами
+    assert match(rule_set, 'квартира и дом', 42) == (True, ['квартира', 'дом'])
+
+
+def test_chat_exception_suppresses_global_keyword():
+    rule_set = main.RuleSet(['квартира'], [], chat_rules={42: ([], ['посуточно'])})
+    assert match(rule_set, 'квартира посуточно', 42) == (False, [])
+    assert match(rule_set, 'квартира посуточно', 7) == (True, ['квартира'])
+
+
+def test_global_exception_suppresses_chat_keyword():
+    rule_set = main.RuleSet([], ['реклама'], chat_rules={42: (['дом'], [])})
+    assert match(rule_set, 'дом реклама', 42) == (False, [])
+
+
+def test_chat_rules_are_loaded_from_db(allowed_user):
+    main.add_user_keywords(allowed_user, 'квартира')
+    main.add_chat_keywords(allowed_user, 42, 'дом')
+    main.add_chat_keywords(allowed_user, 42, 'посуточно', is_exception=True)
+    rule_set = main.load_rule_set(allowed_user)
+    assert match(rule_set, 'дом', 42) == (True, ['дом'])
+    assert match(rule_set, 'квартира посуточно', 42) == (False, [])
+    assert match(rule_set, 'квартира посуточно', 7) == (True, ['квартира'])
@@ -0,0 +1,34 @@
+import sqlite3
+
+import main
+
+
+def broken_connection():
+    raise sqlite3.OperationalError('database is locked')
+
+
+def test_failed_counter_flush_keeps_counts(db, monkeypatch):
+    main.count_skipped_message(1, 2, True)
+    main.count_skipped_message(1, 2, False)
+    real_connect = main.get_db_connection
+    monkeypatch.setattr(main, 'get_db_connection', broken_connection)
+    main.flush_message_counters()
+    main.count_skipped_message(1, 2, False)
+    assert main.pending_message_counters == {(1, 2): [3, 1]}
+
+    monkeypatch.setattr(main, 'get_db_connection', real_connect)
+    main.flush_message_counters()
+    assert main.pending_message_counters == {}
+    conn = main.get_db_connection()
+    assert main.get_skipped_counts(1, conn.cursor()) == (3, 1)
+    conn.close()
+
+
+def test_failed_rollup_flush_keeps_counts(db, monkeypatch):
+    main.count_message_rollup(1, '10', 'chat', ['usdt'])
+    monkeypatch.setattr(main, 'get_db_connection', broken_connection)
+    main.flush_rollups()
+    main.count_message_rollup(1, '10', 'chat', [])
+
+    assert [counters[:2] for counters in main.pending_chat_rollups.values()] == [[2, 1]]
+    assert list(main.pending_keyword_rollups.values()) == [1]
@@ -0,0 +1,77 @@
+import asyncio
+import os
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import main
+
+TOKEN = 'secret'
+
+
+def export(path, headers=None):
+    """GET к выгрузке на тестовом сервере: (статус, тело)"""
+    async def run():
+        app = web.Application()
+        app.router.add_get('/export/{kind:messages|alerts|archive}', main.export_handler)
+        async with TestClient(TestServer(app)) as client:
+            default_headers = {'Authorization': f'Bearer {TOKEN}'}
+            response = await client.get(path, headers=default_headers if headers is None else headers)
+            return response.status, await response.text()
+
+    return asyncio.run(run())
+
+
+def test_export_for_user_without_shard_creates_no_file(db, monkeypatch):
+    monkeypatch.setattr(main, 'API_TOKEN', TOKEN)
+    monkeypatch.setattr(main, 'STORAGE_SHARDS', 'user')
+    monkeypatch.setattr(main, 'SHARD_DIR', str(db / 'shards'))
+    os.makedirs(main.SHARD_DIR)
+
+    status, body = export('/export/messages?user_id=42')
+    assert status == 200
+    assert body.splitlines() == [','.join(main.EXPORT_COLUMNS)]
+    assert not os.path.exists(main.message_shard_path('user_42'))
+    assert main.list_message_shards() == []
+
+
+def save(user_id, text, keywords=''):
+    main.save_user_message(user_id, {
+        'session_id': 1, 'chat_id': '10', 'chat_name': 'chat', 'username': 'u', 'message_type': 'group',
+        'has_keywords': bool(keywords), 'keywords_found': keywords, 'message_text': text,
+    })
+
+
+def test_keyword_filter_runs_in_query_and_sees_compressed_text(db, monkeypatch):
+    monkeypatch.setattr(main, 'API_TOKEN', TOKEN)
+    monkeypatch.setattr(main, 'shard_handles', main.ShardHandles(4))
+    monkeypatch.setattr(main, 'MESSAGE_COMPRESSION', True)
+    monkeypatch.setattr(main, 'COMPRESS_MIN_LENGTH', 50)
+    main.chat_refs.clear()
+    main.sender_refs.clear()
+    save(1, 'Сдаю квартиру ' + 'очень длинное описание ' * 10)
+    save(1, 'продаю дом', 'дом')
+    save(1, 'ничего интересного')
+
+    status, body = export('/export/messages?format=jsonl&keyword=КВАРТИРУ')
+    assert status == 200
+    assert [line.split('"message_text": "')[1][:13] for line in body.splitlines()] == ['Сдаю квартиру']
+    status, body = export('/export/messages?format=jsonl&keyword=дом')
+    assert len(body.splitlines()) == 1
+
+    sql, params = main.build_export_query({'keyword': 'Дом'}, False)
+    assert 'export_contains' in sql and params == ['дом']
+
+
+def test_token_only_from_bearer_header(db, monkeypatch):
+    monkeypatch.setattr(main, 'API_TOKEN', TOKEN)
+    assert export(f'/export/messages?token={TOKEN}', headers={})[0] == 403
+    assert export('/export/messages', headers={'Authorization': 'Bearer wrong'})[0] == 403
+    assert export('/export/messages')[0] == 200
+
+
+def test_export_datetime_is_utc():
+    assert main.parse_export_epoch('86400') == 86400
+    assert main.parse_export_epoch('1970-01-02') == 86400
+    assert main.parse_export_epoch('1970-01-02T03:00:00+03:00') == 86400
+    assert main.parse_export_time('1970-01-02T03:00:00+03:00') == '1970-01-02 00:00:00'
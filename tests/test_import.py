@@ -0,0 +1,98 @@
+import asyncio
+import io
+from datetime import datetime
+
+from aiogram import types
+
+import main
+
+
+def make_update(user_id, text=None, caption=None, document=None):
+    message = types.Message(
+        message_id=1,
+        date=datetime.now(),
+        chat=types.Chat(id=user_id, type='private'),
+        from_user=types.User(id=user_id, is_bot=False, first_name='User'),
+        text=text,
+        caption=caption,
+        document=document,
+    )
+    return types.Update(update_id=1, message=message)
+
+
+def feed(update):
+    asyncio.run(main.dp.feed_update(main.bot, update))
+
+
+def test_iter_import_terms_skips_comments_and_blank_lines():
+    stream = io.BytesIO('﻿квартира\n\n# комментарий\n  дом  \n'.encode())
+    assert list(main.iter_import_terms(stream, 'words.txt')) == ['квартира', 'дом']
+
+
+def test_iter_import_terms_takes_first_csv_column():
+    stream = io.BytesIO('"студия, у метро",1\nдом,2\n'.encode())
+    assert list(main.iter_import_terms(stream, 'words.CSV')) == ['студия, у метро', 'дом']
+
+
+def test_import_user_terms_counts_duplicates_and_invalid(allowed_user):
+    added, duplicates, invalid = main.import_user_terms(
+        allowed_user, ['квартира', 'квартира', 'дом', '(аренда AND']
+    )
+    assert (added, duplicates, len(invalid)) == (2, 1, 1)
+    assert [row[1] for row in main.get_user_keywords(allowed_user)] == ['квартира', 'дом']
+
+
+def test_document_with_import_caption_is_imported(allowed_user, monkeypatch):
+    sent = []
+
+    async def fake_send(user_id, text, reply_markup=None):
+        sent.append(text)
+
+    async def fake_download(document, destination):
+        destination.write('квартира\nдом\n'.encode())
+        return destination
+
+    monkeypatch.setattr(main, 'safe_send_message', fake_send)
+    monkeypatch.setattr(main.bot, 'download', fake_download)
+    document = types.Document(file_id='file', file_unique_id='unique', file_name='words.txt', file_size=16)
+    feed(make_update(allowed_user, caption='/import_keywords', document=document))
+
+    assert len(sent) == 1 and 'Добавлено: 2' in sent[0]
+    assert main.load_rule_set(allowed_user).match('продаю дом')[0]
+
+
+def test_large_import_is_spooled_to_disk(allowed_user, monkeypatch):
+    sent = []
+    destinations = []
+    words = [f'слово{n}' for n in range(500)]
+
+    async def fake_send(user_id, text, reply_markup=None):
+        sent.append(text)
+
+    async def fake_download(document, destination):
+        for word in words:
+            destination.write(f'{word}\n'.encode())
+        destinations.append(destination)
+        return destination
+
+    monkeypatch.setattr(main, 'IMPORT_SPOOL_BYTES', 1024)
+    monkeypatch.setattr(main, 'safe_send_message', fake_send)
+    monkeypatch.setattr(main.bot, 'download', fake_download)
+    document = types.Document(file_id='file', file_unique_id='unique', file_name='words.txt', file_size=6000)
+    feed(make_update(allowed_user, caption='/import_keywords', document=document))
+
+    assert 'Добавлено: 500' in sent[0]
+    # Файл больше порога лежал на диске, а не в памяти
+    assert destinations[0]._rolled and destinations[0].closed
+
+
+def test_import_command_without_document_shows_help(allowed_user, monkeypatch):
+    sent = []
+
+    async def fake_send(user_id, text, reply_markup=None):
+        sent.append(text)
+
+    monkeypatch.setattr(main, 'safe_send_message', fake_send)
+    feed(make_update(allowed_user, text='/import_keywords'))
+
+    assert len(sent) == 1 and 'Отправьте файл' in sent[0]
@@ -0,0 +1,28 @@
+import logging
+import queue
+
+import main
+
+
+def make_record(level, msg, args):
+    return logging.LogRecord('main.hot', level, __file__, 1, msg, args, None)
+
+
+def test_rate_limit_never_drops_errors():
+    rate_filter = main.RateLimitFilter(1)
+    assert rate_filter.filter(make_record(logging.INFO, 'first', ()))
+    assert not rate_filter.filter(make_record(logging.INFO, 'second', ()))
+    assert all(rate_filter.filter(make_record(level, 'boom', ())) for level in (logging.ERROR, logging.CRITICAL))
+
+
+def test_mutable_args_are_formatted_before_queuing():
+    log_queue = queue.SimpleQueue()
+    handler = main.LazyQueueHandler(log_queue)
+    keywords = ['usdt']
+    handler.handle(make_record(logging.INFO, 'found %s for %s', (keywords, 7)))
+    keywords.append('scam')
+    assert log_queue.get_nowait().getMessage() == "found ['usdt'] for 7"
+
+    # Неизменяемые аргументы по-прежнему форматируются в потоке слушателя
+    handler.handle(make_record(logging.INFO, 'user %s', (7,)))
+    assert log_queue.get_nowait().args == (7,)
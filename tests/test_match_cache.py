@@ -0,0 +1,85 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import main
+
+
+def check(user_id, text, chat_id=None):
+    return asyncio.run(main.check_keywords_for_user(user_id, main.normalize_text(text), chat_id))
+
+
+def count_matches(monkeypatch):
+    """Подсчет настоящих проверок RuleSet.match (промахов кэша)"""
+    calls = []
+    real_match = main.RuleSet.match
+
+    def counting_match(self, text_lower, chat_id=None):
+        calls.append(chat_id)
+        return real_match(self, text_lower, chat_id)
+
+    monkeypatch.setattr(main.RuleSet, 'match', counting_match)
+    return calls
+
+
+def test_same_text_and_version_is_a_hit(allowed_user, monkeypatch):
+    monkeypatch.setattr(main, 'match_cache', main.MatchCache(100))
+    calls = count_matches(monkeypatch)
+    main.add_user_keywords(allowed_user, 'usdt')
+
+    assert check(allowed_user, 'Buy USDT') == (True, ['usdt'])
+    # Та же нормализованная форма - тот же ключ
+    assert check(allowed_user, 'buy   usdt') == (True, ['usdt'])
+    assert len(calls) == 1
+    assert (main.match_cache.hits, main.match_cache.misses) == (1, 1)
+
+
+def test_rules_change_invalidates_cached_result(allowed_user, monkeypatch):
+    monkeypatch.setattr(main, 'match_cache', main.MatchCache(100))
+    calls = count_matches(monkeypatch)
+    main.add_user_keywords(allowed_user, 'квартира')
+    assert check(allowed_user, 'сдаю дом') == (False, [])
+
+    main.add_user_keywords(allowed_user, 'дом')
+    assert check(allowed_user, 'сдаю дом') == (True, ['дом'])
+    assert len(calls) == 2 and main.match_cache.hits == 0
+
+
+def test_chat_with_own_rules_gets_own_entry(allowed_user, monkeypatch):
+    monkeypatch.setattr(main, 'match_cache', main.MatchCache(100))
+    calls = count_matches(monkeypatch)
+    main.add_user_keywords(allowed_user, 'квартира')
+    main.add_chat_keywords(allowed_user, 42, 'дом')
+
+    assert check(allowed_user, 'сдаю дом', chat_id=7) == (False, [])
+    assert check(allowed_user, 'сдаю дом', chat_id=8) == (False, [])
+    assert check(allowed_user, 'сдаю дом', chat_id=42) == (True, ['дом'])
+    # Чаты без своих правил делят одну запись
+    assert calls == [None, 42]
+
+
+def test_lru_evicts_oldest_entry():
+    cache = main.MatchCache(2)
+    cache.put('a', (False, []))
+    cache.put('b', (False, []))
+    cache.get('a')
+    cache.put('c', (False, []))
+    assert list(cache.entries) == ['a', 'c']
+
+
+def test_hit_rate_is_reported_in_metrics(allowed_user, monkeypatch):
+    monkeypatch.setattr(main, 'match_cache', main.MatchCache(100))
+    main.add_user_keywords(allowed_user, 'квартира')
+    check(allowed_user, 'сдаю квартиру')
+    check(allowed_user, 'сдаю квартиру')
+
+    async def fetch():
+        app = web.Application()
+        app.router.add_get('/metrics', main.metrics_handler)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get('/metrics')
+            return await response.json()
+
+    stats = asyncio.run(fetch())['match_cache']
+    assert (stats['hits'], stats['misses'], stats['hit_rate']) == (1, 1, 0.5)
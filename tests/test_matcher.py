@@ -0,0 +1,74 @@
+import asyncio
+import os
+import signal
+
+import main
+
+
+def worker_state():
+    return main.IS_MATCHER_WORKER, main.bot is None
+
+
+def add_keywords(user_id, text):
+    main.add_user_keywords(user_id, text)
+    return main.load_rule_version(user_id)[0]
+
+
+def test_match_batch_reloads_only_for_newer_version(allowed_user):
+    add_keywords(allowed_user, 'квартира')
+    version = main.load_rule_set(allowed_user).version
+    cached = main.user_rule_sets[allowed_user]
+
+    # Запрошена старая версия - кэш (более новый) используется без перекомпиляции
+    assert main.match_batch([(allowed_user, version - 1, 'квартира', None)]) == [(True, ['квартира'])]
+    assert main.user_rule_sets[allowed_user] is cached
+
+    # Версия в БД изменилась, а запрошена новее кэша - правила перечитываются
+    conn = main.get_db_connection()
+    main.increment_rules_version(conn.cursor(), allowed_user)
+    conn.commit()
+    conn.close()
+    main.match_batch([(allowed_user, version + 1, 'квартира', None)])
+    assert main.user_rule_sets[allowed_user] is not cached
+
+
+def test_check_keywords_in_process_mode_does_not_compile_in_parent(allowed_user, monkeypatch):
+    add_keywords(allowed_user, 'квартира')
+    main.user_rule_sets.clear()
+
+    class FakeMatcher:
+        async def match(self, user_id, version, match_text, chat_id=None):
+            return main.match_batch([(user_id, version, match_text, chat_id)])[0]
+
+    monkeypatch.setattr(main, 'process_matcher', FakeMatcher())
+    # match_batch в FakeMatcher работает в этом же процессе, поэтому проверяем версию до вызова
+    version, chats = main.load_rule_version(allowed_user)
+    assert allowed_user not in main.user_rule_sets
+    assert chats == frozenset()
+    result = asyncio.run(main.check_keywords_for_user(allowed_user, main.normalize_text('сдаю квартира')))
+    assert result == (True, ['квартира'])
+
+
+def test_process_matcher_restarts_broken_pool(allowed_user):
+    add_keywords(allowed_user, 'квартира')
+
+    async def scenario():
+        matcher = main.ProcessMatcher(1, batch_size=1, batch_delay=0.001)
+        try:
+            state = await asyncio.get_running_loop().run_in_executor(matcher.pool, worker_state)
+            first = await matcher.match(allowed_user, 0, 'квартира')
+            for process in list(matcher.pool._processes.values()):
+                os.kill(process.pid, signal.SIGKILL)
+            await asyncio.sleep(0.5)
+            fallback = await matcher.match(allowed_user, 0, 'квартира')
+            after = await matcher.match(allowed_user, 0, 'квартира')
+            return state, first, fallback, after, matcher.stats()
+        finally:
+            matcher.pool.shutdown(wait=True)
+
+    state, first, fallback, after, stats = asyncio.run(scenario())
+    assert state == (True, True)
+    assert first == fallback == after == (True, ['квартира'])
+    assert stats['restarts'] == 1
+    assert stats['fallbacks'] == 1
+    assert stats['batches'] == 2
@@ -0,0 +1,92 @@
+import asyncio
+import tracemalloc
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import main
+
+
+def get(path, token):
+    """GET к /admin/memory на тестовом сервере: (статус, JSON или None)"""
+    async def run():
+        app = web.Application()
+        app.router.add_get('/admin/memory', main.admin_memory_handler)
+        async with TestClient(TestServer(app)) as client:
+            headers = {'Authorization': f'Bearer {token}'} if token else {}
+            response = await client.get(path, headers=headers)
+            return response.status, await response.json() if response.status == 200 else None
+
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def memory(monkeypatch):
+    """Админский токен и выключенный tracemalloc до и после теста"""
+    monkeypatch.setattr(main, 'API_TOKEN', 'admin')
+    monkeypatch.setattr(main, 'memory_snapshot', None)
+    tracemalloc.stop()
+    yield
+    tracemalloc.stop()
+
+
+def test_memory_report_requires_admin_token(memory):
+    assert get('/admin/memory', None)[0] == 403
+    assert get('/admin/memory', 'wrong')[0] == 403
+    assert get('/admin/memory?top=many', 'admin')[0] == 400
+
+
+def test_memory_report_shape(memory, monkeypatch):
+    monkeypatch.setattr(main, 'MEMORY_BUDGET_MB', 512)
+    monkeypatch.setitem(main.user_last_message, 1001, 0)
+
+    status, report = get('/admin/memory', 'admin')
+    assert status == 200
+    assert set(report) == {'rss_mb', 'budget_mb', 'caches', 'clients', 'tasks', 'tracemalloc'}
+    assert report['rss_mb'] > 0 and report['budget_mb'] == 512
+    assert set(report['caches']) == set(main.get_cache_sizes())
+    assert report['caches']['user_last_message'] == len(main.user_last_message)
+    assert report['tracemalloc'].startswith('off')
+    assert not tracemalloc.is_tracing()
+
+
+def test_trace_query_starts_tracemalloc_and_diffs_snapshots(memory):
+    status, first = get('/admin/memory?trace=1&top=3', 'admin')
+    assert status == 200 and tracemalloc.is_tracing()
+    assert 'diff' not in first['tracemalloc'] and len(first['tracemalloc']['top']) <= 3
+
+    # Следующий вызов сравнивается с прошлым снимком
+    second = get('/admin/memory?top=3', 'admin')[1]['tracemalloc']
+    assert len(second['diff']) <= 3
+    assert set(second['top'][0]) == {'site', 'size_kb', 'count', 'size_diff_kb', 'count_diff'}
+
+
+def test_take_memory_report_keeps_previous_snapshot(memory):
+    tracemalloc.start()
+    first = main.take_memory_report(5)
+    assert main.memory_snapshot is not None and 'diff' not in first
+    blocks = [bytearray(1024) for _ in range(100)]
+    second = main.take_memory_report(5)
+    assert second['traced_mb'] >= 0 and len(second['top']) <= 5
+    assert any(stat['size_diff_kb'] >= 100 for stat in second['diff'])
+    del blocks
+
+
+def test_memory_watch_prunes_flood_control_entries(monkeypatch):
+    sleeps = []
+
+    async def fake_sleep(delay):
+        # Один проход цикла, затем остановка
+        if sleeps:
+            raise asyncio.CancelledError
+        sleeps.append(delay)
+
+    monkeypatch.setattr(main.asyncio, 'sleep', fake_sleep)
+    monkeypatch.setattr(main.time, 'time', lambda: 1000)
+    monkeypatch.setattr(main, 'user_last_message', {1: 900, 2: 950, 3: 999})
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(main.memory_watch_loop())
+    assert sleeps == [main.MEMORY_CHECK_INTERVAL]
+    assert main.user_last_message == {2: 950, 3: 999}
@@ -0,0 +1,35 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize('forms', [
+    ('квартира', 'квартиру', 'квартиры', 'квартирой'),
+    ('работать', 'работает', 'работал'),
+    ('новый', 'новая', 'новых'),
+    ('ёлка', 'елки'),
+])
+def test_stemmer_maps_word_forms_to_one_stem(forms):
+    assert len({main.stem_russian(form) for form in forms}) == 1
+
+
+def test_stemmer_keeps_words_without_cyrillic_vowels():
+    assert main.stem_russian('usdt') == 'usdt'
+    assert main.stem_russian('вк') == 'вк'
+
+
+def test_morphology_matches_any_form():
+    rule_set = main.RuleSet(['квартира'], [], morphology=True)
+    assert rule_set.match(main.normalize_match_text('Сдаю квартиру'))[0]
+    assert not main.RuleSet(['квартира'], []).match(main.normalize_match_text('Сдаю квартиру'))[0]
+
+
+def test_rules_get_backend_mark_and_are_refreshed_once(allowed_user):
+    assert main.keyword_lemmas('usdt AND NOT scam') == f'{main.MORPH_BACKEND}:'
+    main.add_user_keywords(allowed_user, 'квартира, usdt AND NOT scam')
+    conn = main.get_db_connection()
+    conn.execute("UPDATE user_keywords SET lemmas = NULL")
+    cursor = conn.cursor()
+    assert main.refresh_user_lemmas(cursor, allowed_user) == 2
+    assert main.refresh_user_lemmas(cursor, allowed_user) == 0
+    conn.close()
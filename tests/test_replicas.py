@@ -0,0 +1,242 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+
+
+def execute(sql, params=()):
+    conn = main.get_db_connection()
+    conn.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+
+def add_session(user_id, name='work'):
+    conn = main.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO user_sessions (user_id, session_name, session_string) VALUES (?, ?, 'x')",
+                   (user_id, name))
+    session_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return session_id
+
+
+def test_storage_policy_change_on_other_replica_reaches_cache(allowed_user):
+    session_id = add_session(allowed_user)
+    main.sync_user_caches()
+    assert main.get_storage_policy(allowed_user, session_id) == 'all'
+
+    # Другая реплика меняет политику в общей БД
+    execute("UPDATE users SET storage_policy = 'none', cache_version = cache_version + 1 WHERE user_id = ?",
+            (allowed_user,))
+    assert main.get_storage_policy(allowed_user, session_id) == 'all'
+    main.sync_user_caches()
+    assert main.get_storage_policy(allowed_user, session_id) == 'none'
+
+
+def test_chat_filter_change_on_other_replica_updates_running_filter(allowed_user):
+    session_id = add_session(allowed_user)
+    chat_filter = main.load_chat_filter(allowed_user, session_id)
+    main.sync_user_caches()
+
+    execute("UPDATE user_sessions SET chat_exclude = '42' WHERE id = ?", (session_id,))
+    execute("UPDATE users SET cache_version = cache_version + 1 WHERE user_id = ?", (allowed_user,))
+    main.sync_user_caches()
+    assert chat_filter['exclude'] == {42}
+
+
+def test_set_storage_policy_bumps_cache_version(allowed_user):
+    main.sync_user_caches()
+    version = main.user_cache_versions[allowed_user]
+    assert main.set_storage_policy(allowed_user, 'matches')
+    main.sync_user_caches()
+    assert main.user_cache_versions[allowed_user] == version + 1
+
+
+def test_background_restart_reports_only_state_changes(allowed_user, monkeypatch):
+    session_id = add_session(allowed_user)
+    sent = []
+
+    async def fake_send(user_id, text, reply_markup=None):
+        sent.append(text)
+
+    async def invalid_session(session_string):
+        return False, 'invalid'
+
+    monkeypatch.setattr(main, 'safe_send_message', fake_send)
+    monkeypatch.setattr(main, 'test_session', invalid_session)
+
+    async def start(quiet):
+        return await main.start_user_session(allowed_user, session_id, 'work', 'x', quiet=quiet)
+
+    for _ in range(3):
+        assert asyncio.run(start(quiet=True)) is False
+    assert len(sent) == 1
+
+    # Ручной запуск всегда сообщает результат
+    asyncio.run(start(quiet=False))
+    assert len(sent) == 2
+
+
+def test_known_account_running_locally_is_reused_without_connecting(allowed_user, monkeypatch):
+    session_id = add_session(allowed_user)
+    main.save_session_account(session_id, 555)
+    monkeypatch.setitem(main.active_clients, 555, object())
+    monkeypatch.setitem(main.account_subscribers, 555, {})
+    monkeypatch.setattr(main, 'session_accounts', {})
+
+    async def no_connection(*args, **kwargs):
+        raise AssertionError('второе подключение к аккаунту')
+
+    async def fake_send(user_id, text, reply_markup=None):
+        pass
+
+    monkeypatch.setattr(main, 'test_session', no_connection)
+    monkeypatch.setattr(main, 'safe_send_message', fake_send)
+    assert asyncio.run(main.start_user_session(allowed_user, session_id, 'work', 'x'))
+    assert main.session_accounts == {(allowed_user, session_id): 555}
+
+
+def test_account_leased_by_other_replica_is_not_connected(allowed_user, monkeypatch):
+    session_id = add_session(allowed_user)
+    main.save_session_account(session_id, 555)
+    execute("INSERT INTO leases (name, owner, expires_at) VALUES ('account:555', 'other', ?)",
+            (main.time.time() + 60,))
+    sent = []
+
+    async def no_connection(*args, **kwargs):
+        raise AssertionError('второе подключение к аккаунту')
+
+    async def fake_send(user_id, text, reply_markup=None):
+        sent.append(text)
+
+    monkeypatch.setattr(main, 'test_session', no_connection)
+    monkeypatch.setattr(main, 'safe_send_message', fake_send)
+    assert asyncio.run(main.start_user_session(allowed_user, session_id, 'work', 'x')) is False
+    assert 'другой реплике' in sent[0]
+    # Чужая аренда аккаунта не снимается
+    conn = main.get_db_connection()
+    assert conn.execute("SELECT owner FROM leases WHERE name = 'account:555'").fetchone() == ('other',)
+    conn.close()
+
+
+def test_own_setting_change_keeps_local_caches(allowed_user):
+    session_id = add_session(allowed_user)
+    main.sync_user_caches()
+    assert main.set_storage_policy(allowed_user, 'matches')
+    main.get_storage_policy(allowed_user, session_id)
+    main.sync_user_caches()
+    assert (allowed_user, session_id) in main.storage_policies
+
+
+def test_alerts_mark_only_other_replicas_buffers_stale(allowed_user):
+    main.remember_alert(allowed_user, ('2026-01-01 12:00:00', None, 'chat', 'u', 'x', 'text'))
+    main.sync_user_caches()
+    settings_version = main.user_cache_versions[allowed_user]
+
+    main.count_message_rollup(allowed_user, '10', 'chat', ['x'])
+    main.flush_rollups()
+    main.sync_user_caches()
+    assert allowed_user not in main.recent_alerts_stale
+    assert main.user_cache_versions[allowed_user] == settings_version
+
+    # Уведомление, записанное другой репликой
+    execute("UPDATE users SET alerts_version = alerts_version + 1 WHERE user_id = ?", (allowed_user,))
+    main.sync_user_caches()
+    assert allowed_user in main.recent_alerts_stale
+
+
+def test_filter_of_stopped_session_is_not_registered(allowed_user):
+    session_id = add_session(allowed_user)
+    assert main.set_chat_filter(allowed_user, session_id, 'chat_exclude', '42')
+    assert (allowed_user, session_id) not in main.session_chat_filters
+
+
+def test_failed_start_drops_loaded_filter(allowed_user, monkeypatch):
+    session_id = add_session(allowed_user)
+
+    class BrokenClient:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        async def start(self):
+            pass
+
+        async def get_me(self):
+            return SimpleNamespace(id=777, username='me')
+
+        def on(self, event):
+            raise RuntimeError('handler registration failed')
+
+    async def valid_session(session_string):
+        return True, 'ok'
+
+    async def fake_send(user_id, text, reply_markup=None):
+        pass
+
+    monkeypatch.setattr(main, 'TelegramClient', BrokenClient)
+    monkeypatch.setattr(main, 'StringSession', lambda session_string: None)
+    monkeypatch.setattr(main, 'test_session', valid_session)
+    monkeypatch.setattr(main, 'safe_send_message', fake_send)
+    assert asyncio.run(main.start_user_session(allowed_user, session_id, 'work', 'x')) is False
+    assert (allowed_user, session_id) not in main.session_chat_filters
+
+
+class FakeClient:
+    """Клиент Telethon без сети; считает подключения"""
+    connections = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def start(self):
+        FakeClient.connections += 1
+        await asyncio.sleep(0.01)
+
+    async def get_me(self):
+        return SimpleNamespace(id=555, username='me')
+
+    def on(self, event):
+        return lambda handler: handler
+
+    async def run_until_disconnected(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+
+def test_concurrent_starts_open_one_connection_per_account(allowed_user, monkeypatch):
+    first, second = add_session(allowed_user, 'a'), add_session(allowed_user, 'b')
+    for session_id in (first, second):
+        main.save_session_account(session_id, 555)
+
+    async def valid_session(session_string):
+        await asyncio.sleep(0.01)
+        return True, 'ok'
+
+    async def fake_send(user_id, text, reply_markup=None):
+        pass
+
+    FakeClient.connections = 0
+    monkeypatch.setattr(main, 'TelegramClient', FakeClient)
+    monkeypatch.setattr(main, 'StringSession', lambda session_string: None)
+    monkeypatch.setattr(main, 'test_session', valid_session)
+    monkeypatch.setattr(main, 'safe_send_message', fake_send)
+    monkeypatch.setattr(main, 'active_clients', {})
+    monkeypatch.setattr(main, 'account_subscribers', {})
+    monkeypatch.setattr(main, 'session_accounts', {})
+
+    async def start_all():
+        return await asyncio.gather(
+            main.start_user_session(allowed_user, first, 'a', 'x'),
+            main.start_user_session(allowed_user, first, 'a', 'x'),
+            main.start_user_session(allowed_user, second, 'b', 'x'),
+        )
+
+    # Повторный запуск той же сессии отклоняется, вторая сессия аккаунта подписывается на первое подключение
+    assert asyncio.run(start_all()) == [True, False, True]
+    assert FakeClient.connections == 1
+    assert set(main.account_subscribers[555]) == {(allowed_user, first), (allowed_user, second)}
+    assert main.starting_sessions == set() and main.starting_accounts == {}
@@ -0,0 +1,90 @@
+import sqlite3
+
+import pytest
+
+import main
+
+
+def match(keywords, text, exceptions=()):
+    return main.RuleSet(keywords, exceptions).match(main.normalize_match_text(text))
+
+
+@pytest.mark.parametrize('rule', ['НЕ реклама', 'NOT x', 'NOT (a OR b)', 'квартира OR NOT реклама'])
+def test_rule_without_required_term_is_rejected(rule):
+    with pytest.raises(main.RuleSyntaxError):
+        main.parse_rule(rule)
+
+
+@pytest.mark.parametrize('rule', ['usdt NOT scam', 'NOT scam AND usdt', '(a OR b) AND NOT c', 'продаж*'])
+def test_rule_with_required_term_is_accepted(rule):
+    main.parse_rule(rule)
+
+
+def test_boolean_and_near_rules():
+    rules = ['(buy OR sell) AND usdt NOT scam', '"сдам квартиру" NEAR/3 центр']
+    assert match(rules, 'Sell USDT fast') == (True, ['(buy OR sell) AND usdt NOT scam'])
+    assert match(rules, 'sell usdt scam') == (False, [])
+    assert match(rules, 'сдам квартиру в самом центре') == (False, [])
+    assert match(rules, 'сдам квартиру в центр') == (True, ['"сдам квартиру" NEAR/3 центр'])
+
+
+def test_literal_prefix_keeps_operator_words_plain():
+    assert not main.is_rule('=Ремонт И отделка')
+    assert match(['=Ремонт И отделка'], 'ремонт и отделка под ключ') == (True, ['ремонт и отделка'])
+    # Одиночный префикс не превращается в пустое слово, совпадающее с любым текстом
+    assert match(['='], 'что угодно') == (False, [])
+
+
+def test_add_rejects_not_only_rule(allowed_user):
+    added, keywords, invalid = main.add_user_keywords(allowed_user, 'НЕ реклама, квартира')
+    assert keywords == ['квартира'] and len(invalid) == 1
+
+
+def test_migration_marks_old_operator_keywords_as_literal(db):
+    conn = main.get_db_connection()
+    conn.execute("INSERT INTO users (user_id) VALUES (7)")
+    conn.execute("INSERT INTO user_keywords (user_id, keyword) VALUES (7, 'Ремонт И отделка')")
+    conn.execute("INSERT INTO user_keywords (user_id, keyword) VALUES (7, 'квартира')")
+    conn.execute("PRAGMA user_version = 0")
+    conn.commit()
+    conn.close()
+
+    main.init_db()
+    assert [row[1] for row in main.get_user_keywords(7)] == ['=Ремонт И отделка', 'квартира']
+    assert main.load_rule_set(7).match('ремонт и отделка')[0]
+
+    # Повторная инициализация ничего не меняет
+    main.init_db()
+    assert [row[1] for row in main.get_user_keywords(7)] == ['=Ремонт И отделка', 'квартира']
+
+
+def test_failed_load_is_not_cached(allowed_user, monkeypatch):
+    main.add_user_keywords(allowed_user, 'квартира')
+    real_connect = main.get_db_connection
+
+    def broken_connection():
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(main, 'get_db_connection', broken_connection)
+    assert main.load_rule_set(allowed_user).match('квартира') == (False, [])
+    assert allowed_user not in main.user_rule_sets
+
+    monkeypatch.setattr(main, 'get_db_connection', real_connect)
+    assert main.load_rule_set(allowed_user).match('квартира') == (True, ['квартира'])
+
+
+@pytest.mark.parametrize('rule', ['квартира~10', 'квартира~0', 'кот~1'])
+def test_invalid_fuzzy_terms_are_rejected(rule):
+    assert main.is_rule(rule)
+    with pytest.raises(main.RuleSyntaxError):
+        main.parse_rule(rule)
+
+
+def test_fuzzy_term_matches_typo():
+    assert match(['квартира~'], 'сдам кваритра') == (True, ['квартира~'])
+    assert match(['квартира~'], 'сдам кварта') == (False, [])
+
+
+def test_keywords_are_nfkc_normalized_like_messages():
+    assert match(['ＵＳＤＴ', 'ﬁat'], 'buy usdt for fiat') == (True, ['usdt', 'fiat'])
+    assert match(['usdt'], 'buy ＵＳＤＴ') == (True, ['usdt'])
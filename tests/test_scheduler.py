@@ -0,0 +1,93 @@
+import asyncio
+
+import main
+
+
+async def noop_handler(user_id, *args):
+    pass
+
+
+def make_scheduler(weights=None):
+    scheduler = main.FairScheduler(noop_handler, workers=1, weights=weights or {})
+    scheduler.ready = asyncio.Semaphore(0)
+    return scheduler
+
+
+def fill(scheduler, counts):
+    for user_id, count in counts.items():
+        for n in range(count):
+            scheduler.submit(user_id, n)
+
+
+def drain(scheduler):
+    order = []
+    while (item := scheduler.pop()) is not None:
+        order.append(item[0])
+    return order
+
+
+def test_pop_round_robins_equal_weights():
+    scheduler = make_scheduler()
+    fill(scheduler, {1: 3, 2: 3})
+    assert drain(scheduler) == [1, 2, 1, 2, 1, 2]
+    assert scheduler.depth() == 0
+
+
+def test_pop_gives_heavier_tenant_more_slots():
+    scheduler = make_scheduler({1: 2.0})
+    fill(scheduler, {1: 4, 2: 2})
+    assert drain(scheduler) == [1, 1, 2, 1, 1, 2]
+
+
+def test_shed_drops_queue_and_new_messages():
+    scheduler = make_scheduler()
+    fill(scheduler, {1: 2, 2: 1})
+    scheduler.shed({1})
+    scheduler.submit(1, 'late')
+    assert drain(scheduler) == [2]
+    assert scheduler.dropped[1] == 3
+
+
+def test_lowest_priority_keeps_last_tenant():
+    scheduler = make_scheduler({1: 0.5})
+    fill(scheduler, {1: 1})
+    assert scheduler.lowest_priority_users() == set()
+    fill(scheduler, {2: 1, 3: 5})
+    assert scheduler.lowest_priority_users() == {1}
+
+
+def test_governor_sheds_only_on_overloaded_ticks():
+    scheduler = make_scheduler()
+    fill(scheduler, {user_id: user_id for user_id in range(1, 7)})
+    governor = main.OverloadGovernor(scheduler)
+    overloaded = main.GOVERNOR_MAX_DEPTH + 1
+    for _ in range(max(main.OVERLOAD_LEVELS)):
+        governor.update(overloaded, 0.0)
+    assert governor.level == 4
+    assert scheduler.shed_users == {6}
+
+    # Спокойные тики при восстановлении не добавляют новых отброшенных пользователей
+    for _ in range(main.GOVERNOR_RECOVERY_TICKS - 1):
+        governor.update(0, 0.0)
+    assert governor.level == 4
+    assert scheduler.shed_users == {6}
+
+    governor.update(0, 0.0)
+    assert governor.level == 3
+    assert scheduler.shed_users == set()
+    assert sorted(scheduler.queues) == [1, 2, 3, 4, 5]
+
+
+def test_parse_tenant_weights_skips_invalid_entries(caplog):
+    weights = main.parse_tenant_weights('1:2, 2:0, 3:-1, 123, x:1, 4:abc, 5:0.5,')
+    assert weights == {1: 2.0, 5: 0.5}
+    assert sum('TENANT_WEIGHTS' in record.getMessage() for record in caplog.records) == 5
+
+
+def test_submit_drops_messages_over_queue_limit():
+    scheduler = main.FairScheduler(noop_handler, workers=1, weights={}, queue_limit=2)
+    scheduler.ready = asyncio.Semaphore(0)
+    fill(scheduler, {1: 5, 2: 1})
+    assert len(scheduler.queues[1]) == 2
+    assert scheduler.dropped[1] == 3
+    assert drain(scheduler) == [1, 2, 1]
@@ -0,0 +1,73 @@
+import main
+
+
+def message(text, chat_name='chat', username='u', chat_id='10'):
+    return {'chat_id': chat_id, 'chat_name': chat_name, 'username': username, 'message_type': 'group',
+            'has_keywords': False, 'keywords_found': '', 'message_text': text}
+
+
+def test_short_text_is_stored_plain(monkeypatch):
+    monkeypatch.setattr(main, 'MESSAGE_COMPRESSION', True)
+    text = 'к' * (main.COMPRESS_MIN_LENGTH - 1)
+    assert main.encode_message_text(text) == (text, main.TEXT_CODEC_PLAIN)
+    assert main.decode_message_text(text, main.TEXT_CODEC_PLAIN) == text
+
+
+def test_long_text_round_trips_through_zlib(monkeypatch):
+    monkeypatch.setattr(main, 'MESSAGE_COMPRESSION', True)
+    text = 'Сдаю квартиру у метро, ' * (main.COMPRESS_MIN_LENGTH // 10)
+    stored, codec = main.encode_message_text(text)
+    assert codec == main.TEXT_CODEC_ZLIB and len(stored) < len(text.encode())
+    assert main.decode_message_text(stored, codec) == text
+
+
+def test_compression_can_be_disabled(monkeypatch):
+    monkeypatch.setattr(main, 'MESSAGE_COMPRESSION', False)
+    text = 'а' * (main.COMPRESS_MIN_LENGTH * 2)
+    assert main.encode_message_text(text) == (text, main.TEXT_CODEC_PLAIN)
+
+
+def test_intern_chat_reuses_id_and_follows_renames(db):
+    conn = main.get_db_connection()
+    cursor = conn.cursor()
+    first = main.intern_chat(cursor, '10', 'Старое имя', 'group')
+    assert main.intern_chat(cursor, '10', 'Старое имя', 'group') == first
+    assert main.intern_chat(cursor, '10', 'Новое имя', 'group') == first
+    assert main.intern_chat(cursor, '20', 'Другой чат', 'channel') != first
+    assert cursor.execute("SELECT chat_name FROM chats WHERE id = ?", (first,)).fetchone() == ('Новое имя',)
+
+    # Переименование видно и без кэша (запись другого процесса)
+    main.chat_refs.clear()
+    assert main.intern_chat(cursor, '10', 'Третье имя', 'channel') == first
+    assert cursor.execute("SELECT chat_name, message_type FROM chats WHERE id = ?", (first,)).fetchone() == (
+        'Третье имя', 'channel')
+    assert cursor.execute("SELECT COUNT(*) FROM chats").fetchone() == (2,)
+    conn.close()
+
+
+def test_intern_sender_reuses_id(db):
+    conn = main.get_db_connection()
+    cursor = conn.cursor()
+    sender = main.intern_sender(cursor, 'alice')
+    main.sender_refs.clear()
+    assert main.intern_sender(cursor, 'alice') == sender
+    assert main.intern_sender(cursor, 'bob') != sender
+    assert main.intern_sender(cursor, '') is None
+    conn.close()
+
+
+def test_stored_messages_read_back_through_view(db, monkeypatch):
+    monkeypatch.setattr(main, 'MESSAGE_COMPRESSION', True)
+    long_text = 'длинное сообщение ' * 30
+    main.save_user_message(1, message('короткое'))
+    main.save_user_message(1, message(long_text, chat_name='Переименованный'))
+
+    conn = main.connect_message_db(1)
+    rows = conn.execute(
+        "SELECT chat_name, username, message_text, text_codec FROM user_messages_view ORDER BY id"
+    ).fetchall()
+    conn.close()
+    # Имя чата хранится один раз, поэтому старое сообщение показывает новое имя
+    assert [(name, user, main.decode_message_text(text, codec)) for name, user, text, codec in rows] == [
+        ('Переименованный', 'u', 'короткое'), ('Переименованный', 'u', long_text)]
+    assert [codec for *_, codec in rows] == [main.TEXT_CODEC_PLAIN, main.TEXT_CODEC_ZLIB]
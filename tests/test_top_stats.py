@@ -0,0 +1,105 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from aiogram import types
+
+import main
+
+HOUR = 490000
+
+
+def at_hour(monkeypatch, hour):
+    """Часы процесса в середине указанного часа"""
+    monkeypatch.setattr(main.time, 'time', lambda: hour * 3600 + 1800)
+
+
+def count(hour, monkeypatch, user_id, chat_id, keywords=()):
+    at_hour(monkeypatch, hour)
+    main.count_message_rollup(user_id, chat_id, f'chat {chat_id}', list(keywords))
+
+
+@pytest.fixture
+def rollups(allowed_user, monkeypatch):
+    """Агрегаты за два соседних часа и один старый час, сброшенные в БД"""
+    count(HOUR - 200, monkeypatch, allowed_user, '40', ['scam'])
+    main.flush_rollups()
+    for keywords in (['usdt'], [], []):
+        count(HOUR - 1, monkeypatch, allowed_user, '10', keywords)
+    count(HOUR - 1, monkeypatch, allowed_user, '20', ['дом'])
+    main.flush_rollups()
+    count(HOUR, monkeypatch, allowed_user, '20', ['дом'])
+    count(HOUR, monkeypatch, allowed_user, '20', ['дом', 'usdt'])
+    for _ in range(5):
+        count(HOUR, monkeypatch, allowed_user, '30')
+    count(HOUR, monkeypatch, allowed_user + 1, '20', ['дом'])
+    main.flush_rollups()
+    return allowed_user
+
+
+def test_top_chats_ranked_by_alerts_then_messages(rollups):
+    assert main.get_top_chats(rollups, HOUR - 1, HOUR + 1) == [
+        ('20', 'chat 20', 3, 3),
+        ('10', 'chat 10', 3, 1),
+        ('30', 'chat 30', 5, 0),
+    ]
+    assert main.get_top_chats(rollups, HOUR - 1, HOUR + 1, limit=1) == [('20', 'chat 20', 3, 3)]
+
+
+def test_top_stats_window_excludes_end_hour(rollups):
+    assert main.get_top_chats(rollups, HOUR, HOUR + 1) == [('20', 'chat 20', 2, 2), ('30', 'chat 30', 5, 0)]
+    assert main.get_top_chats(rollups, HOUR - 1, HOUR) == [('10', 'chat 10', 3, 1), ('20', 'chat 20', 1, 1)]
+    assert main.get_top_keywords(rollups, HOUR, HOUR + 1) == [('дом', 2), ('usdt', 1)]
+    assert main.get_top_keywords(rollups, HOUR - 1, HOUR + 1) == [('дом', 3), ('usdt', 2)]
+    assert main.get_top_keywords(rollups, 0, HOUR + 1)[-1] == ('scam', 1)
+
+
+def test_parse_stats_period(monkeypatch):
+    at_hour(monkeypatch, HOUR)
+    assert main.parse_stats_period([]) == (HOUR + 1 - 168, HOUR + 1)
+    assert main.parse_stats_period(['24h']) == (HOUR + 1 - 24, HOUR + 1)
+    assert main.parse_stats_period(['30D']) == (HOUR + 1 - 720, HOUR + 1)
+    assert main.parse_stats_period(['all']) == (0, HOUR + 1)
+    # Вторая дата входит в период целиком
+    assert main.parse_stats_period(['1970-01-02', '1970-01-03']) == (24, 72)
+    for args in (['week'], ['24'], ['-1d']):
+        with pytest.raises(ValueError):
+            main.parse_stats_period(args)
+
+
+def make_update(user_id, text):
+    message = types.Message(
+        message_id=1,
+        date=datetime.now(),
+        chat=types.Chat(id=user_id, type='private'),
+        from_user=types.User(id=user_id, is_bot=False, first_name='User'),
+        text=text,
+    )
+    return types.Update(update_id=1, message=message)
+
+
+def command(user_id, text, monkeypatch):
+    sent = []
+
+    async def fake_send(user_id, text, reply_markup=None):
+        sent.append(text)
+
+    monkeypatch.setattr(main, 'safe_send_message', fake_send)
+    asyncio.run(main.dp.feed_update(main.bot, make_update(user_id, text)))
+    return sent
+
+
+def test_top_commands_use_period_and_unflushed_rollups(rollups, monkeypatch):
+    count(HOUR, monkeypatch, rollups, '50', ['аренда'])
+
+    text, = command(rollups, '/top_keywords 24h', monkeypatch)
+    assert text.splitlines()[2:] == ['1. 🔍 дом - 🚨 3', '2. 🔍 usdt - 🚨 2', '3. 🔍 аренда - 🚨 1']
+    text, = command(rollups, '/top_chats', monkeypatch)
+    assert '(7d)' in text and 'chat 40' not in text
+    assert text.splitlines()[2] == '1. 📱 chat 20 (20)'
+    assert 'chat 40' in command(rollups, '/top_chats all', monkeypatch)[0]
+
+
+def test_top_command_with_bad_period_shows_help(rollups, monkeypatch):
+    text, = command(rollups, '/top_chats week', monkeypatch)
+    assert text.startswith('❌ Используйте: /top_chats')